@@ -1,34 +1,164 @@
 #!/usr/bin/env python3.6
+import os
 import time
+from collections import namedtuple
+from multiprocessing import Pool
 
-from common import get_gas_price_low, get_arg, log, get_env_connection, get_env_funder, AccountResult, csv_reader
+from eth_utils import to_hex
+from web3 import Account
 
-INTERVAL = 1
+from account_store import read_accounts
+from columnar import read_rows
+from common import get_arg, log, get_env_connection, get_env_funder, get_env_config, env_int, env_float, CSVWriter, \
+    install_exit_on_signal
+from gas_oracle import get_env_gas_oracle
+from load_engine import LoadEngine, uniform_send_times, lag_stats
+from tx_tracker import ConfirmationTracker, log_progress
 
+CLEANUP_TX_PER_SEC = env_float("CLEANUP_TX_PER_SEC", 20)
+CLEANUP_BATCH = env_int("CLEANUP_BATCH", 1000)
+CLEANUP_PROCESSES = env_int("CLEANUP_PROCESSES", os.cpu_count())
+CLEANUP_WAIT_TIMEOUT = env_float("CLEANUP_WAIT_TIMEOUT", 600)
 
-def cleanup(csv_in):
-    """return all ether from accounts csv to funder"""
+ETHER_GAS_LIMIT = 21000
+CHUNK_SIZE = 64
 
+CleanupResult = namedtuple("CleanupResult", "address ether tokens ether_tx_hash token_tx_hash")
+
+
+def journal_path(accounts_path):
+    """cleanup journal of an accounts csv"""
+    return os.path.splitext(accounts_path.rstrip("/"))[0] + ".cleanup.csv"
+
+
+def _sign_sweep(job):
+    """sign the sweep txs of one account. runs in a pool worker"""
+    private_key, tx_dicts = job
+    signed = [Account.signTransaction(tx_dict, private_key) for tx_dict in tx_dicts]
+    return [(signed_tx.rawTransaction, to_hex(signed_tx.hash)) for signed_tx in signed]
+
+
+def sweep_tx_hashes(result):
+    return [tx_hash for tx_hash in (result.ether_tx_hash, result.token_tx_hash) if tx_hash]
+
+
+def plan_sweeps(conn, funder, accounts, ids, gas_price, token_gas_limit):
+    """balances, token balances and nonces of accounts ids, in batches. returns the sweep (token transfer, then ether
+    transfer) tx dicts of every account with more than dust, CleanupResult rows of the dust accounts, and the
+    (address, tokens) of stranded accounts: holding tokens, but not the ether to pay for their transfer. their ether is
+    left in place, so that topping it up is enough for a later cleanup to sweep them.
+    nonces are those of the latest block, like the balances, so sweeping an account whose earlier sweep is still
+    pending replaces (or fails against) that sweep instead of queueing an unpayable one behind it"""
+    addresses = [accounts.address(i) for i in ids]
+    balances = conn.get_balances(addresses)
+    token_balances = conn.get_token_balances(addresses)
+    nonces = conn.get_transaction_counts(addresses, "latest")
+    sweeps, dust, stranded = [], [], []
+    for i, address, balance, tokens, nonce in zip(ids, addresses, balances, token_balances, nonces):
+        tx_dicts = []
+        if tokens > 0:
+            if balance < gas_price * token_gas_limit:
+                stranded.append((address, tokens))
+                continue
+            balance -= gas_price * token_gas_limit
+            tx_dicts.append({"to": conn.contract.address, "value": 0, "gas": token_gas_limit, "gasPrice": gas_price,
+                             "nonce": nonce, "chainId": conn.chain_id,
+                             "data": conn.contract.encodeABI(fn_name="transfer", args=[funder.address, tokens])})
+        ether = balance - gas_price * ETHER_GAS_LIMIT
+        if ether > 0:
+            tx_dicts.append({"to": funder.address, "value": ether, "gas": ETHER_GAS_LIMIT, "gasPrice": gas_price,
+                             "nonce": nonce + len(tx_dicts), "chainId": conn.chain_id})
+        else:
+            ether = 0
+        if tx_dicts:
+            sweeps.append((i, address, ether, tokens, tx_dicts))
+        else:
+            dust.append(CleanupResult(address=address, ether=0, tokens=0, ether_tx_hash="", token_tx_hash=""))
+    return sweeps, dust, stranded
+
+
+def cleanup(accounts_path):
+    """return all ether and tokens from the accounts of an accounts csv (or seed file) to funder.
+
+    accounts are swept CLEANUP_BATCH at a time: their balances, token balances and nonces are fetched in batched
+    rpc calls, dust accounts are skipped, sweep txs are signed across a process pool and sent at CLEANUP_TX_PER_SEC,
+    and their inclusion is tracked while later batches go on. every dust account, and every swept account once its
+    sweep txs are included, is written to a journal next to the accounts csv; a cleanup of the same accounts resumes
+    after the accounts in it, so sweeps that were sent but not included are planned again from fresh balances.
+    stranded accounts (see plan_sweeps) are logged and left out of the journal, so they are revisited too."""
     conn = get_env_connection()
     funder = get_env_funder(conn)
+    config = get_env_config()
 
-    gas_price = get_gas_price_low()
-    gas_limit = 21000
+    gas_price = get_env_gas_oracle("safeLow", 0).get_latest_gas_price()
+    log(f"using gas price: {gas_price}, gas limits: {ETHER_GAS_LIMIT} (ether), {config.token_transfer_gas_limit} "
+        f"(tokens)")
+    accounts = read_accounts(accounts_path)
 
-    log(f"using gas price: {gas_price}, gas limit: {gas_limit}")
-    account_results = csv_reader(csv_in, AccountResult)
+    path = journal_path(accounts_path)
+    done = {row.address.lower() for row in read_rows(path, CleanupResult)} if os.path.exists(path) else set()
+    journal = CSVWriter(path, CleanupResult._fields, resume=True)
+    ids = [i for i in range(len(accounts)) if accounts.address(i).lower() not in done]
+    log(f"cleaning up {len(ids)} accounts ({len(done)} already in {path})")
 
-    for i, account_result in enumerate(account_results):
-        account = conn.get_account(account_result.private_key)
-        log(f"cleaning up {account.address} ({i}/{len(account_results)})")
-        balance = conn.get_balance(account.address)
-        if balance >= gas_limit * gas_price:
-            tx_hash = conn.send_ether(account, funder.address, balance - gas_limit * gas_price, gas_price, gas_limit)
-            log(f"{account.address}, {balance}, {tx_hash}")
-        else:
-            log(f"balance too low: {balance}")
-        time.sleep(INTERVAL)
+    tracker = ConfirmationTracker(conn, conn.get_latest_block().number, on_progress=log_progress)
+
+    def send(conn, i, sweep, sent_at):
+        _, address, ether, tokens, signed = sweep
+        tx_hashes = [conn.send_raw(raw_tx, tx_hash) for raw_tx, tx_hash in signed]
+        return CleanupResult(address=address, ether=ether, tokens=tokens,
+                             ether_tx_hash=tx_hashes[-1] if ether else "", token_tx_hash=tx_hashes[0] if tokens else "")
+
+    # CleanupResult of sent sweeps with txs not included yet
+    sent = []
+
+    def on_result(i, result):
+        tracker.add(sweep_tx_hashes(result))
+        sent.append(result)
+
+    def journal_included():
+        still_pending = []
+        for result in sent:
+            if all(tracker.inclusion_block(tx_hash) is not None for tx_hash in sweep_tx_hashes(result)):
+                journal.append(result)
+            else:
+                still_pending.append(result)
+        sent[:] = still_pending
+
+    swept_ether, swept_tokens, stranded_tokens = 0, 0, 0
+    with Pool(CLEANUP_PROCESSES) as pool:
+        tracker.start(config.block_update_interval)
+        for start in range(0, len(ids), CLEANUP_BATCH):
+            sweeps, dust, stranded = plan_sweeps(conn, funder, accounts, ids[start:start + CLEANUP_BATCH], gas_price,
+                                                 config.token_transfer_gas_limit)
+            journal.append_all(dust)
+            for address, tokens in stranded:
+                log(f"stranded: {address} holds {tokens} tokens but not the ether to transfer them")
+            stranded_tokens += sum(tokens for _, tokens in stranded)
+            signed = pool.map(_sign_sweep, [(accounts.private_key(i), tx_dicts) for i, _, _, _, tx_dicts in sweeps],
+                              chunksize=CHUNK_SIZE)
+            sweeps = [sweep[:4] + (signed_txs,) for sweep, signed_txs in zip(sweeps, signed)]
+            engine = LoadEngine(send, config.max_in_flight, on_result=on_result)
+            results = engine.run(sweeps, uniform_send_times(time.time(), CLEANUP_TX_PER_SEC, range(len(sweeps))))
+            swept = [result for result in results if result]
+            swept_ether += sum(result.ether for result in swept)
+            swept_tokens += sum(result.tokens for result in swept)
+            log(f"swept {len(swept)} accounts, skipped {len(dust)} dust and {len(stranded)} stranded accounts "
+                f"({min(start + CLEANUP_BATCH, len(ids))}/{len(ids)}). schedule lag (sec): {lag_stats(engine.lags)}")
+            journal_included()
+
+    tracker.stop()
+    tracker.wait(config.block_update_interval, timeout=CLEANUP_WAIT_TIMEOUT)
+    journal_included()
+    journal.close()
+    if sent:
+        log(f"{len(sent)} sweeps were not included, a cleanup of the same accounts sweeps them again")
+    log(f"returned {swept_ether} wei and {swept_tokens} tokens to {funder.address}")
+    if stranded_tokens:
+        log(f"{stranded_tokens} tokens are stranded in accounts without the ether to transfer them. fund them and run "
+            f"the cleanup again")
 
 
 if __name__ == "__main__":
+    install_exit_on_signal()
     cleanup(get_arg())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3.6
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from eth_utils import to_hex, to_checksum_address
+from web3 import Account
+
+from columnar import read_columns
+from common import env, env_int, log, get_arg, account_root, derive_key, AccountResult
+
+ACCOUNT_CACHE_DIR = env("ACCOUNT_CACHE_DIR", "cache")
+ACCOUNT_PROCESSES = env_int("ACCOUNT_PROCESSES", os.cpu_count())
+
+CHUNK_SIZE = 1024
+CACHE_DTYPE = np.dtype([("private_key", np.uint8, 32), ("address", np.uint8, 20)])
+
+
+def new_seed():
+    return os.urandom(32)
+
+
+def seed_path(accounts_path):
+    """seed file of an accounts csv"""
+    return os.path.splitext(accounts_path)[0] + ".seed"
+
+
+def write_seed(path, seed, count):
+    with open(path, "w") as f:
+        json.dump({"seed": seed.hex(), "count": count}, f)
+
+
+def read_seed(path):
+    """(seed, account count) of a seed file"""
+    with open(path) as f:
+        d = json.load(f)
+    return bytes.fromhex(d["seed"]), d["count"]
+
+
+def cache_path(seed, cache_dir=ACCOUNT_CACHE_DIR):
+    return os.path.join(cache_dir, f"accounts.{hashlib.sha256(seed).hexdigest()[:16]}.npy")
+
+
+def bytes_to_array(values, width):
+    """(n, width) byte array of concatenated values"""
+    return np.frombuffer(b"".join(values), np.uint8).reshape(-1, width)
+
+
+def hex_to_array(values, width):
+    """(n, width) byte array of n hex strings (0x prefixed or not)"""
+    return bytes_to_array([bytes.fromhex("".join(values).replace("0x", ""))], width)
+
+
+def _derive_chunk(job):
+    """concatenated private keys and addresses of accounts start..stop of seed. runs in a pool worker"""
+    seed, start, stop = job
+    root = account_root(seed)
+    private_keys = [derive_key(root, index) for index in range(start, stop)]
+    addresses = [Account.privateKeyToAccount(private_key).address for private_key in private_keys]
+    return b"".join(private_keys), bytes.fromhex("".join(addresses).replace("0x", ""))
+
+
+def derive_accounts(seed, count, processes=ACCOUNT_PROCESSES, cache_dir=ACCOUNT_CACHE_DIR):
+    """(private_key, address) rows of the first count accounts of seed, as a CACHE_DTYPE array.
+
+    rows are read from the seed's cache file (memory mapped, so startup costs nothing per account). missing rows are
+    derived across a process pool, the address being the expensive part, and the cache is rewritten with them"""
+    path = cache_path(seed, cache_dir)
+    cached = np.load(path, mmap_mode="r") if os.path.exists(path) else np.empty(0, CACHE_DTYPE)
+    if len(cached) < count:
+        log(f"deriving accounts {len(cached)} to {count} in {processes} processes")
+        jobs = [(seed, start, min(start + CHUNK_SIZE, count)) for start in range(len(cached), count, CHUNK_SIZE)]
+        with Pool(processes) as pool:
+            chunks = pool.map(_derive_chunk, jobs)
+        derived = np.empty(count, CACHE_DTYPE)
+        derived[:len(cached)] = cached
+        derived["private_key"][len(cached):] = bytes_to_array([chunk[0] for chunk in chunks], 32)
+        derived["address"][len(cached):] = bytes_to_array([chunk[1] for chunk in chunks], 20)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, derived)
+        os.replace(path + ".tmp", path)
+        cached = np.load(path, mmap_mode="r")
+    return cached[:count]
+
+
+class AccountView:
+    """account id of a registry, usable wherever an AccountWrapper is"""
+    __slots__ = ("registry", "id")
+
+    def __init__(self, registry, id):
+        self.registry = registry
+        self.id = id
+
+    @property
+    def address(self):
+        return self.registry.address(self.id)
+
+    @property
+    def private_key(self):
+        return self.registry.private_key(self.id)
+
+    @property
+    def nonce(self):
+        return int(self.registry.nonces[self.id])
+
+    @nonce.setter
+    def nonce(self, nonce):
+        self.registry.nonces[self.id] = nonce
+
+    def get_use_nonce(self):
+        self.nonce += 1
+        return self.nonce - 1
+
+    def to_account_result(self):
+        return AccountResult(private_key=self.private_key, address=self.address)
+
+
+class AccountRegistry:
+    """Accounts by integer id (their row in the accounts csv, i.e. their derivation index): private keys, 20 byte
+    addresses and nonces in contiguous arrays, 60 bytes per account. address strings and AccountViews are only
+    created when used. wherever an account is looked up (plans, results), it may be referred to by id or by address;
+    address lookups go through a sorted copy of the addresses, built on first use."""
+
+    def __init__(self, private_keys, addresses, nonces=None):
+        self.private_keys = private_keys
+        self.addresses = addresses
+        self.nonces = np.zeros(len(addresses), np.int64) if nonces is None else np.array(nonces, np.int64)
+        self._sorted = None
+
+    @classmethod
+    def from_hex(cls, private_keys, addresses, nonces=None):
+        return cls(hex_to_array(private_keys, 32), hex_to_array(addresses, 20), nonces)
+
+    @classmethod
+    def from_seed(cls, seed, count):
+        rows = derive_accounts(seed, count)
+        return cls(rows["private_key"], rows["address"])
+
+    def __len__(self):
+        return len(self.nonces)
+
+    def __iter__(self):
+        return (AccountView(self, i) for i in range(len(self)))
+
+    def address(self, i):
+        return to_checksum_address(self.addresses[i].tobytes())
+
+    def private_key(self, i):
+        return to_hex(self.private_keys[i].tobytes())
+
+    def ids(self, keys):
+        """ids of accounts referred to by id or by address"""
+        keys = list(keys)
+        if not keys or not keys[0].startswith("0x"):
+            return np.array(keys, np.int64)
+        if self._sorted is None:
+            flat = np.ascontiguousarray(self.addresses).view("S20").ravel()
+            order = np.argsort(flat)
+            self._sorted = flat[order], order
+        sorted_addresses, order = self._sorted
+        wanted = np.ascontiguousarray(hex_to_array(keys, 20)).view("S20").ravel()
+        positions = np.minimum(np.searchsorted(sorted_addresses, wanted), len(order) - 1)
+        if (sorted_addresses[positions] != wanted).any():
+            raise KeyError("unknown account address")
+        return order[positions]
+
+    def id_of(self, key):
+        return int(self.ids([str(key)])[0])
+
+    def account(self, key):
+        return AccountView(self, self.id_of(key))
+
+    def address_of(self, key):
+        return key if key.startswith("0x") else self.address(int(key))
+
+    def allocate_nonces(self, ids):
+        """next nonce of every account in ids, in order (an account's consecutive uses get consecutive nonces).
+        nonces are advanced past them"""
+        ids = np.asarray(ids, np.int64)
+        if len(ids) == 0:
+            return []
+        order = np.argsort(ids, kind="mergesort")
+        sorted_ids = ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        uses = np.diff(np.r_[starts, len(ids)])
+        nonces = np.empty(len(ids), np.int64)
+        nonces[order] = self.nonces[sorted_ids] + np.arange(len(ids)) - np.repeat(starts, uses)
+        self.nonces[sorted_ids[starts]] += uses
+        return nonces.tolist()
+
+    def account_results(self):
+        return (AccountResult(private_key=self.private_key(i), address=self.address(i)) for i in range(len(self)))
+
+
+def read_accounts(path):
+    """AccountRegistry of an accounts csv (or columnar directory), with addresses as stored, or of a seed file"""
+    if path.endswith(".seed"):
+        return AccountRegistry.from_seed(*read_seed(path))
+    columns = read_columns(path, AccountResult)
+    return AccountRegistry.from_hex(columns.private_key.tolist(), columns.address.tolist())
+
+
+if __name__ == "__main__":
+    """./account_store.py <seed_file>: derive (and cache) the accounts of a seed"""
+    log(f"{len(read_accounts(get_arg(0)))} accounts ready")
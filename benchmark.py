@@ -0,0 +1,244 @@
+#!/usr/bin/env python3.6
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from multiprocessing import Process
+
+import numpy as np
+from eth_utils import to_hex
+from web3 import Account, IPCProvider
+
+from block_monitor import BlockResult
+from collect_results import collect_stats, TxPlusResult, NUM_OF_BLOCKS
+from common import log, env, env_int, now_str, has_args, get_arg, CSVWriter, csv_reader, Connection, AccountCreator, \
+    stringify_list
+from load_engine import LoadEngine, lag_stats
+from load_test import TxResult
+from mock_node import start_mock_node, MockNodeConfig
+from tx_tracker import ReceiptResult
+
+BENCH_TXS = env_int("BENCH_TXS", 2000)
+BENCH_CSV_ROWS = env_int("BENCH_CSV_ROWS", 100000)
+BENCH_BLOCK_SIZES = [int(n) for n in env("BENCH_BLOCK_SIZES", "10,100,1000").split(",")]
+BENCH_JOIN_TXS = 10000
+BENCH_REPEATS = env_int("BENCH_REPEATS", 3)
+MAX_IN_FLIGHT = env_int("MAX_IN_FLIGHT", 16)
+
+# blocks are mined on demand (evm_mine), so every block holds exactly what was sent before it
+MOCK_CONFIG = MockNodeConfig(block_time=3600, block_gas_limit=10 ** 9, chain_id=1, default_balance=10 ** 24,
+                             default_tokens=10 ** 9, latency_ms=0, timeout_rate=0, timeout_sec=0, seed=0)
+ERC20_ADDRESS = "0x" + "11" * 20
+GAS_PRICE = 10 ** 9
+GAS_LIMIT = 60000
+SENDERS = 50
+
+
+def run_mock_node(ipc_path):
+    start_mock_node(MOCK_CONFIG, ipc_path)
+    while True:
+        time.sleep(3600)
+
+
+def mock_connection(ipc_path):
+    with open(env("ERC20_ABI_PATH", "contract/contract-abi.json")) as f:
+        erc20_abi = f.read().replace('\n', '')
+    return Connection(MOCK_CONFIG.chain_id, IPCProvider(ipc_path, timeout=10), ERC20_ADDRESS, erc20_abi)
+
+
+def best_of(f, repeats=BENCH_REPEATS):
+    """fastest wall time (seconds) of repeats calls of f"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def rate(count, seconds, **extra):
+    return dict(count=count, seconds=seconds, per_sec=count / seconds, **extra)
+
+
+def new_senders(count=SENDERS):
+    account_creator = AccountCreator()
+    return [account_creator.next() for _ in range(count)]
+
+
+def sign_transfers(conn, count):
+    """(raw tx, tx hash) of count token transfers, round-robin over fresh senders"""
+    senders = new_senders()
+    data = conn.contract.encodeABI(fn_name="transfer", args=[senders[0].address, 1])
+    signed = []
+    for i in range(count):
+        sender = senders[i % len(senders)]
+        tx = {"to": ERC20_ADDRESS, "value": 0, "data": data, "gas": GAS_LIMIT, "gasPrice": GAS_PRICE,
+              "nonce": sender.get_use_nonce(), "chainId": conn.chain_id}
+        signed_tx = Account.signTransaction(tx, sender.private_key)
+        signed.append((bytes(signed_tx.rawTransaction), to_hex(signed_tx.hash)))
+    return signed
+
+
+def bench_encode_sign(conn, count):
+    """abi encoding plus signing of token transfers, as send_tokens does it but without sending"""
+    senders = new_senders()
+    start = time.perf_counter()
+    for i in range(count):
+        sender = senders[i % len(senders)]
+        tx = conn.contract.functions.transfer(senders[0].address, 1).buildTransaction(
+            {"gas": GAS_LIMIT, "gasPrice": GAS_PRICE, "chainId": conn.chain_id, "nonce": sender.get_use_nonce()})
+        conn.w3.eth.account.signTransaction(tx, sender.private_key)
+    return rate(count, time.perf_counter() - start)
+
+
+def bench_send_tokens(conn, count):
+    """Connection.send_tokens end to end (encode, sign, send) on a single connection"""
+    senders = new_senders()
+    start = time.perf_counter()
+    for i in range(count):
+        conn.send_tokens(senders[i % len(senders)], senders[0].address, 1, GAS_PRICE, GAS_LIMIT)
+    return rate(count, time.perf_counter() - start)
+
+
+def bench_raw_send(conn, ipc_path, count):
+    """throughput of sending pre-signed txs, sequentially and through the load engine with every tx due at once"""
+    signed = sign_transfers(conn, count)
+    start = time.perf_counter()
+    for raw_tx, tx_hash in signed:
+        conn.send_raw(raw_tx, tx_hash)
+    sequential = rate(count, time.perf_counter() - start)
+
+    signed = sign_transfers(conn, count)
+    engine = LoadEngine(lambda c, i, item, sent_at: c.send_raw(*item), MAX_IN_FLIGHT,
+                        connection_factory=lambda: mock_connection(ipc_path))
+    start = time.perf_counter()
+    engine.run(signed, [time.time()] * count)
+    engine_rate = rate(count, time.perf_counter() - start, max_in_flight=MAX_IN_FLIGHT,
+                       lag=lag_stats(engine.lags)._asdict())
+    return {"sequential": sequential, "engine": engine_rate}
+
+
+def bench_csv(directory, count):
+    """CSVWriter append cost per row and csv_reader load time of the written file"""
+    path = os.path.join(directory, "txs.csv")
+    row = TxResult(frm="0x" + "ab" * 20, to="0x" + "cd" * 20, tx_hash="0x" + "ef" * 32, timestamp=time.time(),
+                   gas_price=GAS_PRICE, block_at_submit=1000000)
+    writer = CSVWriter(path, TxResult._fields)
+    start = time.perf_counter()
+    for _ in range(count):
+        writer.append(row)
+    writer.close()
+    append = rate(count, time.perf_counter() - start)
+    append["ns_per_row"] = append["seconds"] / count * 1e9
+    read = rate(count, best_of(lambda: csv_reader(path, TxResult)))
+    return {"append": append, "read": read}
+
+
+def mine(conn):
+    """mine a block of the pending txs (as many as fit). returns its number"""
+    return int(conn.w3.manager.request_blocking("evm_mine", []), 16)
+
+
+def bench_block_stats(conn, sizes):
+    """get_block_stats time of blocks with tx hashes (txs are fetched in batches) and with full txs, per block size.
+    txs left pending by earlier benchmarks are mined first, so every block holds exactly size txs"""
+    while conn.get_block(mine(conn)).transactions:
+        pass
+    results = []
+    for size in sizes:
+        for raw_tx, tx_hash in sign_transfers(conn, size):
+            conn.send_raw(raw_tx, tx_hash)
+        number = mine(conn)
+        block = conn.get_block(number)
+        full_block = conn.get_block(number, True)
+        results.append({"tx_count": len(block.transactions),
+                        "hashes_seconds": best_of(lambda: conn.get_block_stats(block)),
+                        "full_seconds": best_of(lambda: conn.get_block_stats(full_block)),
+                        "fetch_full_seconds": best_of(lambda: conn.get_block(number, True))})
+        log(f"block stats: {results[-1]}")
+    return results
+
+
+def join_inputs(count, blocks=200, mined_fraction=0.9):
+    """synthetic tx results, receipt columns and block columns for count txs spread over blocks blocks"""
+    rand = np.random.RandomState(0)
+    tx_hashes = ["0x" + os.urandom(32).hex() for _ in range(count)]
+    tx_results = [TxResult(*stringify_list(["0x" + "ab" * 20, "0x" + "cd" * 20, tx_hash, 1.5e9 + i, GAS_PRICE, 0]))
+                  for i, tx_hash in enumerate(tx_hashes)]
+    mined = rand.rand(count) < mined_fraction
+    receipt_columns = ReceiptResult(tx_hash=np.array(tx_hashes)[mined],
+                                    block_number=rand.randint(0, blocks, mined.sum()),
+                                    gas_used=np.full(mined.sum(), 51000.0))
+    numbers = np.arange(blocks + NUM_OF_BLOCKS)
+    block_columns = BlockResult(*[np.zeros(len(numbers))] * len(BlockResult._fields))._replace(
+        block_number=numbers, block_timestamp=1.5e9 + numbers * 15.0, my_timestamp=1.5e9 + numbers * 15.0 + 0.5)
+    return tx_results, block_columns, receipt_columns
+
+
+def bench_collect_join(directory, count=BENCH_JOIN_TXS):
+    """collect_results join (captured receipts, no rpc) of count txs, written to csv"""
+    tx_results, block_columns, receipt_columns = join_inputs(count)
+
+    def join():
+        writer = CSVWriter(os.path.join(directory, "txs_plus.csv"), TxPlusResult._fields)
+        collect_stats(tx_results, block_columns, writer, receipt_columns)
+        writer.close()
+
+    seconds = best_of(join)
+    return rate(count, seconds, seconds_per_10k=seconds / count * 10000)
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.decode().strip() or None
+
+
+def benchmark():
+    directory = tempfile.mkdtemp(prefix="benchmark.")
+    ipc_path = os.path.join(directory, "mock.ipc")
+    node = Process(target=run_mock_node, args=(ipc_path,), daemon=True)
+    node.start()
+    while not os.path.exists(ipc_path):
+        time.sleep(0.1)
+    try:
+        conn = mock_connection(ipc_path)
+        results = {}
+        log("benchmarking abi encoding + signing")
+        results["encode_sign"] = bench_encode_sign(conn, BENCH_TXS)
+        log("benchmarking send_tokens")
+        results["send_tokens"] = bench_send_tokens(conn, BENCH_TXS)
+        log("benchmarking raw sends")
+        results["raw_send"] = bench_raw_send(conn, ipc_path, BENCH_TXS)
+        log("benchmarking csv writer and reader")
+        results["csv"] = bench_csv(directory, BENCH_CSV_ROWS)
+        log("benchmarking block stats")
+        results["block_stats"] = bench_block_stats(conn, BENCH_BLOCK_SIZES)
+        log("benchmarking collect_results join")
+        results["collect_join"] = bench_collect_join(directory)
+    finally:
+        node.terminate()
+        node.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "revision": git_revision(),
+        "time": now_str(),
+        "params": {"txs": BENCH_TXS, "csv_rows": BENCH_CSV_ROWS, "block_sizes": BENCH_BLOCK_SIZES,
+                   "join_txs": BENCH_JOIN_TXS, "repeats": BENCH_REPEATS, "max_in_flight": MAX_IN_FLIGHT,
+                   "cpu_count": os.cpu_count()},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    """./benchmark.py [<output json>]"""
+    report = json.dumps(benchmark(), indent=2)
+    print(report)
+    if has_args():
+        with open(get_arg(0), "w") as f:
+            f.write(report)
@@ -1,28 +1,93 @@
 #!/usr/bin/env python3.6
 import time
-from collections import namedtuple
-from multiprocessing import Value, Process
+from collections import namedtuple, deque
+from multiprocessing import Array, Value, Process
 
-from common import CSVWriter, log, now_str, get_env_connection
+from common import CSVWriter, log, now_str, get_env_connection, env, BlockStats, install_exit_on_signal
+from head_subscription import get_env_head_subscription
 
 INTERVAL = 0.1
+MODE = env("BLOCK_MONITOR_MODE", "subscribe")
+STATS_RING_SIZE = 64
+FULLNESS_BLOCKS = 4
 
 BlockResult = namedtuple('BlockResult', 'block_number, block_timestamp, my_timestamp, timestamp_delta tx_count '
-                                        'avg_gas_price median_gas_price q5_gas_price q95_gas_price')
+                                        'avg_gas_price median_gas_price q5_gas_price q95_gas_price stats_timestamp')
 
 
-def monitor_block_timestamps(csv_out, interval, shared_latest_block):
+class BlockStatsRing:
+    """the BlockStats of the latest size blocks, in shared memory, written by the monitor process"""
+
+    def __init__(self, size=STATS_RING_SIZE):
+        self.size = size
+        self._stats = Array('d', size * len(BlockStats._fields))
+        self._count = Value('i', 0, lock=False)
+
+    def append(self, stats):
+        field_count = len(BlockStats._fields)
+        i = self._count.value % self.size * field_count
+        self._stats[i:i + field_count] = [float(v) for v in stats]
+        self._count.value += 1
+
+    def recent(self):
+        """BlockStats of the latest blocks, newest last"""
+        field_count = len(BlockStats._fields)
+        count = self._count.value
+        values = self._stats[:]
+        return [BlockStats(*values[n % self.size * field_count:(n % self.size + 1) * field_count])
+                for n in range(max(count - self.size, 0), count)]
+
+
+def poll_blocks(conn, interval, next_block_number=None):
+    """yield (observed timestamp, full block) for every new block, by polling every interval seconds"""
+    if next_block_number is None:
+        block = conn.get_latest_block(full_transactions=True)
+    else:
+        block = conn.get_block_wait(next_block_number, interval, full_transactions=True)
+    while True:
+        yield time.time(), block
+        block = conn.get_block_wait(block.number + 1, interval, full_transactions=True)
+
+
+def new_blocks(conn, interval, mode):
+    """yield (observed timestamp, full block) for every new block.
+    in "subscribe" mode blocks are observed when the node pushes their head (heights skipped by the node are fetched
+    and share the observed time). falls back to polling if no subscription endpoint is configured or it fails."""
+    last_block_number = None
+    subscription = get_env_head_subscription() if mode == "subscribe" else None
+    if subscription:
+        try:
+            with subscription:
+                for block_number, observed in subscription:
+                    if last_block_number is not None and block_number <= last_block_number:
+                        continue
+                    first = block_number if last_block_number is None else last_block_number + 1
+                    for n in range(first, block_number + 1):
+                        yield observed, conn.get_block_wait(n, interval, full_transactions=True)
+                        last_block_number = n
+        except (OSError, ValueError) as e:
+            log(f"head subscription failed ({e}). falling back to polling")
+    yield from poll_blocks(conn, interval, None if last_block_number is None else last_block_number + 1)
+
+
+def monitor_block_timestamps(csv_out, interval, shared_latest_block, mode=MODE, shared_lags=None, stats_ring=None,
+                             shared_fullness=None):
     """gather block information to csv.
-    per block: block_number, block_timestamp (by miner), block_timestamp (by me), delta of both, tx_count
+    per block: block_number, block_timestamp (by miner), block_timestamp (by me), delta of both, tx_count,
+    gas price stats, and the time stats were done computing.
+    blocks are fetched with full txs in a single call. my_timestamp (sub-second) is taken as soon as the block is
+    observed so the time spent on stats can't leak into it.
+    shared_lags, if given, holds the latest block's (timestamp_delta, stats_timestamp - my_timestamp), and
+    stats_ring the BlockStats of the latest blocks, and shared_fullness the mean gas used / gas limit of the latest
+    FULLNESS_BLOCKS blocks.
     """
     log(csv_out.cols)
     conn = get_env_connection()
-    latest_block = conn.get_latest_block()
-    while True:
+    fullness = deque(maxlen=FULLNESS_BLOCKS)
+    for my_timestamp, latest_block in new_blocks(conn, interval, mode):
         log(f"new block detected: {latest_block.number}")
         shared_latest_block.value = float(latest_block.number)
         latest_block_timestamp = latest_block.timestamp
-        my_timestamp = int(time.time())
         block_stats = conn.get_block_stats(latest_block)
 
         row = BlockResult(
@@ -34,17 +99,34 @@ def monitor_block_timestamps(csv_out, interval, shared_latest_block):
             avg_gas_price=block_stats.avg_gas_price,
             median_gas_price=block_stats.median_gas_price,
             q5_gas_price=block_stats.q5_gas_price,
-            q95_gas_price=block_stats.q95_gas_price)
+            q95_gas_price=block_stats.q95_gas_price,
+            stats_timestamp=time.time())
         csv_out.append(row)
+        if shared_lags is not None:
+            shared_lags[:] = [row.timestamp_delta, row.stats_timestamp - my_timestamp]
+        if stats_ring is not None:
+            stats_ring.append(block_stats)
+        if shared_fullness is not None:
+            fullness.append(latest_block.gasUsed / latest_block.gasLimit)
+            shared_fullness.value = sum(fullness) / len(fullness)
         log(row)
-        latest_block = conn.get_block_wait(latest_block.number + 1, interval)
+
+
+def run_block_monitor(*args, **kwargs):
+    """monitor_block_timestamps in the block monitor process, which is stopped by SIGTERM"""
+    install_exit_on_signal()
+    monitor_block_timestamps(*args, **kwargs)
 
 
 class BlockMonitorProcess:
     def __init__(self, csv_writer, interval, initial_block_number):
         self._shared_block_number = Value('d', float(initial_block_number))
-        self._process = Process(target=monitor_block_timestamps, args=(csv_writer, interval,
-                                                                       self._shared_block_number))
+        self._shared_lags = Array('d', 2)
+        self._stats_ring = BlockStatsRing()
+        self._shared_fullness = Value('d', 0.0)
+        self._process = Process(target=run_block_monitor, args=(csv_writer, interval, self._shared_block_number),
+                                kwargs={"shared_lags": self._shared_lags, "stats_ring": self._stats_ring,
+                                        "shared_fullness": self._shared_fullness})
 
     def start(self):
         log("starting block monitoring")
@@ -52,12 +134,29 @@ class BlockMonitorProcess:
 
     def stop(self):
         self._process.terminate()
+        self._process.join()
 
     def get_latest_block_number(self):
         return self._shared_block_number.value
 
+    def get_observed_delay(self):
+        """observed time minus miner timestamp of the latest block"""
+        return self._shared_lags[0]
+
+    def get_monitor_lag(self):
+        """time spent processing the latest block after it was observed"""
+        return self._shared_lags[1]
+
+    def get_recent_block_stats(self):
+        return self._stats_ring.recent()
+
+    def get_block_fullness(self):
+        """mean gas used / gas limit of the latest blocks"""
+        return self._shared_fullness.value
+
 
 if __name__ == "__main__":
+    install_exit_on_signal()
     shared_latest_block = Value('d', 0.0)
     block_csv_writer = CSVWriter(f"results/blocks.{now_str()}.csv", BlockResult._fields)
     monitor_block_timestamps(block_csv_writer, INTERVAL, shared_latest_block)
@@ -1,52 +1,109 @@
 #!/usr/bin/env python3.6
+import sys
 from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
 
 from block_monitor import BlockResult
-from common import get_arg, now_str, get_env_connection, CSVWriter, csv_reader, log
+from common import get_arg, get_env_connection, CSVWriter, log, install_exit_on_signal
+from columnar import read_rows, read_columns
 from load_test import TxResult
+from tx_tracker import ReceiptResult
 
 NUM_OF_BLOCKS = 12
 
+tx_plus_fields = []
+tx_plus_fields.extend(TxResult._fields)
+tx_plus_fields.extend(['gas_used', 'block_number'])
+for n in range(1, 1 + NUM_OF_BLOCKS):
+    tx_plus_fields.extend([f'timestamp_{n}', f'self_timestamp_{n}'])
+TxPlusResult = namedtuple("TxPlusResult", " ".join(tx_plus_fields))
+
+
+@lru_cache(maxsize=None)
+def env_connection():
+    """connect only once rpc turns out to be needed"""
+    return get_env_connection()
+
+
+def format_number(v):
+    """csv form of a number: '' for nan, whole numbers without a trailing .0"""
+    if np.isnan(v):
+        return ''
+    return str(int(v)) if v == int(v) else repr(float(v))
+
+
+def join_receipts(tx_hashes, receipt_columns):
+    """(inclusion block numbers, gas used) per tx hash. block number is -1 for txs that were not mined.
+    receipts captured during the test are joined by sorted hash lookup; without them receipts are fetched in batches"""
+    if receipt_columns is None:
+        receipts = env_connection().get_transaction_receipts(tx_hashes.tolist())
+        block_numbers = np.array([r.blockNumber if r and r.blockNumber else -1 for r in receipts], dtype=np.int64)
+        gas_used = np.array([r.gasUsed if r and r.blockNumber else np.nan for r in receipts], dtype=np.float64)
+        return block_numbers, gas_used
+    if len(receipt_columns.tx_hash) == 0:
+        return np.full(len(tx_hashes), -1, dtype=np.int64), np.full(len(tx_hashes), np.nan)
+    receipt_hashes = np.char.lower(np.asarray(receipt_columns.tx_hash))
+    order = np.argsort(receipt_hashes)
+    sorted_hashes = receipt_hashes[order]
+    pos = np.minimum(np.searchsorted(sorted_hashes, tx_hashes), len(sorted_hashes) - 1)
+    found = sorted_hashes[pos] == tx_hashes
+    block_numbers = np.where(found, np.asarray(receipt_columns.block_number)[order][pos], -1)
+    gas_used = np.where(found, np.asarray(receipt_columns.gas_used)[order][pos], np.nan)
+    return block_numbers, gas_used
+
 
-class BlockCache:
-    def __init__(self, conn, block_results):
-        self.conn = conn
-        self.block_mem = {block_result.block_number: (block_result.block_timestamp, block_result.my_timestamp)
-                          for block_result in block_results}
+def block_table(block_columns, needed_block_numbers):
+    """sorted (block number, miner timestamp, observed timestamp) arrays covering all needed blocks. blocks the
+    monitor missed are fetched in one batched pre-pass and have no observed timestamp"""
+    numbers, first = np.unique(np.asarray(block_columns.block_number), return_index=True)
+    timestamps = np.asarray(block_columns.block_timestamp, dtype=np.float64)[first]
+    my_timestamps = np.asarray(block_columns.my_timestamp, dtype=np.float64)[first]
+    missing = np.setdiff1d(needed_block_numbers, numbers)
+    if len(missing) > 0:
+        log(f"fetching {len(missing)} blocks missing from block results")
+        blocks = env_connection().get_blocks(missing.tolist())
+        numbers = np.concatenate([numbers, missing])
+        timestamps = np.concatenate([timestamps, [block.timestamp for block in blocks]])
+        my_timestamps = np.concatenate([my_timestamps, np.full(len(missing), np.nan)])
+        order = np.argsort(numbers)
+        numbers, timestamps, my_timestamps = numbers[order], timestamps[order], my_timestamps[order]
+    return numbers, timestamps, my_timestamps
 
-    def get(self, block_number):
-        k = str(block_number)
-        if k in self.block_mem:
-            return self.block_mem[k]
-        self.block_mem[k] = (str(self.conn.get_block(block_number).timestamp), '')
-        return self.block_mem[k]
 
+def collect_stats(tx_results, block_columns, tx_plus_writer, receipt_columns=None):
+    """join txs with the miner and observed timestamps of their inclusion block and NUM_OF_BLOCKS - 1 blocks after
+    it, for all txs at once. needs no rpc when receipts were captured and the block monitor saw every block."""
+    tx_hashes = np.char.lower(np.array([tx_result.tx_hash for tx_result in tx_results], dtype="U66"))
+    block_numbers, gas_used = join_receipts(tx_hashes, receipt_columns)
+    mined = block_numbers >= 0
 
-def collect_stats(tx_results, block_results, tx_plus_writer):
-    conn = get_env_connection()
-    block_cache = BlockCache(conn, block_results)
+    confirmation_blocks = block_numbers[mined][:, None] + np.arange(NUM_OF_BLOCKS)
+    numbers, timestamps, my_timestamps = block_table(block_columns, np.unique(confirmation_blocks))
+    idx = np.searchsorted(numbers, confirmation_blocks)
+    confirmation_timestamps = np.full((len(tx_results), NUM_OF_BLOCKS), np.nan)
+    confirmation_my_timestamps = np.full((len(tx_results), NUM_OF_BLOCKS), np.nan)
+    confirmation_timestamps[mined] = timestamps[idx]
+    confirmation_my_timestamps[mined] = my_timestamps[idx]
 
-    for tx_result in tx_results:
-        result = []
-        result.extend(tx_result)
-        tx_hash = tx_result.tx_hash
-        tx = conn.get_transaction_receipt(tx_hash)
-        if tx and tx.blockNumber:
-            result.append(str(tx.gasUsed))
-            result.append(str(tx.blockNumber))
-            for block_number in range(tx.blockNumber, tx.blockNumber + NUM_OF_BLOCKS):
-                result.extend(block_cache.get(block_number))
-        tx_plus = TxPlusResult(*result)
-        log(tx_plus)
-        tx_plus_writer.append(tx_plus)
+    rows = []
+    for i, tx_result in enumerate(tx_results):
+        result = list(tx_result)
+        if mined[i]:
+            result.append(format_number(gas_used[i]))
+            result.append(str(block_numbers[i]))
+            for timestamp, my_timestamp in zip(confirmation_timestamps[i], confirmation_my_timestamps[i]):
+                result.extend([format_number(timestamp), format_number(my_timestamp)])
+        result.extend([''] * (len(TxPlusResult._fields) - len(result)))
+        rows.append(TxPlusResult(*result))
+    log(f"joined {len(rows)} txs, {mined.sum()} mined")
+    tx_plus_writer.append_all(rows)
 
 
 if __name__ == "__main__":
-    tx_plus_fields = []
-    tx_plus_fields.extend(TxResult._fields)
-    tx_plus_fields.extend(['gas_used', 'block_number'])
-    for i in range(1, 1 + NUM_OF_BLOCKS):
-        tx_plus_fields.extend([f'timestamp_{i}', f'self_timestamp_{i}'])
-    TxPlusResult = namedtuple("TxPlusResult", " ".join(tx_plus_fields))
-    collect_stats(csv_reader(get_arg(0), TxResult), csv_reader(get_arg(1), BlockResult),
-                  CSVWriter(get_arg(2), TxPlusResult._fields))
+    """./collect_results.py <txs> <blocks> <output csv> [<receipts>]"""
+    install_exit_on_signal()
+    receipt_columns = read_columns(get_arg(3), ReceiptResult) if len(sys.argv) > 4 else None
+    collect_stats(read_rows(get_arg(0), TxResult), read_columns(get_arg(1), BlockResult),
+                  CSVWriter(get_arg(2), TxPlusResult._fields), receipt_columns)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3.6
+import os
+import sys
+
+import numpy as np
+
+from common import csv_reader, log
+
+COLUMNAR_SUFFIX = ".cols"
+HEADER_FILE = "_columns.txt"
+
+# dtype per result column name. unknown columns are stored as strings, and float columns holding only integers
+# (e.g. int timestamps) as integers, so that they read back as written
+COLUMN_DTYPES = {
+    "frm": "U42",
+    "to": "U42",
+    "address": "U42",
+    "tx_hash": "U66",
+    "private_key": "U66",
+    "timestamp": "f8",
+    "gas_price": "f8",
+    "block_at_submit": "f8",
+    "block_number": "i8",
+    "block_timestamp": "i8",
+    "my_timestamp": "f8",
+    "timestamp_delta": "f8",
+    "tx_count": "i8",
+    "avg_gas_price": "f8",
+    "median_gas_price": "f8",
+    "q5_gas_price": "f8",
+    "q95_gas_price": "f8",
+    "stats_timestamp": "f8",
+    "gas_used": "f8",
+}
+
+
+def is_columnar(path):
+    return os.path.isdir(path)
+
+
+def columnar_path(csv_path):
+    return (csv_path[:-len(".csv")] if csv_path.endswith(".csv") else csv_path) + COLUMNAR_SUFFIX
+
+
+def to_column(values, col):
+    """typed array from string values. empty numeric values become nan"""
+    dtype = np.dtype(COLUMN_DTYPES.get(col, "U"))
+    values = np.asarray(values, dtype="U")
+    if dtype.kind == "f" and len(values) and np.char.isdigit(np.char.lstrip(values, "-")).all():
+        dtype = np.dtype("i8")
+    if dtype.kind == "f":
+        values = np.where(values == "", "nan", values)
+    return values.astype(dtype)
+
+
+def to_str(value):
+    """csv representation of a column value: nan is empty"""
+    return "" if isinstance(value, float) and value != value else str(value)
+
+
+def write_columns(path, cols, columns):
+    """write one .npy file per column (all of equal length) into directory path"""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, HEADER_FILE), "w") as f:
+        f.write(",".join(cols) + "\n")
+    for col, column in zip(cols, columns):
+        np.save(os.path.join(path, col + ".npy"), to_column(column, col))
+
+
+def csv_to_columnar(csv_path):
+    """convert a result csv to columnar format, next to it. returns the columnar path"""
+    with open(csv_path) as f:
+        cols = f.readline().strip().split(",")
+        rows = [line.split(",") for line in f.read().splitlines()]
+    padded = [""] * len(cols)
+    rows = [row + padded[len(row):] for row in rows]
+    columns = [[row[j] for row in rows] for j in range(len(cols))]
+    path = columnar_path(csv_path)
+    write_columns(path, cols, columns)
+    log(f"wrote {len(rows)} rows to {path}")
+    return path
+
+
+def read_columns(path, ntuple):
+    """ntuple of typed column arrays, from either a csv or a columnar directory (memory mapped).
+    columns missing from older files are all nan/empty"""
+    if is_columnar(path):
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            cols = f.readline().strip().split(",")
+        columns = {col: np.load(os.path.join(path, col + ".npy"), mmap_mode="r") for col in cols}
+    else:
+        rows = csv_reader(path, ntuple)
+        columns = {col: to_column([getattr(row, col) for row in rows], col) for col in ntuple._fields}
+    length = len(next(iter(columns.values()))) if columns else 0
+    return ntuple(*(columns[col] if col in columns else to_column([""] * length, col) for col in ntuple._fields))
+
+
+def read_rows(path, ntuple):
+    """rows of string values, like csv_reader, from either a csv or a columnar directory"""
+    if not is_columnar(path):
+        return csv_reader(path, ntuple)
+    columns = read_columns(path, ntuple)
+    as_str = [[to_str(value) for value in column.tolist()] if column.dtype.kind == "f" else column.astype("U").tolist()
+              for column in columns]
+    return [ntuple(*row) for row in zip(*as_str)]
+
+
+def iter_rows(path, ntuple):
+    """rows of string values, like read_rows, one at a time, so that files of any size are read in bounded memory"""
+    if is_columnar(path):
+        columns = read_columns(path, ntuple)
+        for i in range(len(columns[0])):
+            yield ntuple(*(to_str(column[i]) for column in columns))
+        return
+    padded = [''] * len(ntuple._fields)
+    with open(path) as f:
+        next(f, None)
+        for line in f:
+            values = line.rstrip("\n").split(",")
+            yield ntuple(*(values + padded[len(values):]))
+
+
+if __name__ == "__main__":
+    """convert result csv files to columnar format: ./columnar.py <csv> [<csv> ...]"""
+    for csv_path in sys.argv[1:]:
+        csv_to_columnar(csv_path)
@@ -1,23 +1,27 @@
+import hashlib
+import hmac
 import logging
 import sys
 import os
-import math
+import signal
+import threading
 import time
-from multiprocessing import Process, Value
+from multiprocessing.util import Finalize
 
 import numpy as np
 
 from collections import namedtuple
 from datetime import datetime
 
-import requests
-from eth_hash.auto import keccak
 from web3 import Web3, Account, HTTPProvider, IPCProvider
 from web3.utils.threads import Timeout
 
-from eth_utils.conversions import to_hex, text_if_str, to_bytes
+from eth_utils.conversions import to_hex
 from eth_utils import from_wei, to_wei
 
+import metrics
+from rpc_batch import BatchRpc
+
 
 def env(k, default=None):
     try:
@@ -62,35 +66,109 @@ def ignore_timeouts(f):
     return wrapper
 
 
+CSV_FLUSH_ROWS = env_int("CSV_FLUSH_ROWS", 100)
+CSV_FLUSH_MS = env_int("CSV_FLUSH_MS", 1000)
+
+
 class CSVWriter:
-    def __init__(self, path, cols):
+    """Appends rows through a single open handle, buffering up to flush_rows rows or flush_ms milliseconds (idle
+    buffers are flushed by a background thread), so a killed test loses at most one flush window.
+    Buffers are also flushed on close, on exit and on SIGTERM (see install_exit_on_signal). A writer handed to a
+    forked child (e.g. the block monitor) opens its own handle there and never re-writes rows the parent had buffered.
+    with resume, rows are appended to an existing file (e.g. a journal) instead of starting a new one."""
+
+    def __init__(self, path, cols, flush_rows=CSV_FLUSH_ROWS, flush_ms=CSV_FLUSH_MS, resume=False):
         self.path = path
         self.cols = cols
-        with open(path, "w") as csv_file:
-            csv_file.write(",".join(cols) + "\n")
+        self.flush_rows = flush_rows
+        self.flush_ms = flush_ms
+        if not (resume and os.path.exists(path)):
+            with open(path, "w") as csv_file:
+                csv_file.write(",".join(cols) + "\n")
+        self._init_process_state()
+
+    def __getstate__(self):
+        return {"path": self.path, "cols": self.cols, "flush_rows": self.flush_rows, "flush_ms": self.flush_ms}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    def _init_process_state(self):
+        self._pid = None
+        self._file = None
+        self._buffer = []
+        self._last_flush = time.time()
+        self._locks = {}
+
+    def _lock(self):
+        return self._locks.setdefault(os.getpid(), threading.Lock())
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._buffer = []
+        self._file = open(self.path, "a")
+        Finalize(self, self.close, exitpriority=10)
+        threading.Thread(target=self._flush_periodically, args=(self._pid,), daemon=True).start()
+
+    def _flush_periodically(self, pid):
+        while self._pid == pid and self._file is not None:
+            time.sleep(self.flush_ms / 1000)
+            with self._lock():
+                if (time.time() - self._last_flush) * 1000 >= self.flush_ms:
+                    self._flush()
+
+    def _flush(self):
+        if self._buffer and self._file is not None:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            self._buffer = []
+        self._last_flush = time.time()
 
     def append(self, row):
         assert len(row) == len(self.cols)
-        with open(self.path, "a+") as csv_file:
-            csv_file.write(",".join(stringify_list(row)) + "\n")
+        with self._lock():
+            self._ensure_open()
+            self._buffer.append(",".join(stringify_list(row)) + "\n")
+            if len(self._buffer) >= self.flush_rows or (time.time() - self._last_flush) * 1000 >= self.flush_ms:
+                self._flush()
 
     def append_all(self, rows):
-        with open(self.path, "a+") as csv_file:
-            csv_file.write('\n'.join([",".join(stringify_list(row)) for row in rows]) + "\n")
+        with self._lock():
+            self._ensure_open()
+            self._buffer.extend(",".join(stringify_list(row)) + "\n" for row in rows)
+            self._flush()
+
+    def flush(self):
+        with self._lock():
+            self._flush()
+
+    def close(self):
+        with self._lock():
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
 
 def csv_reader(path, ntuple):
+    """read csv rows into ntuple. rows written before trailing fields were added are padded with ''"""
     with open(path) as f:
         rows = f.read().splitlines()[1:]
 
-    return [ntuple(*row.split(',')) for row in rows]
+    field_count = len(ntuple._fields)
+    padded = [''] * field_count
+    return [ntuple(*(values + padded[len(values):])) for values in (row.split(',') for row in rows)]
 
 
 def setup_logging():
+    level = getattr(logging, env("LOG_LEVEL", "INFO").upper())
     root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
+    root.setLevel(level)
     ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.INFO)
+    ch.setLevel(level)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
     root.addHandler(ch)
@@ -99,10 +177,26 @@ def setup_logging():
 setup_logging()
 
 
+def exit_on_signal(signum, frame):
+    """turn SIGTERM (e.g. Process.terminate) into a normal exit, so buffered csv rows get flushed"""
+    sys.exit(128 + signum)
+
+
+def install_exit_on_signal():
+    """have SIGTERM exit this process (and the ones it forks from then on) through exit_on_signal. installed by the
+    scripts and processes that write csv results, not on import"""
+    signal.signal(signal.SIGTERM, exit_on_signal)
+
+
 def log(m):
     logging.info(m)
 
 
+def debug(m, *args):
+    """args are only formatted into m (%-style) when debug logging is enabled"""
+    logging.debug(m, *args)
+
+
 def ether_to_wei(eth):
     return to_wei(eth, "ether")
 
@@ -122,6 +216,21 @@ def stringify_list(l):
 BlockStats = namedtuple('BlockStats', 'tx_count avg_gas_price median_gas_price q5_gas_price q95_gas_price')
 
 
+def compute_block_stats(txs):
+    """gas weighted gas price stats (gwei) of full tx objects"""
+    if len(txs) == 0:
+        return BlockStats(0, 0, 0, 0, 0)
+    gas_prices = np.fromiter((tx.gasPrice for tx in txs), dtype=np.float64, count=len(txs)) / 1e9
+    gas_usages = np.fromiter((tx.gas for tx in txs), dtype=np.float64, count=len(txs))
+    avg_gas_price = np.dot(gas_prices, gas_usages) / gas_usages.sum()
+    median_gas_price, q5_gas_price, q95_gas_price = weighted_quantile(gas_prices, [0.5, 0.05, 0.95], gas_usages)
+    return BlockStats(tx_count=len(txs),
+                      avg_gas_price=avg_gas_price,
+                      median_gas_price=median_gas_price,
+                      q5_gas_price=q5_gas_price,
+                      q95_gas_price=q95_gas_price)
+
+
 def weighted_quantile(values, quantiles, sample_weight):
     """ Very close to numpy.percentile, but supports weights.
     NOTE: quantiles should be in [0, 1]!
@@ -149,19 +258,19 @@ AccountResult = namedtuple("AccountResult", "private_key address")
 
 
 class AccountWrapper:
-    """Wrap around account and nonce. nonce is tracked in memory after initialization."""
+    """Wrap around account and nonce. nonce is tracked in memory after initialization. the address (an elliptic curve
+    multiplication) is only computed when used, unless it is given, e.g. from an accounts csv"""
 
-    def __init__(self, private_key, nonce):
-        self.w3account, = Account.privateKeyToAccount(private_key),
+    def __init__(self, private_key, nonce, address=None):
+        self.private_key = private_key if isinstance(private_key, str) else to_hex(private_key)
         self.nonce = nonce
+        self._address = address
 
     @property
     def address(self):
-        return self.w3account.address
-
-    @property
-    def private_key(self):
-        return to_hex(self.w3account.privateKey)
+        if self._address is None:
+            self._address = Account.privateKeyToAccount(self.private_key).address
+        return self._address
 
     def get_use_nonce(self):
         self.nonce += 1
@@ -171,47 +280,123 @@ class AccountWrapper:
         return AccountResult(private_key=self.private_key, address=self.address)
 
 
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+HARDENED = 0x80000000
+ACCOUNT_PATH = (44, 60, 0, 0)
+
+
+def _child_key(key, chain_code, index):
+    """bip32 hardened child (private key, chain code) of index"""
+    digest = hmac.new(chain_code, b"\0" + key + (index | HARDENED).to_bytes(4, "big"), hashlib.sha512).digest()
+    child = (int.from_bytes(digest[:32], "big") + int.from_bytes(key, "big")) % SECP256K1_ORDER
+    return child.to_bytes(32, "big"), digest[32:]
+
+
+def account_root(seed):
+    """bip32 key and chain code of m/44'/60'/0'/0' of seed"""
+    digest = hmac.new(b"Bitcoin seed", seed, hashlib.sha512).digest()
+    key, chain_code = digest[:32], digest[32:]
+    for index in ACCOUNT_PATH:
+        key, chain_code = _child_key(key, chain_code, index)
+    return key, chain_code
+
+
+def derive_key(root, index):
+    """private key of account index below root: m/44'/60'/0'/0'/index'. hardened derivation only takes a hmac, so keys
+    are cheap; their addresses are not"""
+    return _child_key(*root, index)[0]
+
+
 class AccountCreator:
-    def __init__(self):
-        self.seed = os.urandom(32)
+    """deterministic accounts of seed (random by default), in index order"""
+
+    def __init__(self, seed=None):
+        self.seed = seed or os.urandom(32)
+        self.root = account_root(self.seed)
         self.count = 0
 
     def next(self):
         self.count += 1
-        extra_key_bytes = text_if_str(to_bytes, str(self.count))
-        return AccountWrapper(keccak(self.seed + extra_key_bytes), 0)
+        return AccountWrapper(derive_key(self.root, self.count - 1), 0)
+
+
+# nodes only accept a replacement of a pending tx at a 10%+ higher gas price
+REPLACEMENT_GAS_BUMP = 1.1
+GAS_BUMP_WEI = 200000000
+TX_WAIT_TIMEOUT = env_float("TX_WAIT_TIMEOUT", 0)
 
 
 class Connection:
-    def __init__(self, chain_id, rpc_provider, erc20_address, erc20_abi):
+    """web3 wrapper. with a NonceRecovery, every sent tx is tracked by it"""
+
+    def __init__(self, chain_id, rpc_provider, erc20_address, erc20_abi, batch_size=100, recovery=None):
         self.chain_id = chain_id
+        self.recovery = recovery
         self.w3 = Web3(rpc_provider)
+        self.batch = BatchRpc(rpc_provider)
+        self.batch_size = batch_size
         self.w3.eth.enable_unaudited_features()
         self.contract = self.w3.eth.contract(address=erc20_address, abi=erc20_abi)
 
-    def get_account(self, private_key):
-        w3acc = Account.privateKeyToAccount(private_key)
-        return AccountWrapper(private_key, self.get_transaction_count(w3acc.address))
+    def get_account(self, private_key, address=None):
+        account = AccountWrapper(private_key, 0, address)
+        # pending, so that txs still in the pool (e.g. of an interrupted run) are not replaced
+        account.nonce = self.get_transaction_count(account.address, "pending")
+        return account
 
-    def sign_send_tx(self, from_account, tx_dict):
-        tx_dict["nonce"] = from_account.nonce
-        signed_tx = self.w3.eth.account.signTransaction(tx_dict, from_account.private_key)
+    def sign_send_tx(self, from_account, tx_dict, nonce=None):
+        """sign and send tx_dict. nonce is taken from (and advanced on) from_account, unless explicitly given"""
+        tx_dict["nonce"] = from_account.nonce if nonce is None else nonce
+        signed_tx = self._sign(tx_dict, from_account)
         try:
             try:
-                tx_hash = to_hex(self.w3.eth.sendRawTransaction(signed_tx.rawTransaction))
+                tx_hash = self._send_raw(signed_tx.rawTransaction)
             except ValueError as e:
-                log(f"tx failed. trying with 0.2 more gwei({e})")
-                tx_dict["gasPrice"] += 200000000
-                signed_tx = self.w3.eth.account.signTransaction(tx_dict, from_account.private_key)
-                tx_hash = to_hex(self.w3.eth.sendRawTransaction(signed_tx.rawTransaction))
-            from_account.nonce += 1
-            return tx_hash
+                # e.g. replacing a tx that only seemed lost, which takes a 10%+ higher gas price
+                gas_price = max(int(tx_dict["gasPrice"] * REPLACEMENT_GAS_BUMP), tx_dict["gasPrice"] + GAS_BUMP_WEI)
+                debug("tx failed. trying with gas price %s (%s)", gas_price, e)
+                metrics.GAS_BUMP_RETRIES.inc()
+                tx_dict["gasPrice"] = gas_price
+                signed_tx = self._sign(tx_dict, from_account)
+                tx_hash = self._send_raw(signed_tx.rawTransaction)
         except Timeout as e:
-            log(f"ipc timeout ({e}). ignoring.")
+            # the tx may or may not have reached the node. the nonce is used up either way, and a nonce recovery
+            # rebroadcasts it if it did not
+            debug("ipc timeout (%s). ignoring.", e)
+            metrics.TIMEOUTS.inc()
+            tx_hash = to_hex(signed_tx.hash)
+        if nonce is None:
             from_account.nonce += 1
-            return to_hex(signed_tx.hash)
+        if self.recovery:
+            self.recovery.track(from_account, tx_dict["nonce"], signed_tx.rawTransaction, tx_hash, tx_dict["gasPrice"])
+        return tx_hash
+
+    def _sign(self, tx_dict, from_account):
+        start = time.perf_counter()
+        signed_tx = self.w3.eth.account.signTransaction(tx_dict, from_account.private_key)
+        metrics.SIGN_SECONDS.observe(time.perf_counter() - start)
+        return signed_tx
+
+    def _send_raw(self, raw_tx):
+        start = time.perf_counter()
+        try:
+            return to_hex(self.w3.eth.sendRawTransaction(raw_tx))
+        finally:
+            metrics.SEND_SECONDS.observe(time.perf_counter() - start)
+
+    def send_raw(self, raw_tx, tx_hash, from_account=None, nonce=None, gas_price=None):
+        """send an already signed tx. tx_hash is returned as is on ipc timeouts. the tx is tracked by the nonce
+        recovery if its sender, nonce and gas price are given"""
+        try:
+            tx_hash = self._send_raw(raw_tx)
+        except Timeout as e:
+            debug("ipc timeout (%s). ignoring.", e)
+            metrics.TIMEOUTS.inc()
+        if self.recovery and from_account:
+            self.recovery.track(from_account, nonce, raw_tx, tx_hash, gas_price)
+        return tx_hash
 
-    def send_ether(self, from_account, to_address, val, gas_price, gas_limit):
+    def send_ether(self, from_account, to_address, val, gas_price, gas_limit, nonce=None):
         tx = {
             "to": to_address,
             "gas": gas_limit,
@@ -219,9 +404,9 @@ class Connection:
             "value": int(val),
             "chainId": self.chain_id,
         }
-        return self.sign_send_tx(from_account, tx)
+        return self.sign_send_tx(from_account, tx, nonce)
 
-    def send_tokens(self, from_account, to_address, val, gas_price, gas_limit):
+    def send_tokens(self, from_account, to_address, val, gas_price, gas_limit, nonce=None):
         tx = {
             "gas": gas_limit,
             "gasPrice": int(gas_price),
@@ -229,40 +414,53 @@ class Connection:
         }
         tx = self.contract.functions.transfer(to_address, val).buildTransaction(tx)
         try:
-            return self.sign_send_tx(from_account, tx)
+            return self.sign_send_tx(from_account, tx, nonce)
         except ValueError as e:
             new_gas_price = self.get_balance(from_account.address) / gas_limit
             if 0 < new_gas_price < gas_price:
-                log(f"failed. trying lower gas price {new_gas_price} ({e})")
+                debug("failed. trying lower gas price %s (%s)", new_gas_price, e)
+                metrics.LOWER_GAS_PRICE_RETRIES.inc()
                 tx["gasPrice"] = int(new_gas_price)
-                return self.sign_send_tx(from_account, tx)
+                return self.sign_send_tx(from_account, tx, nonce)
             raise e
 
     def wait_for_tx(self, tx_hash):
+        self.wait_for_txs([tx_hash])
+
+    def wait_for_txs(self, tx_hashes, interval=1, timeout=TX_WAIT_TIMEOUT):
+        """poll receipts of all pending tx hashes, in batches, until every one of them is mined, or for at most
+        timeout seconds (0: no limit). returns the hashes still pending"""
+        pending = list(tx_hashes)
+        deadline = time.time() + timeout if timeout else None
         while True:
-            tx = self.w3.eth.getTransactionReceipt(tx_hash)
-            if tx and tx.blockNumber:
-                return
-            time.sleep(1)
+            receipts = self.get_transaction_receipts(pending)
+            pending = [tx_hash for tx_hash, receipt in zip(pending, receipts) if not (receipt and receipt.blockNumber)]
+            log(f"{len(tx_hashes) - len(pending)}/{len(tx_hashes)} txs mined")
+            if len(pending) == 0:
+                return pending
+            if deadline and time.time() > deadline:
+                log(f"giving up on {len(pending)} txs after {timeout} seconds")
+                return pending
+            time.sleep(interval)
 
     def contract(self, address, abi):
         return self.w3.eth.contract(address=address, abi=abi)
 
     @ignore_timeouts
-    def get_block(self, n):
-        return self.w3.eth.getBlock(n)
+    def get_block(self, n, full_transactions=False):
+        return self.w3.eth.getBlock(n, full_transactions)
 
     @ignore_timeouts
-    def get_block_wait(self, n, interval=1):
+    def get_block_wait(self, n, interval=1, full_transactions=False):
         while True:
-            block = self.get_block(n)
+            block = self.get_block(n, full_transactions)
             if block and block.number:
                 return block
             time.sleep(interval)
 
     @ignore_timeouts
-    def get_latest_block(self):
-        return self.w3.eth.getBlock("latest")
+    def get_latest_block(self, full_transactions=False):
+        return self.w3.eth.getBlock("latest", full_transactions)
 
     @ignore_timeouts
     def get_transaction(self, tx_hash):
@@ -273,75 +471,56 @@ class Connection:
         return self.w3.eth.getTransactionReceipt(tx_hash)
 
     @ignore_timeouts
-    def get_transaction_count(self, address):
-        return self.w3.eth.getTransactionCount(address)
+    def get_transaction_count(self, address, block_identifier="latest"):
+        return self.w3.eth.getTransactionCount(address, block_identifier)
 
     @ignore_timeouts
     def get_balance(self, address):
         return self.w3.eth.getBalance(address)
 
     @ignore_timeouts
-    def get_block_stats(self, block):
-        txs = [self.get_transaction(tx_hash) for tx_hash in block.transactions]
-        if len(txs) == 0:
-            return BlockStats(0, 0, 0, 0, 0)
-        gas_prices = [wei_to_gwei(tx.gasPrice) for tx in txs]
-        gas_usages = [tx.gas for tx in txs]
-        avg_gas_price = sum([gas_price * gas_used for gas_price, gas_used in zip(gas_prices, gas_usages)]) / sum(
-            gas_usages)
-        median_gas_price, q5_gas_price, q95_gas_price = weighted_quantile(gas_prices, [0.5, 0.05, 0.95], gas_usages)
-        return BlockStats(tx_count=len(block.transactions),
-                          avg_gas_price=avg_gas_price,
-                          median_gas_price=median_gas_price,
-                          q5_gas_price=q5_gas_price,
-                          q95_gas_price=q95_gas_price)
-
-
-def get_gas_prices(tiers):
-    r = requests.get('https://ethgasstation.info/json/ethgasAPI.json')
-    d = r.json()
-    return {tier: int(d[tier] * math.pow(10, 8)) for tier in tiers}
-
+    def _batch_request(self, method, params_list):
+        return self.batch.request(method, params_list)
 
-def get_gas_price(tier):
-    return get_gas_prices([tier])[tier]
+    def batch_request(self, method, params_list):
+        """one json-rpc call per params entry, sent in batches of batch_size"""
+        results = []
+        for i in range(0, len(params_list), self.batch_size):
+            results.extend(self._batch_request(method, params_list[i:i + self.batch_size]))
+        return results
 
+    def get_transactions(self, tx_hashes):
+        return self.batch_request("eth_getTransactionByHash", [[tx_hash] for tx_hash in tx_hashes])
 
-def get_gas_price_low():
-    return get_gas_price("safeLow")
+    def get_transaction_receipts(self, tx_hashes):
+        return self.batch_request("eth_getTransactionReceipt", [[tx_hash] for tx_hash in tx_hashes])
 
+    def get_transaction_counts(self, addresses, block_identifier="pending"):
+        return self.batch_request("eth_getTransactionCount", [[address, block_identifier] for address in addresses])
 
-def monitor_gas_price(gas_tier, shared_gas_price, interval):
-    log("starting gas updates")
-    while True:
-        try:
-            new_gas_price = get_gas_price(gas_tier)
-            if shared_gas_price.value != new_gas_price:
-                log(f"gas price change: {shared_gas_price.value} -> {new_gas_price}")
-                shared_gas_price.value = new_gas_price
-            else:
-                log(f"gas price unchanged: {shared_gas_price.value}")
-        except ValueError as e:
-            log(f"exception fetching gas price : {e}")
-        time.sleep(interval)
-
+    def get_balances(self, addresses, block_identifier="latest"):
+        return self.batch_request("eth_getBalance", [[address, block_identifier] for address in addresses])
 
-class GasMonitorProcess:
-    def __init__(self, gas_tier, interval):
-        self._shared_gas_price = Value('d', float(get_gas_price(gas_tier)))
-        self._process = Process(target=monitor_gas_price, args=(gas_tier, self._shared_gas_price, interval))
+    def get_token_balances(self, addresses, block_identifier="latest"):
+        """erc20 token balances of addresses, as batched eth_call of balanceOf"""
+        calls = [{"to": self.contract.address, "data": self.contract.encodeABI(fn_name="balanceOf", args=[address])}
+                 for address in addresses]
+        results = self.batch_request("eth_call", [[call, block_identifier] for call in calls])
+        return [int(result, 16) if result and result != "0x" else 0 for result in results]
 
-    def start(self):
-        self._process.start()
+    def get_blocks(self, block_numbers, full_transactions=False):
+        return self.batch_request("eth_getBlockByNumber", [[hex(n), full_transactions] for n in block_numbers])
 
-    def stop(self):
-        self._process.terminate()
-
-    def get_latest_gas_price(self):
-        return self._shared_gas_price.value
+    @ignore_timeouts
+    def get_block_stats(self, block):
+        """stats for a block fetched with either tx hashes (txs are then fetched in batches) or full txs"""
+        txs = block.transactions
+        if len(txs) > 0 and isinstance(txs[0], (bytes, str)):
+            txs = self.get_transactions([to_hex(tx_hash) for tx_hash in txs])
+        return compute_block_stats(txs)
 
 
-def get_env_connection():
+def get_env_connection(recovery=None):
     chain_id = env_int('CHAIN_ID')
     try:
         rpc_provider = IPCProvider(env("IPC_PROVIDER"), timeout=2)
@@ -350,19 +529,21 @@ def get_env_connection():
     with open(env('ERC20_ABI_PATH'), 'r') as myfile:
         erc20_abi = myfile.read().replace('\n', '')
     erc20_address = env('ERC20_ADDRESS')
-    return Connection(chain_id=chain_id, rpc_provider=rpc_provider, erc20_abi=erc20_abi, erc20_address=erc20_address)
+    return Connection(chain_id=chain_id, rpc_provider=rpc_provider, erc20_abi=erc20_abi, erc20_address=erc20_address,
+                      batch_size=env_int('RPC_BATCH_SIZE', 100), recovery=recovery)
 
 
 def get_env_funder(conn):
     return conn.get_account(env('FUNDER_PK'))
 
 
-TxPlannedResult = namedtuple("TxPlannedResult", "frm to")
+TxPlannedResult = namedtuple("TxPlannedResult", "frm to offset")
 
 LoadConfig = namedtuple("LoadConfig",
                         "test_duration account_count tx_per_sec gas_tier funding_gas_tier funding_tx_per_sec "
                         "funding_max_gas_price prefund_multiplier gas_update_interval block_update_interval initial_"
-                        "token_transfer_gas_limit ether_transfer_gas_limit token_transfer_gas_limit")
+                        "token_transfer_gas_limit ether_transfer_gas_limit token_transfer_gas_limit max_in_flight "
+                        "presign_gas_prices presign_processes funding_fan_out load_shards")
 
 
 def get_env_config():
@@ -378,4 +559,10 @@ def get_env_config():
                       block_update_interval=env_int("BLOCK_UPDATE_INTERVAL"),
                       initial_token_transfer_gas_limit=env_int("INITIAL_TOKEN_TRANSFER_GAS_LIMIT"),
                       ether_transfer_gas_limit=env_int("ETHER_TRANSFER_GAS_LIMIT"),
-                      token_transfer_gas_limit=env_int("TOKEN_TRANSFER_GAS_LIMIT"))
+                      token_transfer_gas_limit=env_int("TOKEN_TRANSFER_GAS_LIMIT"),
+                      max_in_flight=env_int("MAX_IN_FLIGHT", 16),
+                      presign_gas_prices=[to_wei(gwei, "gwei") for gwei in env("PRESIGN_GAS_PRICES", "").split(",")
+                                          if gwei],
+                      presign_processes=env_int("PRESIGN_PROCESSES", os.cpu_count()),
+                      funding_fan_out=env_int("FUNDING_FAN_OUT", 0),
+                      load_shards=env_int("LOAD_SHARDS", 1))
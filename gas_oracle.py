@@ -0,0 +1,197 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from multiprocessing import Array, Lock
+
+import numpy as np
+import requests
+from eth_utils import to_wei
+
+from common import log, env, env_int, env_float, compute_block_stats, get_env_connection
+
+GAS_ORACLE = env("GAS_ORACLE", "http")
+GAS_ORACLE_PRICES = env("GAS_ORACLE_PRICES", "")
+GAS_ORACLE_BLOCKS = env_int("GAS_ORACLE_BLOCKS", 20)
+GAS_ORACLE_STAT = env("GAS_ORACLE_STAT", "")
+GAS_ORACLE_MAX_AGE = env_float("GAS_ORACLE_MAX_AGE", 0)
+
+# block stats percentile standing in for each ethgasstation tier
+TIER_STATS = {"safeLow": "q5_gas_price", "average": "median_gas_price", "fast": "q95_gas_price",
+              "fastest": "q95_gas_price"}
+FIRST_PRICE_WAIT = 0.05
+
+
+def get_gas_prices(tiers):
+    r = requests.get('https://ethgasstation.info/json/ethgasAPI.json')
+    d = r.json()
+    return {tier: int(d[tier] * math.pow(10, 8)) for tier in tiers}
+
+
+def get_gas_price(tier):
+    return get_gas_prices([tier])[tier]
+
+
+class GasOracle(ABC):
+    """Latest gas price (wei) from a backend (fetch), cached in shared memory.
+
+    start() refreshes the cache every interval seconds from a background thread, so readers never wait on the
+    backend. the cache is shared with forked processes (e.g. load shards), so one oracle serves every consumer.
+    a reader only blocks for the first price (for at most max_age), and when the cache is older than max_age (the
+    refresher fell behind or failed), in which case it refreshes the cache itself, falling back to the cached price
+    if that fails too."""
+
+    def __init__(self, interval, max_age=None):
+        self.interval = interval
+        self.max_age = max_age or 3 * interval
+        self._shared = Array('d', 2)
+        self._refresh_lock = Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @abstractmethod
+    def fetch(self):
+        """latest gas price (wei) from the backend"""
+
+    def refresh(self):
+        with self._refresh_lock:
+            gas_price = float(self.fetch())
+            previous = self._shared[0]
+            self._shared[:] = [gas_price, time.time()]
+        if gas_price != previous:
+            log(f"gas price change: {previous} -> {gas_price}")
+        return gas_price
+
+    def _run(self):
+        log("starting gas updates")
+        while True:
+            try:
+                self.refresh()
+            except (ValueError, OSError) as e:
+                log(f"exception fetching gas price : {e}")
+            if self._stopped.wait(self.interval):
+                return
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_latest_gas_price(self):
+        gas_price, fetched_at = self._shared[:]
+        deadline = time.time() + self.max_age
+        while fetched_at == 0 and self._thread is not None:
+            if time.time() > deadline:
+                raise TimeoutError(f"no gas price after {self.max_age} seconds, the gas oracle backend is failing")
+            time.sleep(FIRST_PRICE_WAIT)
+            gas_price, fetched_at = self._shared[:]
+        if time.time() - fetched_at > self.max_age:
+            try:
+                return self.refresh()
+            except (ValueError, OSError) as e:
+                if fetched_at == 0:
+                    raise
+                log(f"exception refreshing stale gas price ({e}), using the cached one")
+        return gas_price
+
+
+class HttpGasOracle(GasOracle):
+    """ethgasstation price of tier"""
+
+    def __init__(self, tier, interval, max_age=None):
+        super().__init__(interval, max_age)
+        self.tier = tier
+
+    def fetch(self):
+        return get_gas_price(self.tier)
+
+
+class ScriptedGasOracle(GasOracle):
+    """offline prices: a list of (seconds since start, wei), each applying from its time on. a single entry is a fixed
+    price"""
+
+    def __init__(self, script, interval, max_age=None):
+        super().__init__(interval, max_age)
+        self.script = sorted(script)
+        self.start_time = time.time()
+
+    def start(self):
+        self.start_time = time.time()
+        return super().start()
+
+    def fetch(self):
+        elapsed = time.time() - self.start_time
+        current = self.script[0][1]
+        for at, gas_price in self.script:
+            if at <= elapsed:
+                current = gas_price
+        return current
+
+
+def parse_script(prices):
+    """"gwei" or "seconds:gwei,seconds:gwei,..." -> [(seconds, wei)]"""
+    script = []
+    for entry in prices.split(","):
+        at, _, gwei = entry.rpartition(":")
+        script.append((float(at or 0), to_wei(gwei, "gwei")))
+    return script
+
+
+class RecentBlockStats:
+    """BlockStats of the latest count blocks, fetched incrementally (full txs, one batch per call). stands in for the
+    block monitor's stats where no monitor runs"""
+
+    def __init__(self, conn, count):
+        self.conn = conn
+        self.count = count
+        self.stats = deque(maxlen=count)
+        self.next_block_number = None
+
+    def __call__(self):
+        latest_block_number = self.conn.get_latest_block().number
+        first = max(latest_block_number - self.count + 1, 0)
+        if self.next_block_number is not None:
+            first = max(first, self.next_block_number)
+        for block in self.conn.get_blocks(range(first, latest_block_number + 1), full_transactions=True):
+            self.stats.append(compute_block_stats(block.transactions))
+        self.next_block_number = latest_block_number + 1
+        return list(self.stats)
+
+
+class BlockStatsGasOracle(GasOracle):
+    """on-chain estimate: the median, over the last blocks, of a gas weighted percentile of each block's gas prices
+    (stat is a BlockStats field). recent_block_stats returns BlockStats of recent blocks, newest last"""
+
+    def __init__(self, recent_block_stats, stat, blocks, interval, max_age=None):
+        super().__init__(interval, max_age)
+        self.recent_block_stats = recent_block_stats
+        self.stat = stat
+        self.blocks = blocks
+
+    def fetch(self):
+        recent = self.recent_block_stats()[-self.blocks:]
+        gas_prices = [getattr(stats, self.stat) for stats in recent if stats.tx_count]
+        if not gas_prices:
+            raise ValueError("no recent blocks with txs")
+        return int(to_wei(np.median(gas_prices), "gwei"))
+
+
+def get_env_gas_oracle(tier, interval, block_monitor=None):
+    """the GAS_ORACLE backend (http, fixed, scripted or blocks) for tier. the blocks estimator reads the block monitor's
+    stats when one is given, and fetches recent blocks itself otherwise"""
+    max_age = GAS_ORACLE_MAX_AGE or None
+    if GAS_ORACLE == "http":
+        return HttpGasOracle(tier, interval, max_age)
+    if GAS_ORACLE in ("fixed", "scripted"):
+        return ScriptedGasOracle(parse_script(GAS_ORACLE_PRICES), interval, max_age)
+    if GAS_ORACLE == "blocks":
+        recent_block_stats = block_monitor.get_recent_block_stats if block_monitor else \
+            RecentBlockStats(get_env_connection(), GAS_ORACLE_BLOCKS)
+        return BlockStatsGasOracle(recent_block_stats, GAS_ORACLE_STAT or TIER_STATS[tier], GAS_ORACLE_BLOCKS,
+                                   interval, max_age)
+    raise ValueError(f"unknown gas oracle {GAS_ORACLE}")
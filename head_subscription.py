@@ -0,0 +1,104 @@
+import asyncio
+import json
+import socket
+import time
+
+from common import env, log
+
+RECV_CHUNK = 65536
+
+
+def parse_hex_int(v):
+    return int(v, 16)
+
+
+class HeadSubscription:
+    """eth_subscribe("newHeads") over ipc (unix socket path) or websocket (ws:// uri).
+    iterating yields (block number, observed timestamp) per pushed head, observed as soon as the message arrives.
+    raises socket.timeout if no head arrives for timeout seconds."""
+
+    def __init__(self, ipc_path=None, ws_uri=None, timeout=60):
+        assert ipc_path or ws_uri, "an ipc path or websocket uri is required"
+        self.ipc_path = ipc_path
+        self.ws_uri = ws_uri
+        self.timeout = timeout
+        self.subscription_id = None
+        self._sock = None
+        self._ws = None
+        self._loop = None
+        self._buffer = ""
+        self._received_at = None
+        self._decoder = json.JSONDecoder()
+
+    def __enter__(self):
+        if self.ipc_path:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.ipc_path)
+        else:
+            import websockets
+            # websockets binds to the thread's current event loop
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._ws = self._loop.run_until_complete(websockets.connect(self.ws_uri))
+        self._send({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]})
+        response, _ = self._recv_message()
+        if "error" in response:
+            raise ValueError(response["error"])
+        self.subscription_id = response["result"]
+        log(f"subscribed to new heads ({self.ipc_path or self.ws_uri}): {self.subscription_id}")
+        return self
+
+    def __exit__(self, *exc):
+        if self._sock:
+            self._sock.close()
+        if self._ws:
+            self._loop.run_until_complete(self._ws.close())
+            self._loop.close()
+
+    def _send(self, message):
+        if self._sock:
+            self._sock.sendall(json.dumps(message).encode())
+        else:
+            self._loop.run_until_complete(self._ws.send(json.dumps(message)))
+
+    def _recv_message(self):
+        """next json message and the time its last chunk arrived"""
+        if self._ws:
+            from websockets.exceptions import ConnectionClosed
+            try:
+                raw = self._loop.run_until_complete(asyncio.wait_for(self._ws.recv(), self.timeout))
+            except asyncio.TimeoutError:
+                raise socket.timeout("no head received")
+            except ConnectionClosed as e:
+                raise ConnectionError(e)
+            return json.loads(raw), time.time()
+        while True:
+            self._buffer = self._buffer.lstrip()
+            if self._buffer:
+                try:
+                    message, end = self._decoder.raw_decode(self._buffer)
+                    self._buffer = self._buffer[end:]
+                    return message, self._received_at
+                except ValueError:
+                    pass
+            chunk = self._sock.recv(RECV_CHUNK)
+            self._received_at = time.time()
+            if not chunk:
+                raise ConnectionError("head subscription closed by node")
+            self._buffer += chunk.decode()
+
+    def __iter__(self):
+        while True:
+            message, observed = self._recv_message()
+            params = message.get("params")
+            if message.get("method") == "eth_subscription" and params["subscription"] == self.subscription_id:
+                yield parse_hex_int(params["result"]["number"]), observed
+
+
+def get_env_head_subscription():
+    """subscription on IPC_PROVIDER, or WS_PROVIDER. None if neither is configured"""
+    ipc_path, ws_uri = env("IPC_PROVIDER", ""), env("WS_PROVIDER", "")
+    if ipc_path or ws_uri:
+        return HeadSubscription(ipc_path=ipc_path or None, ws_uri=ws_uri or None)
+    return None
@@ -0,0 +1,176 @@
+import bisect
+import math
+import threading
+from collections import namedtuple, deque
+
+from eth_utils import to_wei
+
+import metrics
+from common import env, env_int, log
+
+MIN_VALUE = 1e-3
+LATENCY_CONFIRMATIONS = env_int("LATENCY_CONFIRMATIONS", 12)
+LATENCY_GAS_BUCKETS = [to_wei(gwei, "gwei") for gwei in env("LATENCY_GAS_BUCKETS", "1,2,5,10,20,50,100").split(",")]
+
+LatencyResult = namedtuple("LatencyResult", "block_number block_timestamp pending included confirmed inclusion_p50 "
+                                            "inclusion_p90 inclusion_p99 confirmation_p50 confirmation_p90 "
+                                            "confirmation_p99")
+GasLatencyResult = namedtuple("GasLatencyResult", "block_number min_gas_price included inclusion_p50 inclusion_p99 "
+                                                  "confirmed confirmation_p50 confirmation_p99")
+
+INCLUSION_P50 = metrics.REGISTRY.gauge("inclusion_latency_p50_seconds", "median submit to inclusion latency")
+INCLUSION_P99 = metrics.REGISTRY.gauge("inclusion_latency_p99_seconds", "p99 submit to inclusion latency")
+CONFIRMATION_P50 = metrics.REGISTRY.gauge("confirmation_latency_p50_seconds",
+                                          "median submit to LATENCY_CONFIRMATIONS confirmations latency")
+CONFIRMATION_P99 = metrics.REGISTRY.gauge("confirmation_latency_p99_seconds",
+                                          "p99 submit to LATENCY_CONFIRMATIONS confirmations latency")
+PENDING_TXS = metrics.REGISTRY.gauge("pending_txs", "submitted txs not included yet")
+
+
+class LogHistogram:
+    """Mergeable quantile sketch: values are counted in log spaced buckets (bucket k holds (gamma^(k-1), gamma^k]), so
+    every quantile is within relative_error of an actual value, and memory only grows with the log of the value range
+    (~900 buckets from 1ms to 1 day at 1%). values below MIN_VALUE (incl. negative ones, from clock skew) count as 0."""
+
+    def __init__(self, relative_error=0.01):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        self.counts = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        if value < MIN_VALUE:
+            self.zeros += 1
+        else:
+            k = math.ceil(math.log(value) / self._log_gamma)
+            self.counts[k] = self.counts.get(k, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        assert self.gamma == other.gamma, "only sketches of the same relative error can be merged"
+        for k, count in other.counts.items():
+            self.counts[k] = self.counts.get(k, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for k in sorted(self.counts):
+            seen += self.counts[k]
+            if seen > rank:
+                return 2 * self.gamma ** k / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.counts) / (self.gamma + 1)
+
+
+def merge_all(sketches):
+    total = LogHistogram()
+    for sketch in sketches:
+        total.merge(sketch)
+    return total
+
+
+class LatencyAnalytics:
+    """Online inclusion and confirmation latency of a running test.
+
+    Fed with every submitted tx (submitted) and with every new block and the submitted txs it included (on_block), e.g.
+    by a ConfirmationTracker. Latency runs from submission to the miner timestamp of the inclusion block, and of the
+    block giving it `confirmations` confirmations (the clock collect_results uses for timestamp_n). One sketch pair is
+    kept per gas price bucket and merged for the totals. Memory is bounded by the pending txs plus `confirmations`
+    blocks of included ones. After each block a LatencyResult row, and a GasLatencyResult row per gas price bucket
+    with inclusions, are written, and the latency gauges are updated."""
+
+    def __init__(self, latency_writer=None, gas_latency_writer=None, confirmations=LATENCY_CONFIRMATIONS,
+                 gas_buckets=LATENCY_GAS_BUCKETS):
+        self.latency_writer = latency_writer
+        self.gas_latency_writer = gas_latency_writer
+        self.confirmations = confirmations
+        self.gas_buckets = [0] + sorted(gas_buckets)
+        self.inclusion = [LogHistogram() for _ in self.gas_buckets]
+        self.confirmation = [LogHistogram() for _ in self.gas_buckets]
+        self.pending = {}
+        self.awaiting_confirmation = deque()
+        self._lock = threading.Lock()
+
+    def submitted(self, tx_hash, sent_at, gas_price):
+        bucket = bisect.bisect_right(self.gas_buckets, gas_price) - 1
+        with self._lock:
+            self.pending[tx_hash.lower()] = (sent_at, bucket)
+
+    def replaced(self, tx_hash, replaced_by):
+        """latency of a replacement runs from the submission of the tx it replaced"""
+        with self._lock:
+            if tx_hash.lower() in self.pending:
+                self.pending[replaced_by.lower()] = self.pending.pop(tx_hash.lower())
+
+    def on_block(self, block_number, block_timestamp, tx_hashes):
+        with self._lock:
+            included = [self.pending.pop(tx_hash) for tx_hash in tx_hashes if tx_hash in self.pending]
+            for sent_at, bucket in included:
+                self.inclusion[bucket].add(block_timestamp - sent_at)
+            if included:
+                self.awaiting_confirmation.append((block_number, included))
+            while self.awaiting_confirmation and \
+                    self.awaiting_confirmation[0][0] + self.confirmations - 1 <= block_number:
+                for sent_at, bucket in self.awaiting_confirmation.popleft()[1]:
+                    self.confirmation[bucket].add(block_timestamp - sent_at)
+            result, gas_results = self._results(block_number, block_timestamp)
+        if self.latency_writer:
+            self.latency_writer.append(result)
+        if self.gas_latency_writer and gas_results:
+            self.gas_latency_writer.append_all(gas_results)
+        INCLUSION_P50.set(result.inclusion_p50)
+        INCLUSION_P99.set(result.inclusion_p99)
+        CONFIRMATION_P50.set(result.confirmation_p50)
+        CONFIRMATION_P99.set(result.confirmation_p99)
+        PENDING_TXS.set(result.pending)
+        return result
+
+    def on_late_block(self, block_number, block_timestamp, tx_hashes, confirmation_timestamp=None):
+        """count the txs of an already passed block that were only found in it later (e.g. added after it was
+        scanned). confirmation_timestamp is that of the block giving it `confirmations` confirmations, if mined yet.
+        blocks must be handed to on_late_block before the next on_block call, and no row is written for them"""
+        with self._lock:
+            included = [self.pending.pop(tx_hash) for tx_hash in tx_hashes if tx_hash in self.pending]
+            for sent_at, bucket in included:
+                self.inclusion[bucket].add(block_timestamp - sent_at)
+                if confirmation_timestamp is not None:
+                    self.confirmation[bucket].add(confirmation_timestamp - sent_at)
+            if included and confirmation_timestamp is None:
+                # keep awaiting_confirmation in block order
+                k = len(self.awaiting_confirmation)
+                while k and self.awaiting_confirmation[k - 1][0] > block_number:
+                    k -= 1
+                self.awaiting_confirmation.insert(k, (block_number, included))
+
+    def _results(self, block_number, block_timestamp):
+        inclusion = merge_all(self.inclusion)
+        confirmation = merge_all(self.confirmation)
+        result = LatencyResult(block_number=block_number, block_timestamp=block_timestamp, pending=len(self.pending),
+                               included=inclusion.count, confirmed=confirmation.count,
+                               inclusion_p50=inclusion.quantile(0.5), inclusion_p90=inclusion.quantile(0.9),
+                               inclusion_p99=inclusion.quantile(0.99), confirmation_p50=confirmation.quantile(0.5),
+                               confirmation_p90=confirmation.quantile(0.9),
+                               confirmation_p99=confirmation.quantile(0.99))
+        gas_results = [GasLatencyResult(block_number=block_number, min_gas_price=min_gas_price,
+                                        included=inclusion.count, inclusion_p50=inclusion.quantile(0.5),
+                                        inclusion_p99=inclusion.quantile(0.99), confirmed=confirmation.count,
+                                        confirmation_p50=confirmation.quantile(0.5),
+                                        confirmation_p99=confirmation.quantile(0.99))
+                       for min_gas_price, inclusion, confirmation in zip(self.gas_buckets, self.inclusion,
+                                                                         self.confirmation)
+                       if inclusion.count]
+        return result, gas_results
+
+
+def log_latency(result):
+    log(f"latency (sec) after block {result.block_number}: {result.pending} pending, inclusion p50/p90/p99 "
+        f"{result.inclusion_p50:.1f}/{result.inclusion_p90:.1f}/{result.inclusion_p99:.1f} ({result.included} txs), "
+        f"confirmation p50/p90/p99 {result.confirmation_p50:.1f}/{result.confirmation_p90:.1f}/"
+        f"{result.confirmation_p99:.1f} ({result.confirmed} txs)")
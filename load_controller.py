@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.6
+import sys
+import time
+
+import numpy as np
+import requests
+
+from account_store import read_accounts
+from block_monitor import BlockResult, BlockMonitorProcess
+from columnar import read_rows
+from common import now_str, log, CSVWriter, get_env_connection, get_env_config, TxPlannedResult, get_arg, env_int, \
+    install_exit_on_signal
+from latency import LatencyAnalytics, LatencyResult, GasLatencyResult
+from load_test import TxResult, ShardTxResult, partition_by_sender, merge_shard_results, wait_for_completion
+from tx_tracker import ConfirmationTracker, log_progress, ReceiptResult
+
+START_DELAY = env_int("CONTROLLER_START_DELAY", 30)
+POLL_INTERVAL = 1
+
+
+def shard_payload(config, accounts, txs, slots, start_time):
+    """a shard's txs, by address, and its senders with their nonces. workers know nothing of the account ids"""
+    sender_ids = np.unique(accounts.ids(txs[slot].frm for slot in slots))
+    return {
+        "start_time": start_time,
+        "tx_per_sec": config.tx_per_sec,
+        "slots": slots,
+        "txs": [[accounts.address_of(txs[slot].frm), accounts.address_of(txs[slot].to), txs[slot].offset]
+                for slot in slots],
+        "accounts": [[accounts.private_key(i), int(accounts.nonces[i]), accounts.address(i)] for i in sender_ids],
+    }
+
+
+def gather_results(worker_urls, shard_writers, tracker):
+    """poll every worker for new result rows until all shards are done. returns all ShardTxResult rows"""
+    offsets = [0] * len(worker_urls)
+    done = [False] * len(worker_urls)
+    results = []
+    while not all(done):
+        time.sleep(POLL_INTERVAL)
+        for k, url in enumerate(worker_urls):
+            if done[k]:
+                continue
+            r = requests.get(f"{url}/results", params={"offset": offsets[k]})
+            r.raise_for_status()
+            reply = r.json()
+            rows = [ShardTxResult(*row) for row in reply["rows"]]
+            shard_writers[k].append_all(rows)
+            results.extend(rows)
+            for row in rows:
+                tracker.add_submitted(row.tx_hash, float(row.timestamp), float(row.gas_price))
+            offsets[k] += len(rows)
+            done[k] = reply["done"]
+        log(f"gathered {sum(offsets)} results")
+    return results
+
+
+def control(conn, config, accounts, planned_txs, worker_urls, tx_writer, block_writer, receipt_writer,
+            analytics=None):
+    """split the plan by sender across remote workers, start them all at the same time and gather their results"""
+    sender_ids = np.unique(accounts.ids(tx.frm for tx in planned_txs))
+    accounts.nonces[sender_ids] = conn.get_transaction_counts([accounts.address(i) for i in sender_ids])
+    shards = partition_by_sender(planned_txs, len(worker_urls))
+
+    block_monitor = BlockMonitorProcess(block_writer, config.block_update_interval, conn.get_latest_block().number)
+    block_monitor.start()
+    tracker = ConfirmationTracker(conn, conn.get_latest_block().number, on_progress=log_progress,
+                                  receipt_writer=receipt_writer, analytics=analytics)
+    tracker.start(config.block_update_interval)
+
+    start_time = time.time() + START_DELAY
+    for url, slots in zip(worker_urls, shards):
+        log(f"handing {len(slots)} txs to {url}")
+        r = requests.post(f"{url}/shard", json=shard_payload(config, accounts, planned_txs, slots, start_time))
+        r.raise_for_status()
+
+    shard_writers = [CSVWriter(f"{tx_writer.path}.shard{k}", ShardTxResult._fields) for k in range(len(worker_urls))]
+    tx_results = merge_shard_results(gather_results(worker_urls, shard_writers, tracker), tx_writer)
+
+    wait_for_completion(conn, config, tracker, tx_results)
+    log(f"killing block monitor")
+    block_monitor.stop()
+
+
+if __name__ == "__main__":
+    """./load_controller.py <accounts_csv> <planned_txs_csv> <worker_url> [<worker_url> ...]"""
+    install_exit_on_signal()
+    now = now_str()
+    env_connection = get_env_connection()
+    env_config = get_env_config()
+    control(env_connection, env_config, read_accounts(get_arg(0)), read_rows(get_arg(1), TxPlannedResult),
+            sys.argv[3:],
+            CSVWriter(f"results/txs.{now}.csv", TxResult._fields),
+            CSVWriter(f"results/blocks.{now}.csv", BlockResult._fields),
+            CSVWriter(f"results/receipts.{now}.csv", ReceiptResult._fields),
+            LatencyAnalytics(CSVWriter(f"results/latency.{now}.csv", LatencyResult._fields),
+                             CSVWriter(f"results/latency.gas.{now}.csv", GasLatencyResult._fields)))
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+from common import log, debug, get_env_connection
+
+LagStats = namedtuple("LagStats", "count mean p50 p95 p99 max")
+
+
+def lag_stats(lags):
+    """summarize how far (seconds) actual send times trailed the schedule"""
+    if len(lags) == 0:
+        return LagStats(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    lags = np.array(lags)
+    p50, p95, p99 = np.percentile(lags, [50, 95, 99])
+    return LagStats(count=len(lags), mean=lags.mean(), p50=p50, p95=p95, p99=p99, max=lags.max())
+
+
+def uniform_send_times(start_time, rate, slots):
+    """send time of every schedule slot, at a constant rate"""
+    interval = 1 / rate
+    return (start_time + slot * interval for slot in slots)
+
+
+def planned_send_times(start_time, offsets):
+    """send time of every tx at its planned offset (seconds from start)"""
+    return (start_time + float(offset) for offset in offsets)
+
+
+class LoadEngine:
+    """Open-loop submission engine.
+
+    Item i is released at send_times[i] no matter how long earlier requests take. Blocking rpc calls run on a thread
+    pool with at most max_in_flight outstanding requests; every pool thread holds its own connection since ipc
+    requests are serialized per provider.
+    send(conn, i, item, sent_at) is called on a pool thread and its return value is handed to on_result(i, result) (on
+    the loop thread). A failed send is tried again up to retries times. Sends that still fail are logged, yield None
+    and are listed (by item index) in failures, so the caller can act on them (e.g. on nonces they left unused).
+    """
+
+    def __init__(self, send, max_in_flight, on_result=None, connection_factory=get_env_connection, retries=0):
+        self.send = send
+        self.max_in_flight = max_in_flight
+        self.on_result = on_result
+        self.connection_factory = connection_factory
+        self.retries = retries
+        self.lags = []
+        self.failures = []
+        self._local = threading.local()
+
+    def _get_connection(self):
+        if not hasattr(self._local, "conn"):
+            self._local.conn = self.connection_factory()
+        return self._local.conn
+
+    def _submit(self, i, item, scheduled_time):
+        sent_at = time.time()
+        self.lags.append(sent_at - scheduled_time)
+        metrics.SCHEDULE_LAG.observe(sent_at - scheduled_time)
+        metrics.SUBMISSIONS.inc()
+        for _ in range(self.retries):
+            try:
+                return self.send(self._get_connection(), i, item, sent_at)
+            except Exception as e:
+                debug("submission %s failed, trying again (%s)", i, e)
+        return self.send(self._get_connection(), i, item, sent_at)
+
+    async def _run(self, items, send_times, executor):
+        loop = asyncio.get_event_loop()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        results = [None] * len(items)
+
+        async def submit(i, item, scheduled_time):
+            try:
+                results[i] = await loop.run_in_executor(executor, self._submit, i, item, scheduled_time)
+                if self.on_result:
+                    self.on_result(i, results[i])
+            except Exception as e:
+                metrics.SUBMISSION_FAILURES.inc()
+                log(f"submission {i} failed ({e})")
+                if results[i] is None:
+                    self.failures.append(i)
+            finally:
+                in_flight.release()
+
+        submissions = []
+        for i, (item, scheduled_time) in enumerate(zip(items, send_times)):
+            delay = scheduled_time - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await in_flight.acquire()
+            submissions.append(asyncio.ensure_future(submit(i, item, scheduled_time)))
+        await asyncio.gather(*submissions)
+        return results
+
+    def run(self, items, send_times):
+        """submit all items on schedule and return their results in item order"""
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            return loop.run_until_complete(self._run(items, send_times, executor))
+        finally:
+            executor.shutdown(wait=True)
+            loop.close()
@@ -1,45 +1,130 @@
 #!/usr/bin/env python3.6
-import random
+import math
 import time
+from collections import namedtuple
+from functools import partial
 
-from common import now_str, log, CSVWriter, wei_to_ether, get_env_connection, get_env_funder, AccountCreator, \
-    AccountResult, get_env_config, TxPlannedResult, GasMonitorProcess
-
-
-def fund_accounts(conn, funder, config, accounts, gas_monitor, pre_txs):
-    tx_count_per_acount = {account.address: 0 for account in accounts}
-    for pre_tx in pre_txs:
-        tx_count_per_acount[pre_tx.frm] += 1
+import numpy as np
 
-    load_gas_price = gas_monitor.get_latest_gas_price()
+from account_store import new_seed, write_seed, seed_path, read_accounts, AccountRegistry
+from columnar import read_rows
+from common import now_str, log, CSVWriter, wei_to_ether, get_env_connection, get_env_funder, AccountCreator, \
+    AccountResult, get_env_config, TxPlannedResult, get_arg, has_args, install_exit_on_signal
+from gas_oracle import get_env_gas_oracle
+from load_engine import LoadEngine, lag_stats
+from nonce_recovery import get_env_nonce_recovery
+from tx_tracker import ConfirmationTracker, log_progress
+from workload import plan_txs
+
+
+FundingNode = namedtuple("FundingNode", "account ether tokens children")
+
+
+def funding_tree(leaves, fan_out, account_creator, config):
+    """group leaf funding nodes under intermediate accounts, at most fan_out children per node. every intermediate
+    is funded with its subtree's ether and tokens, plus gas (at funding_max_gas_price) to fund its children."""
+    if len(leaves) <= fan_out:
+        return leaves
+    group_size = math.ceil(len(leaves) / fan_out)
+    nodes = []
+    for i in range(0, len(leaves), group_size):
+        children = funding_tree(leaves[i:i + group_size], fan_out, account_creator, config)
+        gas = len(children) * config.funding_max_gas_price * (config.ether_transfer_gas_limit +
+                                                              config.initial_token_transfer_gas_limit)
+        nodes.append(FundingNode(account=account_creator.next(),
+                                 ether=sum(child.ether for child in children) + gas,
+                                 tokens=sum(child.tokens for child in children),
+                                 children=children))
+    return nodes
+
+
+def fund_level(config, gas_oracle, tracker, senders, recovery=None):
+    """stream ether and token funding txs from every (sender, nodes) pair concurrently, at funding_tx_per_sec per
+    sender, without waiting on sends. funding tx hashes are handed to tracker, and the txs to recovery.
+    nothing is sent (nor a nonce used) for a 0 ether or 0 tokens amount."""
+    jobs = []
+    for sender, nodes in senders:
+        for j, node in enumerate(nodes):
+            ether_nonce = sender.get_use_nonce() if node.ether else None
+            token_nonce = sender.get_use_nonce() if node.tokens else None
+            jobs.append((j, sender, node, ether_nonce, token_nonce))
+    jobs.sort(key=lambda job: job[0])
+
+    def send(conn, i, job, sent_at):
+        _, sender, node, ether_nonce, token_nonce = job
+        funding_gas_price = min(gas_oracle.get_latest_gas_price(), config.funding_max_gas_price)
+        to_address = node.account.address
+        fund_ether_tx_hash, fund_tokens_tx_hash = None, None
+        if node.ether:
+            fund_ether_tx_hash = conn.send_ether(sender, to_address, node.ether, funding_gas_price,
+                                                 config.ether_transfer_gas_limit, ether_nonce)
+        if node.tokens:
+            fund_tokens_tx_hash = conn.send_tokens(sender, to_address, node.tokens, funding_gas_price,
+                                                   config.initial_token_transfer_gas_limit, token_nonce)
+        log(f"funding {to_address}, {fund_ether_tx_hash}, {fund_tokens_tx_hash} ({i}/{len(jobs)})")
+        return [tx_hash for tx_hash in (fund_ether_tx_hash, fund_tokens_tx_hash) if tx_hash]
+
+    engine = LoadEngine(send, config.max_in_flight, on_result=lambda i, tx_hashes: tracker.add(tx_hashes),
+                        connection_factory=partial(get_env_connection, recovery))
+    start_time = time.time()
+    engine.run(jobs, (start_time + job[0] / config.funding_tx_per_sec for job in jobs))
+    log(f"funding schedule lag (sec): {lag_stats(engine.lags)}")
+
+
+def funding_shortfalls(conn, leaves):
+    """leaves reduced to the ether and tokens their accounts still lack, from batched (pending) balance and token
+    balance lookups. leaves lacking nothing are dropped"""
+    addresses = [node.account.address for node in leaves]
+    balances = conn.get_balances(addresses, "pending")
+    token_balances = conn.get_token_balances(addresses, "pending")
+    shortfalls = [node._replace(ether=max(node.ether - balance, 0), tokens=max(node.tokens - tokens, 0))
+                  for node, balance, tokens in zip(leaves, balances, token_balances)]
+    return [node for node in shortfalls if node.ether or node.tokens]
+
+
+def fund_accounts(conn, funder, config, accounts, gas_oracle, pre_txs, funding_account_writer=None, resume=False):
+    """fund accounts with ether and tokens for their planned txs. with a funding fan out, the funder seeds
+    intermediate accounts (dumped to funding_account_writer) which fund the accounts below them level by level,
+    so funding time grows with the log of the account count.
+    with resume, accounts are only funded with what they lack, so an interrupted funding can be run again."""
+    tx_count_per_acount = np.bincount(accounts.ids(pre_tx.frm for pre_tx in pre_txs), minlength=len(accounts))
+
+    load_gas_price = gas_oracle.get_latest_gas_price()
     ether_per_tx = config.token_transfer_gas_limit * load_gas_price * config.prefund_multiplier
-    expected = (len(accounts) * config.funding_max_gas_price * config.ether_transfer_gas_limit) + \
-               (len(accounts) * config.funding_max_gas_price * config.initial_token_transfer_gas_limit) + \
-               ether_per_tx * len(pre_txs)
-    log(f"funding {len(accounts)} accounts with a total of ~{wei_to_ether(expected)} ether")
+    leaves = [FundingNode(account=account, ether=ether_per_tx * int(tx_count_per_acount[account.id]),
+                          tokens=int(tx_count_per_acount[account.id]), children=[]) for account in accounts]
+    if resume:
+        leaves = funding_shortfalls(conn, leaves)
+        log(f"{len(leaves)} of {len(accounts)} accounts lack funds")
+    roots = leaves
+    if config.funding_fan_out > 1:
+        roots = funding_tree(leaves, config.funding_fan_out, AccountCreator(), config)
+    expected = sum(node.ether for node in roots) + \
+               (len(roots) * config.funding_max_gas_price * config.ether_transfer_gas_limit) + \
+               (len(roots) * config.funding_max_gas_price * config.initial_token_transfer_gas_limit)
+    log(f"funding {len(leaves)} accounts with a total of ~{wei_to_ether(expected)} ether")
     input("press enter to continue...")
     start_balance = conn.get_balance(funder.address)
     log(f"current funder balance is {wei_to_ether(start_balance)}")
 
-    funding_txs = []
-    for i, account in enumerate(accounts):
-        funding_gas_price = min(gas_monitor.get_latest_gas_price(), config.funding_max_gas_price)
-        to_address = account.address
-        total_ether = config.token_transfer_gas_limit * load_gas_price * config.prefund_multiplier * \
-                      tx_count_per_acount[
-                          account.address]
-        fund_ether_tx_hash = conn.send_ether(funder, to_address, total_ether, funding_gas_price,
-                                             config.ether_transfer_gas_limit)
-        fund_tokens_tx_hash = conn.send_tokens(funder, to_address, tx_count_per_acount[account.address],
-                                               funding_gas_price, config.initial_token_transfer_gas_limit)
-        funding_txs.append(fund_ether_tx_hash)
-        funding_txs.append(fund_tokens_tx_hash)
-        log(f"funding {to_address}, {fund_ether_tx_hash}, {fund_tokens_tx_hash} ({i}/{len(accounts)})")
-        time.sleep(1 / config.funding_tx_per_sec)  # for sanity
-
-    for i, tx_hash in enumerate(funding_txs):
-        log(f"waiting for tx {tx_hash} to complete. ({i}/{len(funding_txs)})")
-        conn.wait_for_tx(tx_hash)
+    tracker = ConfirmationTracker(conn, conn.get_latest_block().number, on_progress=log_progress)
+    recovery = get_env_nonce_recovery(get_env_connection(), tracker.replace)
+    level, senders = 0, [(funder, roots)]
+    while len(senders) > 0:
+        nodes = [node for _, nodes in senders for node in nodes]
+        intermediates = [node.account for node in nodes if node.children]
+        if intermediates and funding_account_writer:
+            funding_account_writer.append_all(account.to_account_result() for account in intermediates)
+        log(f"funding level {level}: {len(nodes)} accounts from {len(senders)} senders")
+        tracker.start(config.block_update_interval)
+        if recovery:
+            recovery.start()
+        fund_level(config, gas_oracle, tracker, senders, recovery)
+        tracker.stop()
+        if recovery:
+            recovery.stop()
+        tracker.wait(config.block_update_interval, recovery)
+        level, senders = level + 1, [(node.account, node.children) for node in nodes if node.children]
 
     final_balance = conn.get_balance(funder.address)
     log(f"new funder balance : {wei_to_ether(final_balance)}")
@@ -48,53 +133,65 @@ def fund_accounts(conn, funder, config, accounts, gas_monitor, pre_txs):
 
 
 def prepare_txs(config, account_writer, tx_plan_writer):
-    # generate random accounts
+    # derive accounts of a new seed, stored next to the accounts csv
     log("generating accounts")
-    account_creator = AccountCreator()
-    accounts = [account_creator.next() for _ in range(config.account_count)]
+    seed = new_seed()
+    write_seed(seed_path(account_writer.path), seed, config.account_count)
+    accounts = AccountRegistry.from_seed(seed, config.account_count)
 
     # dump accounts
     log("dumping accounts to csv")
-    account_writer.append_all(account.to_account_result() for account in accounts)
+    account_writer.append_all(accounts.account_results())
 
-    # pre-compute (from,to) tx pairs
+    # pre-compute (from, to, offset) txs
     total_tx = config.test_duration * config.tx_per_sec
-    if config.account_count == config.tx_per_sec * config.test_duration:
+    one_per_sender = config.account_count == total_tx
+    if one_per_sender:
         log(f"generating one tx per account ({total_tx})")
-        frms = accounts[:]
-        planned_txs = [TxPlannedResult(frms.pop().address, random.choice(accounts).address) for _ in range(total_tx)]
-    else:
-        log(f"pre-computing {total_tx} transactions")
-        planned_txs = [TxPlannedResult(random.choice(accounts).address, random.choice(accounts).address) for _ in
-                       range(total_tx)]
+    planned_txs = plan_txs(len(accounts), total_tx, config.tx_per_sec, one_per_sender=one_per_sender)
 
     tx_plan_writer.append_all(planned_txs)
     return accounts, planned_txs
 
 
-def prepare(conn, funder, config, account_writer, tx_plan_writer):
+def prepare(conn, funder, config, account_writer, tx_plan_writer, funding_account_writer=None):
     accounts, planned_txs = prepare_txs(config, account_writer, tx_plan_writer)
 
-    # start monitoring gas
-    log("starting gas monitoring")
-
-    gas_monitor = GasMonitorProcess(config.gas_tier, config.gas_update_interval)
-    gas_monitor.start()
+    # start gas price updates
+    gas_oracle = get_env_gas_oracle(config.gas_tier, config.gas_update_interval)
+    gas_oracle.start()
 
     # funding
-    fund_accounts(conn, funder, config, accounts, gas_monitor, planned_txs)
+    fund_accounts(conn, funder, config, accounts, gas_oracle, planned_txs, funding_account_writer)
 
-    gas_monitor.stop()
+    gas_oracle.stop()
 
     return accounts, planned_txs
 
 
+def resume_funding(conn, funder, config, accounts, planned_txs, funding_account_writer=None):
+    """fund what existing accounts still lack for planned_txs"""
+    gas_oracle = get_env_gas_oracle(config.gas_tier, config.gas_update_interval)
+    gas_oracle.start()
+    fund_accounts(conn, funder, config, accounts, gas_oracle, planned_txs, funding_account_writer, resume=True)
+    gas_oracle.stop()
+
+
 if __name__ == "__main__":
+    """./load_prepare.py [<accounts_csv> <planned_txs_csv>]: prepare a new load, or resume the funding of a prepared
+    one"""
+    install_exit_on_signal()
     now = now_str()
-    tx_plan_writer = CSVWriter(f"results/txs.planned.{now}.csv", TxPlannedResult._fields)
-    account_writer = CSVWriter(f"results/accounts.{now}.csv", AccountResult._fields)
+    funding_account_writer = CSVWriter(f"results/accounts.funding.{now}.csv", AccountResult._fields)
     env_connection = get_env_connection()
     env_funder = get_env_funder(env_connection)
     env_config = get_env_config()
-    log(f"Preparing load. configuration is {env_config}")
-    prepare(env_connection, env_funder, env_config, account_writer, tx_plan_writer)
+    if has_args():
+        log(f"Resuming funding. configuration is {env_config}")
+        resume_funding(env_connection, env_funder, env_config, read_accounts(get_arg(0)),
+                       read_rows(get_arg(1), TxPlannedResult), funding_account_writer)
+    else:
+        log(f"Preparing load. configuration is {env_config}")
+        tx_plan_writer = CSVWriter(f"results/txs.planned.{now}.csv", TxPlannedResult._fields)
+        account_writer = CSVWriter(f"results/accounts.{now}.csv", AccountResult._fields)
+        prepare(env_connection, env_funder, env_config, account_writer, tx_plan_writer, funding_account_writer)
@@ -1,89 +1,310 @@
 #!/usr/bin/env python3.6
 import time
 from collections import namedtuple
+from functools import partial
+from multiprocessing import Barrier, Process, Value
 from block_monitor import BlockResult, BlockMonitorProcess
 
-from common import now_str, log, CSVWriter, get_env_connection, get_env_funder, AccountResult, get_env_config, \
-    TxPlannedResult, GasMonitorProcess, get_arg, csv_reader, has_args, AccountWrapper
+import metrics
+from account_store import read_accounts, AccountView
+from common import now_str, log, debug, CSVWriter, get_env_connection, get_env_funder, AccountResult, \
+    get_env_config, TxPlannedResult, get_arg, has_args, env, env_int, env_float, TX_WAIT_TIMEOUT, install_exit_on_signal
+from columnar import read_rows, csv_to_columnar
+from gas_oracle import get_env_gas_oracle
+from latency import LatencyAnalytics, LatencyResult, GasLatencyResult
+from load_engine import LoadEngine, lag_stats, uniform_send_times, planned_send_times
 from load_prepare import prepare
+from nonce_recovery import get_env_nonce_recovery, read_replacements, RecoveryResult
+from presign import presign_transfers
+from rate_controller import get_env_rate_controller, RateResult, RATE_CONTROLLER
+from tx_journal import TxJournal, journal_path, read_journal, reconcile, resumed_txs
+from tx_tracker import ConfirmationTracker, log_progress, ReceiptResult
 
+SHARD_START_DELAY = 1
+METRICS_SNAPSHOT_INTERVAL = env_float("METRICS_SNAPSHOT_INTERVAL", 5)
+LOAD_RESUME = env_int("LOAD_RESUME", 0)
+SEND_RETRIES = 1
 
-def do_load(conn, config, accounts, txs, gas_monitor, block_monitor, tx_writer):
-    start_time = time.time()
-    interval = 1 / config.tx_per_sec
-    results = []
-    accounts_dict = {account.address: account for account in accounts}
-    for i, tx in enumerate(txs):
-        log(f"submitting tx {i}/{len(txs)}")
-        time_to_execute = start_time + i * interval
-        if time_to_execute > time.time():
-            time.sleep(time_to_execute - time.time())
-
-        tx_time = int(time.time())
-        frm, to = accounts_dict[tx.frm], accounts_dict[tx.to]
-        gas_price = gas_monitor.get_latest_gas_price()
-        tx_hash = conn.send_tokens(frm, to.address, 1, int(gas_price),
-                                   config.token_transfer_gas_limit)
-        tx_result = TxResult(frm=frm.address, to=to.address, tx_hash=tx_hash, timestamp=str(tx_time),
+
+def do_load(config, accounts, txs, gas_oracle, block_monitor, tx_writer, tracker=None, slots=None,
+            wait_for_start=time.time, rate_controller=None, recovery=None, journal=None):
+    """submit planned txs on an open-loop schedule (tx i at start + its planned offset, or start + i/tx_per_sec for
+    plans without offsets) with up to max_in_flight concurrent rpc requests. nonces are allocated up front, in plan
+    order. if presign gas prices are configured, all txs are signed before the load window opens and only raw bytes
+    are pushed during it.
+    a shard of a larger plan passes the global schedule slot of each of its txs, and wait_for_start, which returns
+    the shared start time once all shards are ready. shard rows are written with their slot.
+    with a rate controller, txs follow its send times and gas prices are scaled by its multiplier instead.
+    with a nonce recovery, every sent tx is tracked by it. with a TxJournal, every tx is journaled before and after
+    it is sent.
+    a failed send is tried again once. the nonces of txs that still failed are filled (see fill_nonce_gaps) by the
+    nonce recovery, or without one once the schedule is done, so later txs of their senders are not held back.
+    accounts is an AccountRegistry; planned txs refer to its accounts by id or by address."""
+    if not txs:
+        # a shard without txs still takes part in the shared start
+        wait_for_start()
+        log("no txs to send")
+        return []
+    sender_ids = accounts.ids(tx.frm for tx in txs)
+    nonces = accounts.allocate_nonces(sender_ids)
+    presigned = None
+    if config.presign_gas_prices:
+        presigned = presign_transfers(accounts, sender_ids, txs, nonces, 1, config.token_transfer_gas_limit,
+                                      config.presign_gas_prices, config.presign_processes)
+
+    def send(conn, i, tx, sent_at):
+        frm = AccountView(accounts, sender_ids[i])
+        to = accounts.address_of(tx.to)
+        slot = i if slots is None else slots[i]
+        if journal:
+            journal.append(slot, frm.address, nonces[i])
+        gas_price = gas_oracle.get_latest_gas_price()
+        if rate_controller:
+            gas_price *= rate_controller.gas_price_multiplier
+        if presigned:
+            tx_hash, gas_price = presigned.send(conn, i, gas_price, frm, nonces[i])
+        else:
+            tx_hash = conn.send_tokens(frm, to, 1, int(gas_price), config.token_transfer_gas_limit, nonces[i])
+        if journal:
+            journal.append(slot, frm.address, nonces[i], tx_hash)
+        tx_result = TxResult(frm=frm.address, to=to, tx_hash=tx_hash, timestamp=str(int(sent_at)),
                              gas_price=str(gas_price), block_at_submit=block_monitor.get_latest_block_number())
-        log(tx_result)
-        results.append(tx_result)
-        tx_writer.append(tx_result)
+        debug("submitted tx %s/%s: %s", i, len(txs), tx_result)
+        return tx_result
+
+    def on_result(i, tx_result):
+        tx_writer.append(tx_result if slots is None else ShardTxResult(slots[i], *tx_result))
+        if tracker:
+            tracker.add_submitted(tx_result.tx_hash, float(tx_result.timestamp), float(tx_result.gas_price))
+
+    engine = LoadEngine(send, config.max_in_flight, on_result=on_result,
+                        connection_factory=partial(get_env_connection, recovery), retries=SEND_RETRIES)
+    start_time = wait_for_start()
+    if rate_controller:
+        rate_controller.start()
+        results = engine.run(txs, rate_controller.send_times(start_time))
+        rate_controller.stop()
+    elif all(tx.offset for tx in txs):
+        results = engine.run(txs, planned_send_times(start_time, (tx.offset for tx in txs)))
+    else:
+        results = engine.run(txs, uniform_send_times(start_time, config.tx_per_sec, slots or range(len(txs))))
 
     log(f"total load duration {time.time()-start_time}")
-    return results
+    log(f"schedule lag (sec): {lag_stats(engine.lags)}")
+    if engine.failures:
+        log(f"{len(engine.failures)} txs failed to send")
+        if not recovery:
+            fill_nonce_gaps(get_env_connection(), accounts, sender_ids, nonces, engine.failures,
+                            gas_oracle.get_latest_gas_price(), config.ether_transfer_gas_limit)
+    return [result for result in results if result is not None]
+
+
+def fill_nonce_gaps(conn, accounts, sender_ids, nonces, failed, gas_price, gas_limit):
+    """send a 0 ether self transfer at the nonce of every failed tx (by index) that later nonces of its sender wait
+    for. returns the number of filled nonces"""
+    last_nonces = dict(zip(sender_ids.tolist(), nonces))
+    filled = 0
+    for i in sorted(failed):
+        frm = AccountView(accounts, sender_ids[i])
+        if nonces[i] < last_nonces[int(sender_ids[i])]:
+            try:
+                conn.send_ether(frm, frm.address, 0, gas_price, gas_limit, nonces[i])
+                filled += 1
+            except ValueError as e:
+                log(f"filling nonce {nonces[i]} of {frm.address} failed ({e})")
+    log(f"filled {filled} nonce gaps left by failed txs")
+    return filled
+
+
+def report_monitors(gas_oracle, block_monitor):
+    """have the metrics gauges read the monitors' latest values"""
+    metrics.GAS_PRICE.set_function(gas_oracle.get_latest_gas_price)
+    metrics.LATEST_BLOCK.set_function(block_monitor.get_latest_block_number)
+    metrics.BLOCK_OBSERVED_DELAY.set_function(block_monitor.get_observed_delay)
+    metrics.BLOCK_MONITOR_LAG.set_function(block_monitor.get_monitor_lag)
+
+
+def partition_by_sender(txs, shard_count):
+    """schedule slots of each shard. senders are dealt round robin, so every account (and its nonces) is owned by a
+    single shard"""
+    shard_of_sender = {}
+    shards = [[] for _ in range(shard_count)]
+    for slot, tx in enumerate(txs):
+        shards[shard_of_sender.setdefault(tx.frm, len(shard_of_sender) % shard_count)].append(slot)
+    return shards
+
+
+def set_start_time(shared_start_time):
+    shared_start_time.value = time.time() + SHARD_START_DELAY
+
+
+def run_shard(config, accounts, txs, slots, gas_oracle, block_monitor, path, barrier, shared_start_time,
+              recovery_writer=None, journal=None):
+    """one load shard process. its nonce recovery keeps running after the load until all of the shard's txs are
+    mined (or abandoned), so the replacements it made are all recorded once the shard exits"""
+    def wait_for_start():
+        barrier.wait()
+        return shared_start_time.value
+
+    metrics.REGISTRY.reset()
+    reporter = metrics.MetricsReporter(snapshot_path=f"{path}.metrics.jsonl", interval=METRICS_SNAPSHOT_INTERVAL)
+    reporter.start()
+    shard_writer = CSVWriter(path, ShardTxResult._fields)
+    recovery = get_env_nonce_recovery(get_env_connection(), recovery_writer=recovery_writer)
+    if recovery:
+        recovery.start()
+    do_load(config, accounts, [txs[slot] for slot in slots], gas_oracle, block_monitor, shard_writer,
+            slots=slots, wait_for_start=wait_for_start, recovery=recovery, journal=journal)
+    shard_writer.close()
+    if recovery:
+        recovery.stop()
+        recovery.wait(config.block_update_interval, TX_WAIT_TIMEOUT or None)
+        if recovery_writer:
+            recovery_writer.close()
+    reporter.stop()
 
 
-def load_test(conn, config, accounts, planned_txs, tx_writer, block_writer):
-    # start monitoring gas
-    gas_monitor = GasMonitorProcess(config.gas_tier, config.gas_update_interval)
-    gas_monitor.start()
+def do_sharded_load(config, accounts, txs, gas_oracle, block_monitor, tx_writer, recovery_writer=None, journal=None):
+    """run do_load in load_shards processes over a sender partition of txs, all on the same schedule clock.
+    shard results are merged, in schedule order, into tx_writer. shards record their nonce recovery actions to
+    recovery_writer"""
+    shards = partition_by_sender(txs, config.load_shards)
+    paths = [f"{tx_writer.path}.shard{k}" for k in range(len(shards))]
+    shared_start_time = Value('d', 0.0)
+    barrier = Barrier(len(shards), action=partial(set_start_time, shared_start_time))
+    processes = [Process(target=run_shard, args=(config, accounts, txs, slots, gas_oracle, block_monitor, path,
+                                                 barrier, shared_start_time, recovery_writer, journal))
+                 for slots, path in zip(shards, paths)]
+    log(f"starting {len(processes)} load shards ({[len(slots) for slots in shards]} txs)")
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
+    return merge_shard_results((row for path in paths for row in read_rows(path, ShardTxResult)), tx_writer)
+
+
+def merge_shard_results(shard_rows, tx_writer):
+    """write ShardTxResult rows to tx_writer as TxResult rows, in schedule slot order"""
+    results = [TxResult(*row[1:]) for row in sorted(shard_rows, key=lambda row: int(row.slot))]
+    log(f"merging {len(results)} shard results")
+    tx_writer.append_all(results)
+    return results
+
+
+def load_test(conn, config, accounts, planned_txs, tx_writer, block_writer, receipt_writer=None, analytics=None,
+              rate_writer=None, recovery_writer=None, journal=None, unmined_tx_hashes=()):
+    """run the load of planned_txs. with a journal, sent txs are journaled (see TxJournal); a resumed run passes the
+    txs of the run it resumes that are not mined yet, so they are waited for as well"""
     # start block monitor
     block_monitor = BlockMonitorProcess(block_writer, config.block_update_interval, conn.get_latest_block().number)
     block_monitor.start()
 
+    # start gas price updates
+    gas_oracle = get_env_gas_oracle(config.gas_tier, config.gas_update_interval, block_monitor)
+    gas_oracle.start()
+    report_monitors(gas_oracle, block_monitor)
+
+    # track confirmations while loading. sharded results only arrive once all shards are done, so the tracker then
+    # starts scanning (from here) afterwards
+    tracker = ConfirmationTracker(conn, conn.get_latest_block().number, on_progress=log_progress,
+                                  receipt_writer=receipt_writer, analytics=analytics)
+    tracker.add(unmined_tx_hashes)
+
     # start load
     log("executing txs")
-    tx_results = do_load(conn, config, accounts, planned_txs, gas_monitor, block_monitor, tx_writer)
+    if config.load_shards > 1:
+        if RATE_CONTROLLER:
+            log("the rate controller only runs unsharded. ignoring it")
+        recovery = None
+        tx_results = do_sharded_load(config, accounts, planned_txs, gas_oracle, block_monitor, tx_writer,
+                                     recovery_writer, journal)
+        for tx_result in tx_results:
+            tracker.add_submitted(tx_result.tx_hash, float(tx_result.timestamp), float(tx_result.gas_price))
+        if recovery_writer:
+            for tx_hash, replaced_by in read_replacements(recovery_writer.path):
+                tracker.replace(tx_hash, replaced_by)
+        tracker.start(config.block_update_interval)
+    else:
+        tracker.start(config.block_update_interval)
+        recovery = get_env_nonce_recovery(get_env_connection(), tracker.replace, recovery_writer)
+        if recovery:
+            recovery.start()
+        rate_controller = get_env_rate_controller(config.tx_per_sec, tracker, block_monitor, rate_writer)
+        tx_results = do_load(config, accounts, planned_txs, gas_oracle, block_monitor, tx_writer, tracker,
+                             rate_controller=rate_controller, recovery=recovery, journal=journal)
 
-    # stop gas monitoring
-    log(f"killing gas monitor")
-    gas_monitor.stop()
+    # stop gas price updates
+    gas_oracle.stop()
 
-    for i, tx_result in enumerate(tx_results):
-        tx_hash = tx_result.tx_hash
-        log(f"waiting for transaction {tx_hash} ({i}/{len(tx_results)}) to complete")
-        conn.wait_for_tx(tx_hash)
+    wait_for_completion(conn, config, tracker, tx_results, recovery)
+
+    log(f"killing block monitor")
+    block_monitor.stop()
+
+
+def wait_for_completion(conn, config, tracker, tx_results, recovery=None):
+    """wait (stopping tracker's background scan, and the recovery's background checks) until all txs are included,
+    and then for additional 12 blocks"""
+    tracker.stop()
+    if recovery:
+        recovery.stop()
+    log(f"waiting for {len(tx_results)} transactions to complete")
+    tracker.wait(config.block_update_interval, recovery)
 
     log(f"waiting additional 12 blocks")
     final_block = conn.get_latest_block().number + 12
     while conn.get_latest_block().number <= final_block:
         time.sleep(config.block_update_interval)
 
-    log(f"killing block monitor")
-    block_monitor.stop()
-
 
 TxResult = namedtuple("TxResult", "frm to tx_hash timestamp gas_price block_at_submit")
+ShardTxResult = namedtuple("ShardTxResult", ("slot",) + TxResult._fields)
 
 if __name__ == "__main__":
+    install_exit_on_signal()
     now = now_str()
     tx_writer = CSVWriter(f"results/txs.{now}.csv", TxResult._fields)
     block_writer = CSVWriter(f"results/blocks.{now_str()}.csv", BlockResult._fields)
+    receipt_writer = CSVWriter(f"results/receipts.{now}.csv", ReceiptResult._fields)
+    latency_analytics = LatencyAnalytics(CSVWriter(f"results/latency.{now}.csv", LatencyResult._fields),
+                                         CSVWriter(f"results/latency.gas.{now}.csv", GasLatencyResult._fields))
     env_connection = get_env_connection()
     env_config = get_env_config()
     log(f"load configuration is {env_config}")
     if has_args():
         log("skipping preparations")
-        accounts = [AccountWrapper(account_result.private_key, 0)
-                    for account_result in csv_reader(get_arg(0), AccountResult)]
-        planned_tx = csv_reader(get_arg(1), TxPlannedResult)
+        accounts = read_accounts(get_arg(0))
+        planned_tx = read_rows(get_arg(1), TxPlannedResult)
+        # sender nonces come from the chain. with LOAD_RESUME, txs a previous run of this plan sent (per its journal)
+        # are skipped, otherwise the whole plan is sent again under a fresh journal
+        journal_file = journal_path(get_arg(1))
+        entries = read_journal(journal_file) if LOAD_RESUME else []
+        slots, unmined_tx_hashes = reconcile(env_connection, accounts, planned_tx, entries)
+        if len(slots) < len(planned_tx):
+            log(f"resuming {journal_file}: {len(slots)} txs left")
+            planned_tx = resumed_txs(planned_tx, slots, env_config.tx_per_sec)
+        tx_journal = TxJournal(journal_file, slots, resume=LOAD_RESUME)
     else:
         log("initiating preparations")
         env_funder = get_env_funder(env_connection)
         tx_plan_writer = CSVWriter(f"results/txs.planned.{now}.csv", TxPlannedResult._fields)
         account_writer = CSVWriter(f"results/accounts.{now}.csv", AccountResult._fields)
-        accounts, planned_tx = prepare(env_connection, env_funder, env_config, account_writer, tx_plan_writer)
+        funding_account_writer = CSVWriter(f"results/accounts.funding.{now}.csv", AccountResult._fields)
+        accounts, planned_tx = prepare(env_connection, env_funder, env_config, account_writer, tx_plan_writer,
+                                       funding_account_writer)
+        tx_journal, unmined_tx_hashes = TxJournal(journal_path(tx_plan_writer.path)), []
 
-    load_test(env_connection, env_config, accounts, planned_tx, tx_writer, block_writer)
+    metrics_reporter = metrics.MetricsReporter(env_int("METRICS_PORT", 0), f"results/metrics.{now}.jsonl",
+                                               METRICS_SNAPSHOT_INTERVAL)
+    metrics_reporter.start()
+    load_test(env_connection, env_config, accounts, planned_tx, tx_writer, block_writer, receipt_writer,
+              latency_analytics, CSVWriter(f"results/rate.{now}.csv", RateResult._fields),
+              CSVWriter(f"results/recovery.{now}.csv", RecoveryResult._fields), tx_journal, unmined_tx_hashes)
+    tx_journal.close()
+    metrics_reporter.stop()
+    if env("COLUMNAR_RESULTS", ""):
+        tx_writer.close()
+        receipt_writer.close()
+        for writer in (tx_writer, block_writer, receipt_writer):
+            csv_to_columnar(writer.path)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3.6
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import metrics
+from account_store import AccountRegistry
+from block_monitor import BlockResult, BlockMonitorProcess
+from common import now_str, log, CSVWriter, get_env_connection, get_env_config, TxPlannedResult, get_arg, \
+    stringify_list, env_int, TX_WAIT_TIMEOUT, install_exit_on_signal
+from gas_oracle import get_env_gas_oracle
+from load_test import do_load, ShardTxResult, report_monitors, METRICS_SNAPSHOT_INTERVAL
+from nonce_recovery import get_env_nonce_recovery, RecoveryResult
+
+
+class ShardResultStream:
+    """collects a shard's result rows for the controller to fetch, and writes them to a local csv"""
+
+    def __init__(self, path):
+        self.writer = CSVWriter(path, ShardTxResult._fields)
+        self.rows = []
+        self.done = False
+
+    def append(self, row):
+        self.writer.append(row)
+        self.rows.append(stringify_list(row))
+
+    def read(self, offset):
+        return {"rows": self.rows[offset:], "done": self.done}
+
+
+def run_shard(shard, stream):
+    """run a shard handed over by the controller against this worker's node, starting at the shard's start time"""
+    now = now_str()
+    conn = get_env_connection()
+    config = get_env_config()._replace(tx_per_sec=shard["tx_per_sec"])
+    private_keys, nonces, addresses = zip(*shard["accounts"])
+    accounts = AccountRegistry.from_hex(private_keys, addresses, nonces)
+    txs = [TxPlannedResult(*tx) for tx in shard["txs"]]
+
+    block_writer = CSVWriter(f"results/blocks.worker.{now}.csv", BlockResult._fields)
+    block_monitor = BlockMonitorProcess(block_writer, config.block_update_interval, conn.get_latest_block().number)
+    block_monitor.start()
+    gas_oracle = get_env_gas_oracle(config.gas_tier, config.gas_update_interval, block_monitor)
+    gas_oracle.start()
+    report_monitors(gas_oracle, block_monitor)
+
+    def wait_for_start():
+        log(f"starting {len(txs)} txs in {shard['start_time'] - time.time():.3f} seconds")
+        return shard["start_time"]
+
+    recovery_writer = CSVWriter(f"results/recovery.worker.{now}.csv", RecoveryResult._fields)
+    recovery = get_env_nonce_recovery(get_env_connection(), recovery_writer=recovery_writer)
+    try:
+        if recovery:
+            recovery.start()
+        do_load(config, accounts, txs, gas_oracle, block_monitor, stream, slots=shard["slots"],
+                wait_for_start=wait_for_start, recovery=recovery)
+        if recovery:
+            recovery.stop()
+            recovery.wait(config.block_update_interval, TX_WAIT_TIMEOUT or None)
+    finally:
+        gas_oracle.stop()
+        block_monitor.stop()
+        stream.writer.close()
+        stream.done = True
+
+
+class WorkerHandler(BaseHTTPRequestHandler):
+    """POST /shard starts a shard. GET /results?offset=n returns result rows from offset n, and whether the shard is
+    done"""
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != "/shard":
+            return self._reply(404, {"error": "not found"})
+        if self.server.stream is not None and not self.server.stream.done:
+            return self._reply(409, {"error": "a shard is already running"})
+        shard = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        self.server.stream = ShardResultStream(f"results/txs.worker.{now_str()}.csv")
+        threading.Thread(target=run_shard, args=(shard, self.server.stream), daemon=True).start()
+        self._reply(200, {"txs": len(shard["txs"])})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/results" or self.server.stream is None:
+            return self._reply(404, {"error": "not found"})
+        offset = int(parse_qs(url.query).get("offset", ["0"])[0])
+        self._reply(200, self.server.stream.read(offset))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WorkerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port):
+        super().__init__(("", port), WorkerHandler)
+        self.stream = None
+
+
+if __name__ == "__main__":
+    install_exit_on_signal()
+    port = int(get_arg(0))
+    log(f"load worker listening on port {port}")
+    metrics.MetricsReporter(env_int("METRICS_PORT", 0), f"results/metrics.worker.{now_str()}.jsonl",
+                            METRICS_SNAPSHOT_INTERVAL).start()
+    WorkerServer(port).serve_forever()
@@ -0,0 +1,226 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# seconds, roughly log spaced from 0.5ms to 60s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def reset(self):
+        self.value = 0
+
+
+class Gauge:
+    """a value that is either set, or read from a function whenever it is reported"""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    @property
+    def value(self):
+        return self._function() if self._function else self._value
+
+    def reset(self):
+        self._value = 0.0
+
+
+class Histogram:
+    """observation counts in fixed buckets (upper bounds), plus sum and max. quantiles are estimated from the buckets"""
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """upper bound of the bucket holding quantile q (max for the overflow bucket)"""
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return 0.0
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def reset(self):
+        """zero all metrics, e.g. in a forked process that reports on its own"""
+        for metric in self.metrics:
+            metric.reset()
+
+    def render_text(self):
+        """prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            if isinstance(metric, Histogram):
+                lines.append(f"# TYPE {metric.name} histogram")
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                    cumulative += count
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {metric.sum}")
+                lines.append(f"{metric.name}_count {cumulative}")
+            else:
+                lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'gauge'}")
+                lines.append(f"{metric.name} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """compact summary: counter and gauge values, and count/mean/p50/p99/max of histograms"""
+        snapshot = {"time": round(time.time(), 3)}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                count = metric.count
+                snapshot[metric.name] = [count, round(metric.sum / count, 6) if count else 0,
+                                         metric.quantile(0.5), metric.quantile(0.99), round(metric.max, 6)]
+            else:
+                snapshot[metric.name] = metric.value
+        return snapshot
+
+
+REGISTRY = Registry()
+
+SCHEDULE_LAG = REGISTRY.histogram("schedule_lag_seconds", "how far actual send times trailed the schedule")
+SIGN_SECONDS = REGISTRY.histogram("sign_seconds", "time to sign a tx")
+SEND_SECONDS = REGISTRY.histogram("send_seconds", "sendRawTransaction rpc latency")
+SUBMISSIONS = REGISTRY.counter("submissions_total", "submissions handed to the load engine")
+SUBMISSION_FAILURES = REGISTRY.counter("submission_failures_total", "submissions that raised")
+GAS_BUMP_RETRIES = REGISTRY.counter("gas_bump_retries_total", "txs resent at a 10%+ higher gas price")
+LOWER_GAS_PRICE_RETRIES = REGISTRY.counter("lower_gas_price_retries_total",
+                                           "token transfers resent at a gas price the balance can cover")
+PRESIGN_LEVEL_RETRIES = REGISTRY.counter("presign_level_retries_total",
+                                         "pre-signed txs resent at the next gas price level")
+TIMEOUTS = REGISTRY.counter("timeouts_total", "sendRawTransaction rpc timeouts (tx hash assumed)")
+GAS_PRICE = REGISTRY.gauge("gas_price_wei", "current gas price of the gas oracle")
+LATEST_BLOCK = REGISTRY.gauge("latest_block_number", "latest block seen by the block monitor")
+BLOCK_OBSERVED_DELAY = REGISTRY.gauge("block_observed_delay_seconds",
+                                      "observed time minus miner timestamp of the latest block")
+BLOCK_MONITOR_LAG = REGISTRY.gauge("block_monitor_lag_seconds",
+                                   "time the block monitor took to process the latest block after observing it")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics (prometheus text) and GET /metrics.json (snapshot)"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            data, content_type = REGISTRY.render_text().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            data, content_type = json.dumps(REGISTRY.snapshot()).encode(), "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port):
+        super().__init__(("", port), MetricsHandler)
+
+
+class MetricsReporter:
+    """serves metrics on port (if given) and appends a snapshot json line to snapshot_path every interval seconds
+    (if given), both from daemon threads"""
+
+    def __init__(self, port=None, snapshot_path=None, interval=5):
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._server = MetricsServer(port) if port else None
+
+    def start(self):
+        if self._server:
+            logging.info(f"serving metrics on port {self._server.server_address[1]}")
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if self.snapshot_path and self.interval > 0:
+            threading.Thread(target=self._write_snapshots, daemon=True).start()
+        return self
+
+    def write_snapshot(self):
+        with open(self.snapshot_path, "a") as f:
+            f.write(json.dumps(REGISTRY.snapshot(), separators=(",", ":")) + "\n")
+
+    def _write_snapshots(self):
+        while not self._stopped.wait(self.interval):
+            self.write_snapshot()
+
+    def stop(self):
+        """stop reporting, after a final snapshot"""
+        self._stopped.set()
+        if self.snapshot_path and self.interval > 0:
+            self.write_snapshot()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
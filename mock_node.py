@@ -0,0 +1,453 @@
+#!/usr/bin/env python3.6
+import heapq
+import itertools
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import rlp
+from eth_hash.auto import keccak
+from eth_utils import big_endian_to_int, to_checksum_address
+from web3 import Account
+
+from common import log, get_arg, env_int, env_float
+
+TRANSFER_SELECTOR = "a9059cbb"
+BALANCE_OF_SELECTOR = "70a08231"
+ETHER_TRANSFER_GAS = 21000
+TOKEN_TRANSFER_GAS = 51000
+REPLACEMENT_BUMP = 1.1
+METHOD_NOT_FOUND = -32601
+
+MockNodeConfig = namedtuple("MockNodeConfig", "block_time block_gas_limit chain_id default_balance default_tokens "
+                                              "latency_ms timeout_rate timeout_sec seed")
+
+
+def get_env_mock_config():
+    return MockNodeConfig(block_time=env_float("MOCK_BLOCK_TIME", 1),
+                          block_gas_limit=env_int("MOCK_BLOCK_GAS_LIMIT", 8000000),
+                          chain_id=env_int("CHAIN_ID", 1),
+                          default_balance=env_int("MOCK_DEFAULT_BALANCE", 10 ** 24),
+                          default_tokens=env_int("MOCK_DEFAULT_TOKENS", 10 ** 9),
+                          latency_ms=env_float("MOCK_LATENCY_MS", 0),
+                          timeout_rate=env_float("MOCK_TIMEOUT_RATE", 0),
+                          timeout_sec=env_float("MOCK_TIMEOUT_SEC", 5),
+                          seed=env_int("MOCK_SEED", 0))
+
+
+def to_quantity(n):
+    return hex(n)
+
+
+def to_data(b):
+    return "0x" + b.hex()
+
+
+def block_hash(number):
+    return to_data(keccak(number.to_bytes(32, "big")))
+
+
+class MethodNotFound(Exception):
+    """a request the mock node does not serve, answered with a json-rpc method not found error"""
+
+
+class MockTx:
+    """a decoded raw transaction"""
+
+    def __init__(self, raw):
+        nonce, gas_price, gas, to, value, data, v, r, s = rlp.decode(raw)
+        self.raw = raw
+        self.hash = to_data(keccak(raw))
+        self.sender = Account.recoverTransaction(raw)
+        self.nonce = big_endian_to_int(nonce)
+        self.gas_price = big_endian_to_int(gas_price)
+        self.gas = big_endian_to_int(gas)
+        self.to = to_checksum_address(to) if to else None
+        self.value = big_endian_to_int(value)
+        self.data = data
+        self.v, self.r, self.s = big_endian_to_int(v), big_endian_to_int(r), big_endian_to_int(s)
+        self.gas_used = min(self.gas, TOKEN_TRANSFER_GAS if data else ETHER_TRANSFER_GAS)
+        self.block_number = None
+        self.index = None
+
+    def token_transfer(self):
+        """(recipient, amount) if this is an erc20 transfer call"""
+        if self.data[:4].hex() != TRANSFER_SELECTOR:
+            return None
+        return to_checksum_address(self.data[16:36]), big_endian_to_int(self.data[36:68])
+
+    def to_json(self, blocks):
+        mined = self.block_number is not None
+        return {
+            "hash": self.hash,
+            "nonce": to_quantity(self.nonce),
+            "blockHash": blocks[self.block_number]["hash"] if mined else None,
+            "blockNumber": to_quantity(self.block_number) if mined else None,
+            "transactionIndex": to_quantity(self.index) if mined else None,
+            "from": self.sender,
+            "to": self.to,
+            "value": to_quantity(self.value),
+            "gas": to_quantity(self.gas),
+            "gasPrice": to_quantity(self.gas_price),
+            "input": to_data(self.data),
+            "v": to_quantity(self.v),
+            "r": to_quantity(self.r),
+            "s": to_quantity(self.s),
+        }
+
+    def receipt_json(self, blocks):
+        return {
+            "transactionHash": self.hash,
+            "transactionIndex": to_quantity(self.index),
+            "blockHash": blocks[self.block_number]["hash"],
+            "blockNumber": to_quantity(self.block_number),
+            "from": self.sender,
+            "to": self.to,
+            "cumulativeGasUsed": to_quantity(self.gas_used),
+            "gasUsed": to_quantity(self.gas_used),
+            "contractAddress": None,
+            "logs": [],
+            "logsBloom": "0x" + "00" * 256,
+            "status": "0x1",
+        }
+
+
+class MockChain:
+    """In-memory stand-in chain. Every block_time seconds a block is mined from the mempool: executable txs (next
+    nonce of their sender) by descending gas price, up to the block gas limit. Ether and token balances are tracked,
+    starting from default balances, and new heads are pushed to listeners."""
+
+    def __init__(self, config):
+        self.config = config
+        self.blocks = []
+        self.block_txs = []
+        self.txs = {}
+        self.queued = {}
+        self.nonces = {}
+        self.balances = {}
+        self.tokens = {}
+        self.head_listeners = []
+        self.lock = threading.RLock()
+        self._seq = itertools.count()
+        self.mine()
+
+    def nonce(self, address):
+        return self.nonces.get(address, 0)
+
+    def balance(self, address):
+        return self.balances.get(address, self.config.default_balance)
+
+    def token_balance(self, address):
+        return self.tokens.get(address, self.config.default_tokens)
+
+    def pending_nonce(self, address):
+        nonce = self.nonce(address)
+        while nonce in self.queued.get(address, {}):
+            nonce += 1
+        return nonce
+
+    def send_raw(self, raw):
+        tx = MockTx(raw)
+        with self.lock:
+            if tx.nonce < self.nonce(tx.sender):
+                raise ValueError("nonce too low")
+            if tx.gas_price * tx.gas + tx.value > self.balance(tx.sender):
+                raise ValueError("insufficient funds for gas * price + value")
+            queued = self.queued.setdefault(tx.sender, {})
+            replaced = queued.get(tx.nonce)
+            if replaced and replaced.hash != tx.hash:
+                if tx.gas_price < replaced.gas_price * REPLACEMENT_BUMP:
+                    raise ValueError("replacement transaction underpriced")
+                del self.txs[replaced.hash]
+            queued[tx.nonce] = tx
+            self.txs[tx.hash] = tx
+        return tx.hash
+
+    def _apply(self, tx, number, index):
+        tx.block_number, tx.index = number, index
+        self.nonces[tx.sender] = tx.nonce + 1
+        self.balances[tx.sender] = self.balance(tx.sender) - tx.gas_used * tx.gas_price - tx.value
+        if tx.to:
+            self.balances[tx.to] = self.balance(tx.to) + tx.value
+        token_transfer = tx.token_transfer()
+        if token_transfer:
+            to, amount = token_transfer
+            self.tokens[tx.sender] = self.token_balance(tx.sender) - amount
+            self.tokens[to] = self.token_balance(to) + amount
+
+    def _select(self):
+        """executable txs by descending gas price, within the block gas limit"""
+        ready = [(-tx.gas_price, next(self._seq), tx) for sender, queued in self.queued.items()
+                 for tx in [queued.get(self.nonce(sender))] if tx]
+        heapq.heapify(ready)
+        selected, gas = [], 0
+        while ready:
+            _, _, tx = heapq.heappop(ready)
+            if gas + tx.gas_used > self.config.block_gas_limit:
+                continue
+            selected.append(tx)
+            gas += tx.gas_used
+            del self.queued[tx.sender][tx.nonce]
+            self.nonces[tx.sender] = tx.nonce + 1
+            follower = self.queued[tx.sender].get(tx.nonce + 1)
+            if follower:
+                heapq.heappush(ready, (-follower.gas_price, next(self._seq), follower))
+        return selected, gas
+
+    def mine(self):
+        with self.lock:
+            number = len(self.blocks)
+            txs, gas_used = self._select() if number else ([], 0)
+            for index, tx in enumerate(txs):
+                self._apply(tx, number, index)
+            block = {
+                "number": to_quantity(number),
+                "hash": block_hash(number),
+                "parentHash": block_hash(number - 1) if number else "0x" + "00" * 32,
+                "timestamp": to_quantity(int(time.time())),
+                "gasLimit": to_quantity(self.config.block_gas_limit),
+                "gasUsed": to_quantity(gas_used),
+                "miner": "0x" + "00" * 20,
+                "difficulty": to_quantity(1),
+                "totalDifficulty": to_quantity(number + 1),
+                "extraData": "0x",
+                "nonce": "0x" + "00" * 8,
+                "size": to_quantity(sum(len(tx.raw) for tx in txs)),
+                "uncles": [],
+            }
+            self.blocks.append(block)
+            self.block_txs.append(txs)
+            listeners = list(self.head_listeners)
+        for listener in listeners:
+            try:
+                listener(dict(block))
+            except Exception as e:
+                # e.g. the subscriber disconnected
+                log(f"dropping a new heads subscriber ({e})")
+                with self.lock:
+                    if listener in self.head_listeners:
+                        self.head_listeners.remove(listener)
+        return block
+
+    def run(self):
+        while True:
+            time.sleep(self.config.block_time)
+            block = self.mine()
+            log(f"mined block {int(block['number'], 16)} ({len(self.block_txs[-1])} txs, "
+                f"{sum(len(queued) for queued in self.queued.values())} in mempool)")
+
+    def get_block(self, block_id, full_transactions):
+        with self.lock:
+            n = len(self.blocks) - 1 if block_id in ("latest", "pending") else int(block_id, 16)
+            if n >= len(self.blocks):
+                return None
+            txs = self.block_txs[n]
+            return dict(self.blocks[n], transactions=[tx.to_json(self.blocks) if full_transactions else tx.hash
+                                                      for tx in txs])
+
+    def get_transaction(self, tx_hash):
+        with self.lock:
+            tx = self.txs.get(tx_hash.lower())
+            return tx.to_json(self.blocks) if tx else None
+
+    def get_receipt(self, tx_hash):
+        with self.lock:
+            tx = self.txs.get(tx_hash.lower())
+            return tx.receipt_json(self.blocks) if tx and tx.block_number is not None else None
+
+    def call(self, tx, block_id):
+        data = tx.get("data", tx.get("input", "0x"))[2:]
+        if data[:8] != BALANCE_OF_SELECTOR:
+            raise MethodNotFound("only erc20 balanceOf calls are supported")
+        return to_data(self.token_balance(to_checksum_address(data[-40:])).to_bytes(32, "big"))
+
+
+class MockNodeSession:
+    """one client connection: json-rpc requests (single or batched) and newHeads subscriptions.
+    every request is delayed by latency_ms; a timeout_rate fraction of sendRawTransaction replies (the tx is still
+    accepted) is held back for timeout_sec, to trigger client side timeouts."""
+
+    def __init__(self, chain, write, rand):
+        self.chain = chain
+        self.write = write
+        self.rand = rand
+        self.write_lock = threading.Lock()
+        self.subscriptions = {}
+
+    def send(self, message):
+        with self.write_lock:
+            self.write(json.dumps(message).encode())
+
+    def subscribe(self, kind):
+        if self.write is None:
+            # like geth, which only pushes notifications over ipc and websockets
+            raise MethodNotFound("notifications not supported")
+        assert kind == "newHeads", f"unsupported subscription {kind}"
+        subscription_id = to_quantity(int.from_bytes(os.urandom(8), "big"))
+
+        def on_head(header):
+            self.send({"jsonrpc": "2.0", "method": "eth_subscription",
+                       "params": {"subscription": subscription_id, "result": header}})
+
+        self.subscriptions[subscription_id] = on_head
+        with self.chain.lock:
+            self.chain.head_listeners.append(on_head)
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        on_head = self.subscriptions.pop(subscription_id, None)
+        with self.chain.lock:
+            # mine() drops listeners that failed
+            if on_head in self.chain.head_listeners:
+                self.chain.head_listeners.remove(on_head)
+        return on_head is not None
+
+    def close(self):
+        for subscription_id in list(self.subscriptions):
+            self.unsubscribe(subscription_id)
+
+    def call(self, method, params):
+        chain = self.chain
+        if method == "eth_sendRawTransaction":
+            if self.rand.random() < chain.config.timeout_rate:
+                tx_hash = chain.send_raw(bytes.fromhex(params[0][2:]))
+                time.sleep(chain.config.timeout_sec)
+                return tx_hash
+            return chain.send_raw(bytes.fromhex(params[0][2:]))
+        if method == "eth_getTransactionCount":
+            address = to_checksum_address(params[0])
+            with chain.lock:
+                nonce = chain.pending_nonce(address) if params[1] == "pending" else chain.nonce(address)
+            return to_quantity(nonce)
+        if method == "eth_getBalance":
+            return to_quantity(chain.balance(to_checksum_address(params[0])))
+        if method == "eth_blockNumber":
+            return to_quantity(len(chain.blocks) - 1)
+        if method == "eth_getBlockByNumber":
+            return chain.get_block(*params)
+        if method == "eth_getTransactionByHash":
+            return chain.get_transaction(params[0])
+        if method == "eth_getTransactionReceipt":
+            return chain.get_receipt(params[0])
+        if method == "eth_call":
+            return chain.call(*params)
+        if method == "eth_gasPrice":
+            return to_quantity(10 ** 9)
+        if method == "evm_mine":
+            return chain.mine()["number"]
+        if method == "eth_subscribe":
+            return self.subscribe(*params)
+        if method == "eth_unsubscribe":
+            return self.unsubscribe(*params)
+        if method == "net_version":
+            return str(chain.config.chain_id)
+        if method == "eth_chainId":
+            return to_quantity(chain.config.chain_id)
+        raise MethodNotFound(f"the method {method} does not exist/is not available")
+
+    def respond(self, request):
+        try:
+            return {"jsonrpc": "2.0", "id": request["id"], "result": self.call(request["method"], request["params"])}
+        except MethodNotFound as e:
+            return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": METHOD_NOT_FOUND, "message": str(e)}}
+        except Exception as e:
+            return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32000, "message": str(e)}}
+
+    def reply(self, message):
+        if self.chain.config.latency_ms:
+            time.sleep(self.chain.config.latency_ms / 1000)
+        if isinstance(message, list):
+            return [self.respond(request) for request in message]
+        return self.respond(message)
+
+    def handle(self, message):
+        self.send(self.reply(message))
+
+
+class IPCHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        session = MockNodeSession(self.server.chain, self.request.sendall, self.server.rand)
+        decoder = json.JSONDecoder()
+        buffer = ""
+        try:
+            while True:
+                chunk = self.request.recv(65536)
+                if not chunk:
+                    return
+                buffer += chunk.decode()
+                while True:
+                    buffer = buffer.lstrip()
+                    try:
+                        message, end = decoder.raw_decode(buffer)
+                    except ValueError:
+                        break
+                    buffer = buffer[end:]
+                    session.handle(message)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            session.close()
+
+
+class MockIPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, ipc_path, chain, rand):
+        if os.path.exists(ipc_path):
+            os.remove(ipc_path)
+        super().__init__(ipc_path, IPCHandler)
+        self.chain = chain
+        self.rand = rand
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        session = MockNodeSession(self.server.chain, None, self.server.rand)
+        message = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        data = json.dumps(session.reply(message)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, chain, rand):
+        super().__init__(("127.0.0.1", port), HTTPHandler)
+        self.chain = chain
+        self.rand = rand
+
+
+def start_mock_node(config, ipc_path=None, http_port=None):
+    """serve a new mock chain on ipc_path and/or http_port from background threads. returns the chain"""
+    chain = MockChain(config)
+    rand = random.Random(config.seed)
+    servers = []
+    if ipc_path:
+        servers.append(MockIPCServer(ipc_path, chain, rand))
+    if http_port:
+        servers.append(MockHTTPServer(http_port, chain, rand))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=chain.run, daemon=True).start()
+    log(f"mock node listening on {ipc_path or '-'} (ipc), {http_port or '-'} (http). {config}")
+    return chain
+
+
+if __name__ == "__main__":
+    """./mock_node.py <ipc_path> [<http_port>]"""
+    start_mock_node(get_env_mock_config(), get_arg(0), int(get_arg(1)) if len(sys.argv) > 2 else None)
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,242 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+from eth_utils import to_hex, to_wei
+from web3 import Account
+
+import metrics
+from columnar import read_rows
+from common import env_int, env_float, log, debug, REPLACEMENT_GAS_BUMP
+
+NONCE_RECOVERY = env_int("NONCE_RECOVERY", 1)
+NONCE_CHECK_SEC = env_float("NONCE_CHECK_SEC", 15)
+NONCE_RESEND_SEC = env_float("NONCE_RESEND_SEC", 30)
+NONCE_STUCK_SEC = env_float("NONCE_STUCK_SEC", 180)
+NONCE_GAS_BUMP = env_float("NONCE_GAS_BUMP", 1.125)
+NONCE_MAX_REPLACEMENTS = env_int("NONCE_MAX_REPLACEMENTS", 3)
+NONCE_MAX_GAS_PRICE = to_wei(env_float("NONCE_MAX_GAS_PRICE", 0), "gwei")
+NONCE_BUDGET = to_wei(env_float("NONCE_BUDGET", 0.05), "ether")
+
+FILL_GAS_LIMIT = 21000
+
+TrackedTx = namedtuple("TrackedTx", "raw_tx tx_hash gas_price sent_at broadcast_at replacements")
+RecoveryResult = namedtuple("RecoveryResult", "timestamp frm nonce action tx_hash replaced_by gas_price")
+
+REBROADCASTS = metrics.REGISTRY.counter("nonce_rebroadcasts_total", "txs the node lost, sent again")
+REPLACEMENTS = metrics.REGISTRY.counter("nonce_replacements_total", "stuck txs replaced at a higher gas price")
+GAP_FILLS = metrics.REGISTRY.counter("nonce_gap_fills_total", "nonces never sent, filled with a 0 ether self transfer")
+ABANDONED = metrics.REGISTRY.counter("nonce_abandoned_total", "stuck txs left as they are, out of replacement budget")
+OUTSTANDING = metrics.REGISTRY.gauge("nonce_outstanding_txs", "sent txs whose nonce is not mined yet")
+
+
+class NonceRecovery:
+    """Recovers dropped, stuck and missing txs of many accounts, by nonce.
+
+    Every sent tx is tracked (track) with its raw bytes until the node's latest nonce of its sender passes it. check()
+    fetches the latest and pending nonces of all senders with outstanding txs in two batched rpc passes, whatever the
+    number of accounts, and then
+    - rebroadcasts txs the node does not know (nonce at or above its pending nonce) resend_sec after their last send,
+      e.g. lost on an ipc timeout or evicted from the pool
+    - fills a nonce that was never sent (one below later outstanding ones) with a 0 ether self transfer, as it would
+      block every later tx of the account
+    - replaces txs pending for stuck_sec at a gas_bump (10%+) higher gas price, up to max_replacements times per tx,
+      max_gas_price and a total budget (wei) of extra gas cost. txs out of budget are abandoned: left as they are
+    on_replaced(tx_hash, replaced_by) is called for every replacement (e.g. ConfirmationTracker.replace) and every
+    action is written as a RecoveryResult row."""
+
+    def __init__(self, conn, on_replaced=None, recovery_writer=None, resend_sec=NONCE_RESEND_SEC,
+                 stuck_sec=NONCE_STUCK_SEC, gas_bump=NONCE_GAS_BUMP, max_replacements=NONCE_MAX_REPLACEMENTS,
+                 max_gas_price=NONCE_MAX_GAS_PRICE, budget=NONCE_BUDGET):
+        self.conn = conn
+        self.on_replaced = on_replaced
+        self.recovery_writer = recovery_writer
+        self.resend_sec = resend_sec
+        self.stuck_sec = stuck_sec
+        self.gas_bump = max(gas_bump, REPLACEMENT_GAS_BUMP)
+        self.max_replacements = max_replacements
+        self.max_gas_price = max_gas_price
+        self.budget = budget
+        self.spent = 0
+        self.accounts = {}
+        self.outstanding = {}
+        self.abandoned = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def track(self, account, nonce, raw_tx, tx_hash, gas_price, replacements=0):
+        now = time.time()
+        with self._lock:
+            self.accounts[account.address] = account
+            self.outstanding.setdefault(account.address, {})[nonce] = TrackedTx(
+                raw_tx=bytes(raw_tx), tx_hash=tx_hash.lower(), gas_price=int(gas_price), sent_at=now,
+                broadcast_at=now, replacements=replacements)
+
+    def outstanding_count(self):
+        with self._lock:
+            return sum(len(txs) for txs in self.outstanding.values())
+
+    def active_count(self):
+        """outstanding txs, except abandoned ones"""
+        return self.outstanding_count() - len(self.abandoned)
+
+    def check(self):
+        """one recovery pass over all senders with outstanding txs. returns the number of outstanding txs"""
+        with self._lock:
+            addresses = [address for address, txs in self.outstanding.items() if txs]
+        if addresses:
+            latest_nonces = self.conn.get_transaction_counts(addresses, "latest")
+            pending_nonces = self.conn.get_transaction_counts(addresses, "pending")
+            resend, stuck, gaps = self._classify(addresses, latest_nonces, pending_nonces, time.time())
+            for address, nonce, tracked in resend:
+                self._rebroadcast(address, nonce, tracked)
+            if stuck:
+                self._replace(stuck)
+            for address, nonce, gas_price in gaps:
+                self._fill(address, nonce, gas_price)
+        count = self.outstanding_count()
+        OUTSTANDING.set(count)
+        return count
+
+    def _classify(self, addresses, latest_nonces, pending_nonces, now):
+        resend, stuck, gaps = [], [], []
+        with self._lock:
+            for address, latest_nonce, pending_nonce in zip(addresses, latest_nonces, pending_nonces):
+                txs = self.outstanding[address]
+                for nonce in [nonce for nonce in txs if nonce < latest_nonce]:
+                    del txs[nonce]
+                    self.abandoned.discard((address, nonce))
+                for nonce in sorted(txs):
+                    tracked = txs[nonce]
+                    if nonce >= pending_nonce:
+                        if now - tracked.broadcast_at > self.resend_sec:
+                            resend.append((address, nonce, tracked))
+                    elif now - tracked.sent_at > self.stuck_sec and (address, nonce) not in self.abandoned:
+                        stuck.append((address, nonce, tracked))
+                later = [nonce for nonce in txs if nonce > pending_nonce]
+                if pending_nonce not in txs and later:
+                    following = txs[min(later)]
+                    if now - following.sent_at > self.resend_sec:
+                        gaps.append((address, pending_nonce, following.gas_price))
+        return resend, stuck, gaps
+
+    def _rebroadcast(self, address, nonce, tracked):
+        try:
+            self.conn.send_raw(tracked.raw_tx, tracked.tx_hash)
+        except ValueError as e:
+            # typically known by now, or mined since the nonces were fetched
+            debug("rebroadcast of %s failed (%s)", tracked.tx_hash, e)
+        REBROADCASTS.inc()
+        self._update(address, nonce, tracked._replace(broadcast_at=time.time()))
+        self._record(address, nonce, "rebroadcast", tracked.tx_hash, "", tracked.gas_price)
+
+    def _replace(self, stuck):
+        txs = self.conn.get_transactions([tracked.tx_hash for _, _, tracked in stuck])
+        for (address, nonce, tracked), tx in zip(stuck, txs):
+            if tx is None or tx.blockNumber is not None:
+                # dropped (rebroadcast once the node reports it missing) or just mined
+                continue
+            gas_price = max(int(math.ceil(tx.gasPrice * self.gas_bump)), tx.gasPrice + 1)
+            cost = (gas_price - tx.gasPrice) * tx.gas
+            if tracked.replacements >= self.max_replacements or \
+                    (self.max_gas_price and gas_price > self.max_gas_price) or self.spent + cost > self.budget:
+                self._abandon(address, nonce, tracked)
+                continue
+            tx_dict = {"to": tx.to, "value": tx.value, "data": tx.input, "gas": tx.gas, "gasPrice": gas_price,
+                       "nonce": nonce, "chainId": self.conn.chain_id}
+            replaced_by = self._send(address, tx_dict, tracked.replacements + 1)
+            if replaced_by is None:
+                continue
+            self.spent += cost
+            REPLACEMENTS.inc()
+            self._record(address, nonce, "replace", tracked.tx_hash, replaced_by, gas_price)
+            if self.on_replaced:
+                self.on_replaced(tracked.tx_hash, replaced_by)
+
+    def _fill(self, address, nonce, gas_price):
+        cost = gas_price * FILL_GAS_LIMIT
+        if self.spent + cost > self.budget:
+            log(f"no budget left to fill nonce {nonce} of {address}")
+            return
+        tx_dict = {"to": address, "value": 0, "gas": FILL_GAS_LIMIT, "gasPrice": gas_price, "nonce": nonce,
+                   "chainId": self.conn.chain_id}
+        tx_hash = self._send(address, tx_dict, 0)
+        if tx_hash is not None:
+            self.spent += cost
+            GAP_FILLS.inc()
+            self._record(address, nonce, "fill", "", tx_hash, gas_price)
+
+    def _send(self, address, tx_dict, replacements):
+        """sign tx_dict as address, send and track it. returns its hash, or None if the node refused it"""
+        account = self.accounts[address]
+        signed_tx = Account.signTransaction(tx_dict, account.private_key)
+        tx_hash = to_hex(signed_tx.hash)
+        try:
+            self.conn.send_raw(signed_tx.rawTransaction, tx_hash)
+        except ValueError as e:
+            debug("recovery tx %s of %s failed (%s)", tx_dict["nonce"], address, e)
+            return None
+        self.track(account, tx_dict["nonce"], signed_tx.rawTransaction, tx_hash, tx_dict["gasPrice"], replacements)
+        return tx_hash.lower()
+
+    def _update(self, address, nonce, tracked):
+        with self._lock:
+            if nonce in self.outstanding[address]:
+                self.outstanding[address][nonce] = tracked
+
+    def _abandon(self, address, nonce, tracked):
+        log(f"tx {tracked.tx_hash} (nonce {nonce} of {address}) stuck out of replacement budget. leaving it")
+        ABANDONED.inc()
+        with self._lock:
+            self.abandoned.add((address, nonce))
+        self._record(address, nonce, "abandon", tracked.tx_hash, "", tracked.gas_price)
+
+    def _record(self, address, nonce, action, tx_hash, replaced_by, gas_price):
+        result = RecoveryResult(timestamp=time.time(), frm=address, nonce=nonce, action=action, tx_hash=tx_hash,
+                                replaced_by=replaced_by, gas_price=gas_price)
+        debug("nonce recovery: %s", result)
+        if self.recovery_writer:
+            self.recovery_writer.append(result)
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.check()
+            except Exception as e:
+                log(f"nonce recovery check failed ({e})")
+
+    def start(self, interval=NONCE_CHECK_SEC):
+        """check in a background thread every interval seconds"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def wait(self, interval=NONCE_CHECK_SEC, timeout=None):
+        """check until every tracked nonce is mined (abandoned txs aside), or for at most timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.check()
+            active = self.active_count()
+            if active == 0 or (deadline and time.time() > deadline):
+                log(f"nonce recovery settled: {active} outstanding txs, {len(self.abandoned)} abandoned")
+                return active
+            time.sleep(interval)
+
+
+def get_env_nonce_recovery(conn, on_replaced=None, recovery_writer=None):
+    """a NonceRecovery with the NONCE_* settings, or None if NONCE_RECOVERY is off"""
+    if not NONCE_RECOVERY:
+        return None
+    return NonceRecovery(conn, on_replaced, recovery_writer)
+
+
+def read_replacements(path):
+    """(tx_hash, replaced_by) of every replacement in a recovery csv"""
+    return [(row.tx_hash, row.replaced_by) for row in read_rows(path, RecoveryResult) if row.action == "replace"]
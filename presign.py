@@ -0,0 +1,83 @@
+import bisect
+import os
+from multiprocessing import Pool
+
+from eth_utils import to_hex
+from web3 import Account
+
+import metrics
+from common import get_env_connection, log, debug
+
+CHUNK_SIZE = 256
+
+_worker_conn = None
+
+
+def _init_worker():
+    global _worker_conn
+    _worker_conn = get_env_connection()
+
+
+def _sign_transfer(job):
+    """sign one token transfer at every gas price level. runs in a pool worker"""
+    private_key, nonce, to_address, val, gas_limit, gas_prices = job
+    contract = _worker_conn.contract
+    data = contract.encodeABI(fn_name="transfer", args=[to_address, val])
+    signed = []
+    for gas_price in gas_prices:
+        tx = {
+            "to": contract.address,
+            "value": 0,
+            "data": data,
+            "gas": gas_limit,
+            "gasPrice": gas_price,
+            "nonce": nonce,
+            "chainId": _worker_conn.chain_id,
+        }
+        signed_tx = Account.signTransaction(tx, private_key)
+        signed.append((bytes(signed_tx.rawTransaction), to_hex(signed_tx.hash)))
+    return signed
+
+
+class PresignedTxs:
+    """raw signed txs per planned tx, one per gas price level (levels sorted ascending)"""
+
+    def __init__(self, gas_prices, signed):
+        self.gas_prices = gas_prices
+        self.signed = signed
+
+    def closest_level(self, gas_price):
+        i = bisect.bisect_left(self.gas_prices, gas_price)
+        if i == 0:
+            return 0
+        if i == len(self.gas_prices):
+            return i - 1
+        return i if self.gas_prices[i] - gas_price <= gas_price - self.gas_prices[i - 1] else i - 1
+
+    def send(self, conn, i, gas_price, from_account=None, nonce=None):
+        """send the pre-signed version of tx i closest to gas_price. returns (tx_hash, gas_price used). sender and
+        nonce are handed to the connection's nonce recovery"""
+        level = self.closest_level(gas_price)
+        raw_tx, tx_hash = self.signed[i][level]
+        try:
+            return conn.send_raw(raw_tx, tx_hash, from_account, nonce, self.gas_prices[level]), self.gas_prices[level]
+        except ValueError as e:
+            if level + 1 == len(self.gas_prices):
+                raise e
+            debug("tx failed. trying next gas price level %s (%s)", self.gas_prices[level + 1], e)
+            metrics.PRESIGN_LEVEL_RETRIES.inc()
+            level += 1
+            raw_tx, tx_hash = self.signed[i][level]
+            return conn.send_raw(raw_tx, tx_hash, from_account, nonce, self.gas_prices[level]), self.gas_prices[level]
+
+
+def presign_transfers(accounts, sender_ids, txs, nonces, val, gas_limit, gas_prices, processes=None):
+    """sign a token transfer of val for every planned tx (sent by the accounts registry's sender_ids), at each of
+    gas_prices, across a process pool"""
+    gas_prices = sorted(gas_prices)
+    jobs = ((accounts.private_key(sender_id), nonce, accounts.address_of(tx.to), val, gas_limit, gas_prices)
+            for sender_id, tx, nonce in zip(sender_ids, txs, nonces))
+    log(f"pre-signing {len(txs)} txs at {len(gas_prices)} gas price levels")
+    with Pool(processes or os.cpu_count(), initializer=_init_worker) as pool:
+        signed = pool.map(_sign_transfer, jobs, chunksize=CHUNK_SIZE)
+    return PresignedTxs(gas_prices, signed)
@@ -0,0 +1,180 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from common import env, env_float, log
+
+RATE_CONTROLLER = env("RATE_CONTROLLER", "")
+RATE_TARGET_LATENCY = env_float("RATE_TARGET_LATENCY", 60)
+RATE_UPDATE_SEC = env_float("RATE_UPDATE_SEC", 60)
+RATE_MIN = env_float("RATE_MIN", 0.1)
+RATE_MAX = env_float("RATE_MAX", 1000)
+RATE_STEP = env_float("RATE_STEP", 0.1)
+RATE_RAMP_SEC = env_float("RATE_RAMP_SEC", 3600)
+RATE_PID = [float(gain) for gain in env("RATE_PID", "0.5,0.1,0").split(",")]
+RATE_MAX_FULLNESS = env_float("RATE_MAX_FULLNESS", 0.95)
+RATE_MAX_GAS_MULTIPLIER = env_float("RATE_MAX_GAS_MULTIPLIER", 1)
+
+BACK_OFF = 0.5
+RAMP_HOLD = 0.9
+GAS_STEP = 1.125
+
+RateResult = namedtuple("RateResult", "timestamp block_number rate gas_price_multiplier pending inclusion_rate "
+                                      "estimated_latency block_fullness")
+
+TARGET_RATE = metrics.REGISTRY.gauge("target_rate_tx_per_sec", "submission rate set by the rate controller")
+GAS_PRICE_MULTIPLIER = metrics.REGISTRY.gauge("gas_price_multiplier",
+                                              "multiplier the rate controller applies to the oracle gas price")
+
+
+class StepPolicy:
+    """additive increase, multiplicative decrease: grow the rate by step (of the initial rate) while latency and
+    block fullness are within bounds, halve it otherwise"""
+
+    def __init__(self, initial_rate, step=RATE_STEP):
+        self.increment = initial_rate * step
+
+    def next_rate(self, rate, latency_error, full, dt):
+        if latency_error >= 0 and not full:
+            return rate + self.increment
+        return rate * BACK_OFF
+
+
+class RampPolicy:
+    """linear ramp from the initial rate to max_rate over ramp_sec. once latency or fullness go out of bounds, the last
+    rate that kept them within bounds is taken as the max sustainable rate, and the ramp then holds just below it"""
+
+    def __init__(self, initial_rate, max_rate=RATE_MAX, ramp_sec=RATE_RAMP_SEC):
+        self.slope = (max_rate - initial_rate) / ramp_sec
+        self.sustained = None
+        self.knee = None
+
+    def next_rate(self, rate, latency_error, full, dt):
+        if self.knee is None:
+            if latency_error >= 0 and not full:
+                self.sustained = rate
+                return rate + self.slope * dt
+            self.knee = self.sustained or rate * BACK_OFF
+            log(f"ramp reached max sustainable rate {self.knee:.2f} tx/sec")
+        return self.knee * RAMP_HOLD
+
+
+class PIDPolicy:
+    """velocity form PID on the relative latency error (target - latency) / target, scaled by the initial rate.
+    while blocks are full only decreases are allowed"""
+
+    def __init__(self, initial_rate, gains=RATE_PID):
+        self.initial_rate = initial_rate
+        self.kp, self.ki, self.kd = gains
+        self.errors = [0.0, 0.0]
+
+    def next_rate(self, rate, latency_error, full, dt):
+        error = min(latency_error, 0.0) if full else latency_error
+        previous, before_previous = self.errors
+        delta = self.kp * (error - previous) + self.ki * error * dt + \
+            self.kd * (error - 2 * previous + before_previous) / dt
+        self.errors = [error, previous]
+        return rate + self.initial_rate * delta
+
+
+POLICIES = {"step": StepPolicy, "ramp": RampPolicy, "pid": PIDPolicy}
+
+
+class RateController:
+    """Closed-loop submission rate (and gas price multiplier), for the load engine to follow through send_times.
+
+    Every update_sec it reads the confirmation tracker's progress and the block monitor's block fullness. latency is
+    estimated by Little's law as pending txs / inclusion rate (or time since start while nothing was included yet),
+    so the backlog is held at what the chain absorbs within target_latency. the policy maps the relative latency
+    error and whether blocks are full to the next rate, within [min_rate, max_rate]. with max_gas_multiplier > 1
+    the gas price is raised while latency is over target on full blocks, and lowered again when latency is below
+    half the target. every update is written as a RateResult row."""
+
+    def __init__(self, policy, initial_rate, get_progress, get_block_fullness, rate_writer=None,
+                 target_latency=RATE_TARGET_LATENCY, update_sec=RATE_UPDATE_SEC, min_rate=RATE_MIN,
+                 max_rate=RATE_MAX, max_fullness=RATE_MAX_FULLNESS, max_gas_multiplier=RATE_MAX_GAS_MULTIPLIER):
+        self.policy = policy
+        self.rate = initial_rate
+        self.get_progress = get_progress
+        self.get_block_fullness = get_block_fullness
+        self.rate_writer = rate_writer
+        self.target_latency = target_latency
+        self.update_sec = update_sec
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_fullness = max_fullness
+        self.max_gas_multiplier = max_gas_multiplier
+        self.gas_price_multiplier = 1.0
+        self._stopped = threading.Event()
+        self._start_time = None
+        self._last = None
+
+    def send_times(self, start_time):
+        """endless send times from start_time, spaced by the current rate"""
+        send_time = start_time
+        while True:
+            yield send_time
+            send_time += 1 / self.rate
+
+    def estimate_latency(self, progress, inclusion_rate, now):
+        if progress.included == 0:
+            return now - self._start_time if progress.pending else 0.0
+        if inclusion_rate == 0:
+            return math.inf if progress.pending else 0.0
+        return progress.pending / inclusion_rate
+
+    def update(self):
+        now = time.time()
+        progress = self.get_progress()
+        last_time, last_included = self._last
+        dt = now - last_time
+        inclusion_rate = (progress.included - last_included) / dt
+        latency = self.estimate_latency(progress, inclusion_rate, now)
+        fullness = self.get_block_fullness()
+        full = fullness >= self.max_fullness
+        latency_error = (self.target_latency - min(latency, 3 * self.target_latency)) / self.target_latency
+
+        self.rate = min(max(self.policy.next_rate(self.rate, latency_error, full, dt), self.min_rate), self.max_rate)
+        if self.max_gas_multiplier > 1:
+            if latency_error < 0 and full:
+                self.gas_price_multiplier = min(self.gas_price_multiplier * GAS_STEP, self.max_gas_multiplier)
+            elif latency_error > 0.5:
+                self.gas_price_multiplier = max(self.gas_price_multiplier / GAS_STEP, 1.0)
+        self._last = (now, progress.included)
+
+        TARGET_RATE.set(self.rate)
+        GAS_PRICE_MULTIPLIER.set(self.gas_price_multiplier)
+        result = RateResult(timestamp=now, block_number=progress.block_number, rate=self.rate,
+                            gas_price_multiplier=self.gas_price_multiplier, pending=progress.pending,
+                            inclusion_rate=inclusion_rate, estimated_latency=latency, block_fullness=fullness)
+        log(f"rate controller: {result}")
+        if self.rate_writer:
+            self.rate_writer.append(result)
+        return result
+
+    def _run(self):
+        while not self._stopped.wait(self.update_sec):
+            try:
+                self.update()
+            except Exception as e:
+                log(f"rate update failed ({e})")
+
+    def start(self):
+        self._start_time = time.time()
+        self._last = (self._start_time, self.get_progress().included)
+        TARGET_RATE.set(self.rate)
+        self._stopped.clear()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def get_env_rate_controller(initial_rate, tracker, block_monitor, rate_writer=None):
+    """the RATE_CONTROLLER policy (step, ramp or pid) fed by tracker and block_monitor, or None if not configured"""
+    if not RATE_CONTROLLER:
+        return None
+    return RateController(POLICIES[RATE_CONTROLLER](initial_rate), initial_rate, tracker.progress,
+                          block_monitor.get_block_fullness, rate_writer)
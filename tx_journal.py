@@ -0,0 +1,75 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from columnar import read_rows
+from common import log, CSVWriter
+
+JournalEntry = namedtuple("JournalEntry", "slot frm nonce tx_hash")
+
+
+def journal_path(planned_txs_path):
+    """load journal of a planned txs csv"""
+    return os.path.splitext(planned_txs_path.rstrip("/"))[0] + ".journal.csv"
+
+
+class TxJournal:
+    """Write-ahead journal of load txs. every tx gets a row (schedule slot, sender, nonce) before it is sent, and
+    another one with its hash once sent. rows are flushed as they are appended, so a killed run never sent a tx its
+    journal does not know of. slots maps the indices of a (resumed) subset of txs to their slots in the plan. with
+    resume, rows are appended to the journal of the run being resumed, otherwise a fresh journal is started."""
+
+    def __init__(self, path, slots=None, resume=False):
+        self.writer = CSVWriter(path, JournalEntry._fields, flush_rows=1, resume=resume)
+        self.slots = slots
+
+    @property
+    def path(self):
+        return self.writer.path
+
+    def append(self, i, frm, nonce, tx_hash=""):
+        slot = i if self.slots is None else self.slots[i]
+        self.writer.append(JournalEntry(slot=slot, frm=frm, nonce=nonce, tx_hash=tx_hash))
+
+    def close(self):
+        self.writer.close()
+
+
+def read_journal(path):
+    return read_rows(path, JournalEntry) if os.path.exists(path) else []
+
+
+def reconcile(conn, accounts, txs, entries=()):
+    """set the nonces of the senders of txs from the chain, and find out which journaled txs were sent, with two
+    batched nonce lookups over the senders. a nonce below its sender's pending nonce (the node has its tx, or it is
+    mined) was sent by the slot that was last journaled with it, as resumed runs may hand a nonce to another slot.
+    returns the slots of txs that remain to be sent, and the hashes of sent txs that are not mined yet"""
+    sender_ids = np.unique(accounts.ids(tx.frm for tx in txs))
+    addresses = [accounts.address(i) for i in sender_ids]
+    accounts.nonces[sender_ids] = conn.get_transaction_counts(addresses, "pending")
+    if not entries:
+        return list(range(len(txs))), []
+    latest = dict(zip(sender_ids.tolist(), conn.get_transaction_counts(addresses, "latest")))
+    claims = {}
+    for entry, sender_id in zip(entries, accounts.ids(entry.frm for entry in entries).tolist()):
+        key, slot = (sender_id, int(entry.nonce)), int(entry.slot)
+        claimed_slot, tx_hash = claims.get(key, (None, ""))
+        # the sent row of a slot follows its intent row
+        claims[key] = slot, entry.tx_hash or (tx_hash if claimed_slot == slot else "")
+    sent, unmined = set(), set()
+    for (sender_id, nonce), (slot, tx_hash) in claims.items():
+        if nonce < accounts.nonces[sender_id]:
+            sent.add(slot)
+            if tx_hash and nonce >= latest[sender_id]:
+                unmined.add(tx_hash)
+    log(f"journal: {len(sent)} of {len(txs)} txs sent, {len(unmined)} of them not mined yet")
+    return [slot for slot in range(len(txs)) if slot not in sent], sorted(unmined)
+
+
+def resumed_txs(txs, slots, tx_per_sec):
+    """the txs of slots, with offsets shifted so that the first of them is due at once. txs without offsets are
+    given their uniform schedule offsets (slot / tx_per_sec) first"""
+    offsets = [float(txs[slot].offset) if txs[slot].offset else slot / tx_per_sec for slot in slots]
+    first = min(offsets, default=0)
+    return [txs[slot]._replace(offset="%.6f" % (offset - first)) for slot, offset in zip(slots, offsets)]
@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import namedtuple
+
+from eth_utils import to_hex
+
+from common import log, TX_WAIT_TIMEOUT
+from latency import log_latency
+
+TrackerProgress = namedtuple("TrackerProgress", "block_number pending included confirmed")
+ReceiptResult = namedtuple("ReceiptResult", "tx_hash block_number gas_used")
+
+
+class ConfirmationTracker:
+    """Tracks inclusion of pending txs by walking each new block's tx list once, instead of polling a receipt per
+    hash. Each scanned block costs a single (batched) fetch regardless of how many txs are pending.
+    txs may be added while a background scan thread (start/stop) is running; on_progress is then called after
+    every scan with a TrackerProgress. with a receipt_writer, receipts of included txs are fetched (one batch per
+    scan) and written as ReceiptResult rows, so results can be collected later without rpc.
+    with a LatencyAnalytics, every scanned block is handed to it along with the txs it included.
+    a tx added after blocks were scanned may be in one of them already (e.g. on fast chains, or results gathered
+    later): the receipts of such txs are looked up once, in a batch at the next scan, and the blocks they were found
+    in are handed to the LatencyAnalytics as late blocks."""
+
+    def __init__(self, conn, start_block_number, confirmations=4, on_progress=None, receipt_writer=None,
+                 analytics=None):
+        self.conn = conn
+        self.start_block_number = start_block_number
+        self.next_block_number = start_block_number
+        self.latest_block_number = start_block_number - 1
+        self.confirmations = confirmations
+        self.on_progress = on_progress
+        self.receipt_writer = receipt_writer
+        self.analytics = analytics
+        self.pending = set()
+        self.unchecked = set()
+        self.included = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, tx_hashes):
+        with self._lock:
+            self._add(tx_hash.lower() for tx_hash in tx_hashes)
+
+    def _add(self, tx_hashes):
+        tx_hashes = set(tx_hashes)
+        self.pending.update(tx_hashes)
+        if self.next_block_number > self.start_block_number:
+            self.unchecked.update(tx_hashes)
+
+    def add_submitted(self, tx_hash, sent_at, gas_price):
+        """add a tx along with when and at which gas price it was sent, for latency analytics"""
+        if self.analytics:
+            self.analytics.submitted(tx_hash, sent_at, gas_price)
+        self.add([tx_hash])
+
+    def replace(self, tx_hash, replaced_by):
+        """track replaced_by instead of the pending tx it replaced (e.g. at a higher gas price)"""
+        with self._lock:
+            if tx_hash.lower() in self.pending:
+                self.pending.remove(tx_hash.lower())
+                self._add([replaced_by.lower()])
+        if self.analytics:
+            self.analytics.replaced(tx_hash, replaced_by)
+
+    def inclusion_block(self, tx_hash):
+        return self.included.get(tx_hash.lower())
+
+    def confirmation_depth(self, tx_hash):
+        """number of blocks (including its own) on top of which tx_hash is confirmed. 0 while pending"""
+        block_number = self.inclusion_block(tx_hash)
+        return 0 if block_number is None else self.latest_block_number - block_number + 1
+
+    def progress(self):
+        with self._lock:
+            confirmed_below = self.latest_block_number - self.confirmations + 1
+            confirmed = sum(1 for block_number in self.included.values() if block_number <= confirmed_below)
+            return TrackerProgress(block_number=self.latest_block_number, pending=len(self.pending),
+                                   included=len(self.included), confirmed=confirmed)
+
+    def scan(self):
+        """scan all blocks mined since the last scan, and look up the receipts of txs added after earlier scans.
+        txs are only marked included once their receipts are written, so a failed scan is retried as a whole by the
+        next one. returns the number of newly included txs"""
+        latest_block_number = self.conn.get_latest_block().number
+        blocks = self.conn.get_blocks(list(range(self.next_block_number, latest_block_number + 1)))
+        with self._lock:
+            block_hits = [[tx_hash for tx_hash in (to_hex(tx_hash) for tx_hash in block.transactions)
+                           if tx_hash in self.pending] for block in blocks]
+            unchecked = [tx_hash for tx_hash in self.unchecked if tx_hash in self.pending]
+        hits = {tx_hash: block.number for block, tx_hashes in zip(blocks, block_hits) for tx_hash in tx_hashes}
+        lookups = [tx_hash for tx_hash in unchecked if tx_hash not in hits]
+        if self.receipt_writer:
+            lookups.extend(hits)
+        receipts = dict(zip(lookups, self.conn.get_transaction_receipts(lookups))) if lookups else {}
+        late = {}
+        for tx_hash in unchecked:
+            receipt = receipts.get(tx_hash)
+            # a receipt beyond latest_block_number is found by the next scan's blocks
+            if tx_hash not in hits and receipt is not None and receipt.blockNumber <= latest_block_number:
+                hits[tx_hash] = receipt.blockNumber
+                late.setdefault(receipt.blockNumber, []).append(tx_hash)
+        late_blocks = self._late_blocks(late) if self.analytics and late else []
+        if self.receipt_writer and hits:
+            self.receipt_writer.append_all(
+                ReceiptResult(tx_hash=tx_hash, block_number=receipts[tx_hash].blockNumber,
+                              gas_used=receipts[tx_hash].gasUsed) for tx_hash in hits if receipts[tx_hash])
+        with self._lock:
+            for tx_hash, block_number in hits.items():
+                self.pending.discard(tx_hash)
+                self.included[tx_hash] = block_number
+            self.unchecked.difference_update(unchecked)
+        latency = None
+        if self.analytics:
+            for late_block in late_blocks:
+                self.analytics.on_late_block(*late_block)
+            for block, tx_hashes in zip(blocks, block_hits):
+                latency = self.analytics.on_block(block.number, block.timestamp, tx_hashes)
+        self.next_block_number = latest_block_number + 1
+        self.latest_block_number = latest_block_number
+        if self.on_progress:
+            self.on_progress(self.progress())
+        if latency:
+            log_latency(latency)
+        return len(hits)
+
+    def _late_blocks(self, late):
+        """on_late_block arguments of the already scanned blocks in late (block number -> txs found in it), with the
+        timestamps of the blocks and, if scanned too, of the blocks confirming them. one batched fetch"""
+        confirmations = self.analytics.confirmations
+        confirmed_by = {block_number: block_number + confirmations - 1 for block_number in late
+                        if block_number + confirmations - 1 < self.next_block_number}
+        timestamps = {block.number: block.timestamp
+                      for block in self.conn.get_blocks(sorted(set(late) | set(confirmed_by.values())))}
+        return [(block_number, timestamps[block_number], tx_hashes,
+                 timestamps[confirmed_by[block_number]] if block_number in confirmed_by else None)
+                for block_number, tx_hashes in sorted(late.items())]
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.scan()
+            except Exception as e:
+                log(f"confirmation scan failed ({e})")
+
+    def start(self, interval):
+        """scan in a background thread every interval seconds"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop the background scan. must be called before wait"""
+        self._stopped.set()
+        self._thread.join()
+
+    def wait(self, interval, recovery=None, timeout=TX_WAIT_TIMEOUT):
+        """block until all pending txs are included, or for at most timeout seconds (0: no limit). with a
+        NonceRecovery, it runs a check before every scan, and waiting ends once all its nonces are mined: txs still
+        pending then lost their nonce to another tx and never will be. returns the number of pending txs"""
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            if recovery:
+                recovery.check()
+            self.scan()
+            progress = self.progress()
+            log(f"{progress.included}/{progress.included + progress.pending} txs included "
+                f"({progress.confirmed} with {self.confirmations}+ confirmations)")
+            if progress.pending == 0:
+                return 0
+            if recovery and recovery.outstanding_count() == 0:
+                log(f"{progress.pending} txs will never be included, their nonces were used by other txs")
+                return progress.pending
+            if deadline and time.time() > deadline:
+                log(f"giving up on {progress.pending} pending txs after {timeout} seconds")
+                return progress.pending
+            time.sleep(interval)
+
+
+def log_progress(progress):
+    log(f"confirmation progress: {progress}")
@@ -1,19 +1,20 @@
 import time
 
-from common import AccountResult, TxPlannedResult, csv_reader, get_arg, CSVWriter, now_str, Connection, \
-    get_env_connection, log
+from account_store import read_accounts
+from common import get_arg, get_env_connection, log
+
+INTERVAL = 1
 
 if __name__ == "__main__":
-    now = now_str()
-    account_results = csv_reader(get_arg(0), AccountResult)
+    """wait until every account of an accounts csv (or seed file) has a balance, polling the balances of the
+    accounts still unfunded in batches"""
+    accounts = read_accounts(get_arg(0))
     env_connection = get_env_connection()
 
-    offset = 28000
-
-    for i in range(offset, len(account_results)):
-        account_result = account_results[i]
-        balance = env_connection.get_balance(account_result.address)
-        while balance == 0:
-            time.sleep(1)
-            balance = env_connection.get_balance(account_result.address)
-        log(f"({i}/{len(account_results)}){account_result.address}: {balance}")
+    unfunded = [accounts.address(i) for i in range(len(accounts))]
+    while unfunded:
+        balances = env_connection.get_balances(unfunded)
+        unfunded = [address for address, balance in zip(unfunded, balances) if balance == 0]
+        log(f"({len(accounts) - len(unfunded)}/{len(accounts)}) accounts funded")
+        if unfunded:
+            time.sleep(INTERVAL)
@@ -1,39 +1,110 @@
-from collections import namedtuple
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from block_monitor import BlockResult
-from common import get_arg, CSVWriter, get_env_connection, log, csv_reader
+from columnar import iter_rows
+from common import get_arg, CSVWriter, get_env_connection, log, env_int, install_exit_on_signal
 
-OldBlockResult = namedtuple('BlockResult', 'block_number, block_timestamp, my_timestamp, timestamp_delta')
+BLOCK_FIXER_WORKERS = env_int("BLOCK_FIXER_WORKERS", 8)
+BLOCK_FIXER_CHUNK = env_int("BLOCK_FIXER_CHUNK", 20)
 
 
-def block_fixer(block_csv_path, writer):
-    """re-fetch stats and fill-in missing blocks"""
-    conn = get_env_connection()
-    block_results = csv_reader(block_csv_path, OldBlockResult)
-    block_results_mem = {block_result.block_number: block_result for block_result in block_results}
-    new_results = []
-    latest = None
-    for i in range(int(block_results[-1].block_number), int(block_results[0].block_number) - 1, -1):
-        k = str(i)
-        if k in block_results_mem:
-            latest = block_results_mem[k]
-        my_timestamp = latest.my_timestamp
-        block = conn.get_block(i)
-        block_stats = conn.get_block_stats(block)
-        row = BlockResult(
+def scan_blocks(block_csv_path):
+    """first block number, my_timestamp of every block from it on (that of the next higher recorded block for blocks
+    missing from the file), and which of them are missing or stale (recorded without stats). a single pass over the
+    file, keeping a few bytes per block. rows must be in block order, as the block monitor writes them"""
+    numbers, my_timestamps, has_stats = array("q"), array("d"), array("b")
+    for row in iter_rows(block_csv_path, BlockResult):
+        number = int(row.block_number)
+        if numbers and number <= numbers[-1]:
+            if number == numbers[-1]:
+                # observed twice (e.g. a reorg). the first observation is kept
+                continue
+            raise ValueError(f"block {number} after block {numbers[-1]}: rows are not in block order")
+        numbers.append(number)
+        my_timestamps.append(float(row.my_timestamp))
+        has_stats.append(row.tx_count not in ("", "nan"))
+    numbers = np.frombuffer(numbers, np.int64)
+    first = int(numbers[0])
+    known = np.full(int(numbers[-1]) - first + 1, np.nan)
+    known[numbers - first] = np.frombuffer(my_timestamps, np.float64)
+    # index of the next recorded block at or above every block
+    next_known = np.where(np.isnan(known), len(known), np.arange(len(known)))
+    next_known = np.minimum.accumulate(next_known[::-1])[::-1]
+    todo = np.ones(len(known), bool)
+    todo[numbers[np.frombuffer(has_stats, np.int8).astype(bool)] - first] = False
+    return first, known[next_known], todo
+
+
+def fetch_blocks(block_numbers, workers=BLOCK_FIXER_WORKERS, chunk_size=BLOCK_FIXER_CHUNK):
+    """(block, BlockStats) of block_numbers (ascending), in order. chunks of blocks are fetched with full txs in a
+    batch per chunk, by a pool of workers with a connection each, at most 2 * workers chunks ahead of the consumer"""
+    local = threading.local()
+
+    def fetch(chunk):
+        if not hasattr(local, "conn"):
+            local.conn = get_env_connection()
+        blocks = local.conn.get_blocks(chunk, full_transactions=True)
+        return [(block, local.conn.get_block_stats(block)) for block in blocks if block is not None]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        for start in range(0, len(block_numbers), chunk_size):
+            futures.append(executor.submit(fetch, block_numbers[start:start + chunk_size]))
+            if len(futures) >= 2 * workers:
+                yield from futures.popleft().result()
+        while futures:
+            yield from futures.popleft().result()
+
+
+def fetched_rows(first, my_timestamps, todo):
+    """BlockResult rows of the blocks to fetch, in order"""
+    block_numbers = (first + np.flatnonzero(todo)).tolist()
+    for k, (block, block_stats) in enumerate(fetch_blocks(block_numbers), 1):
+        my_timestamp = my_timestamps[block.number - first]
+        if k % 1000 == 0:
+            log(f"fetched {k}/{len(block_numbers)} blocks")
+        yield BlockResult(
             block_number=block.number,
             block_timestamp=block.timestamp,
             my_timestamp=my_timestamp,
-            timestamp_delta=int(my_timestamp) - int(block.timestamp),
+            timestamp_delta=my_timestamp - int(block.timestamp),
             tx_count=block_stats.tx_count,
             avg_gas_price=block_stats.avg_gas_price,
             median_gas_price=block_stats.median_gas_price,
             q5_gas_price=block_stats.q5_gas_price,
-            q95_gas_price=block_stats.q95_gas_price)
-        log(row)
-        new_results.append(row)
-    writer.append_all(reversed(new_results))
+            q95_gas_price=block_stats.q95_gas_price,
+            stats_timestamp=time.time())
+
+
+def block_fixer(block_csv_path, writer):
+    """re-fetch stats of blocks recorded without them and fill in missing blocks, which take the my_timestamp of the
+    next higher recorded block. only those blocks are fetched, and the fixed file is written by merging them into the
+    recorded rows as both streams go"""
+    first, my_timestamps, todo = scan_blocks(block_csv_path)
+    log(f"{int(todo.sum())} of {len(todo)} blocks missing or without stats")
+    fetched = fetched_rows(first, my_timestamps, todo)
+    pending = next(fetched, None)
+    last_number = first - 1
+    for row in iter_rows(block_csv_path, BlockResult):
+        number = int(row.block_number)
+        while pending is not None and pending.block_number < number:
+            writer.append(pending)
+            pending = next(fetched, None)
+        if number > last_number and not todo[number - first]:
+            writer.append(row)
+        last_number = max(last_number, number)
+    while pending is not None:
+        writer.append(pending)
+        pending = next(fetched, None)
+    writer.close()
 
 
 if __name__ == "__main__":
+    install_exit_on_signal()
     block_fixer(get_arg(), CSVWriter(f"{get_arg()}.fixed", BlockResult._fields))
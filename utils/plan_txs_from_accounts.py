@@ -1,11 +1,11 @@
-import random
-
-from common import AccountResult, TxPlannedResult, csv_reader, get_arg, CSVWriter, now_str
+from account_store import read_accounts
+from common import TxPlannedResult, get_arg, CSVWriter, now_str, env_int
+from workload import plan_txs
 
 if __name__ == "__main__":
+    """one tx per account, at TX_PER_SEC"""
     now = now_str()
-    account_results = csv_reader(get_arg(0), AccountResult)
-    frms = account_results[:]
-    planned_txs = [TxPlannedResult(account.address, random.choice(account_results).address) for account in account_results]
+    account_count = len(read_accounts(get_arg(0)))
+    planned_txs = plan_txs(account_count, account_count, env_int("TX_PER_SEC", 1), one_per_sender=True)
     tx_plan_writer = CSVWriter(f"results/txs.planned.{now}.csv", TxPlannedResult._fields)
     tx_plan_writer.append_all(planned_txs)
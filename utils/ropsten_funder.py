@@ -2,7 +2,8 @@
 import requests
 import time
 
-from common import get_gas_price, get_env_connection, get_env_funder
+from common import get_env_connection, get_env_funder
+from gas_oracle import get_gas_price
 
 GAS_LIMIT = 21000
 
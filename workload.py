@@ -0,0 +1,118 @@
+#!/usr/bin/env python3.6
+import math
+
+import numpy as np
+
+from account_store import read_accounts
+from block_monitor import BlockResult
+from columnar import read_columns
+from common import env, env_int, env_float, log, get_arg, now_str, CSVWriter, TxPlannedResult
+
+WORKLOAD_ARRIVALS = env("WORKLOAD_ARRIVALS", "uniform")
+WORKLOAD_SENDERS = env("WORKLOAD_SENDERS", "uniform")
+WORKLOAD_RECEIVERS = env("WORKLOAD_RECEIVERS", "uniform")
+WORKLOAD_ZIPF_S = env_float("WORKLOAD_ZIPF_S", 1.1)
+WORKLOAD_BURST_FACTOR = env_float("WORKLOAD_BURST_FACTOR", 5)
+WORKLOAD_BURST_SEC = env_float("WORKLOAD_BURST_SEC", 60)
+WORKLOAD_PERIOD_SEC = env_float("WORKLOAD_PERIOD_SEC", 86400)
+WORKLOAD_AMPLITUDE = env_float("WORKLOAD_AMPLITUDE", 0.5)
+WORKLOAD_REPLAY = env("WORKLOAD_REPLAY", "")
+WORKLOAD_SEED = env_int("WORKLOAD_SEED", -1)
+
+DIURNAL_GRID = 1 << 16
+
+
+def uniform_offsets(count, rate, rand):
+    """tx i at i / rate"""
+    return np.arange(count) / rate
+
+
+def poisson_offsets(count, rate, rand):
+    """poisson arrivals: exponential inter-arrival times of mean 1 / rate"""
+    offsets = np.cumsum(rand.exponential(1 / rate, count))
+    return offsets - offsets[0]
+
+
+def mmpp_offsets(count, rate, rand, burst_factor=WORKLOAD_BURST_FACTOR, mean_state_sec=WORKLOAD_BURST_SEC):
+    """bursty arrivals from a two state markov modulated poisson process. quiet and burst states alternate, each
+    lasting exponentially distributed times (mean mean_state_sec); the burst rate is burst_factor times the quiet
+    rate, so that the mean rate is rate"""
+    quiet_rate = 2 * rate / (1 + burst_factor)
+    rates = np.array([quiet_rate, quiet_rate * burst_factor])
+    # enough states to cover count arrivals, with margin
+    state_count = 2 * int(math.ceil(count / (rate * mean_state_sec))) + 16
+    while True:
+        durations = rand.exponential(mean_state_sec, state_count)
+        state_rates = rates[np.arange(state_count) % 2]
+        arrivals = rand.poisson(state_rates * durations)
+        if arrivals.sum() >= count:
+            break
+        state_count *= 2
+    starts = np.concatenate([[0.0], np.cumsum(durations)[:-1]])
+    offsets = np.repeat(starts, arrivals) + rand.uniform(0, 1, arrivals.sum()) * np.repeat(durations, arrivals)
+    offsets = np.sort(offsets)[:count]
+    return offsets - offsets[0]
+
+
+def diurnal_offsets(count, rate, rand, period=WORKLOAD_PERIOD_SEC, amplitude=WORKLOAD_AMPLITUDE):
+    """poisson arrivals with a rate following rate * (1 - amplitude * cos(2 pi t / period)), i.e. starting at the
+    daily low. unit rate arrivals are mapped through the inverse of the cumulative rate"""
+    unit_arrivals = np.cumsum(rand.exponential(1.0, count))
+    duration = unit_arrivals[-1] / rate * (1 + amplitude) + period
+    grid = np.linspace(0, duration, DIURNAL_GRID)
+    cumulative_rate = rate * (grid - amplitude * period / (2 * np.pi) * np.sin(2 * np.pi * grid / period))
+    offsets = np.interp(unit_arrivals, cumulative_rate, grid)
+    return offsets - offsets[0]
+
+
+def replay_offsets(count, rate, rand, blocks_path=WORKLOAD_REPLAY):
+    """the arrival pattern of real blocks (a block results csv): txs are spread over the recorded block intervals in
+    proportion to their tx counts, and time is scaled so the mean rate is rate"""
+    blocks = read_columns(blocks_path, BlockResult)
+    order = np.argsort(np.asarray(blocks.block_number))
+    timestamps = np.asarray(blocks.block_timestamp, dtype=np.float64)[order]
+    tx_counts = np.asarray(blocks.tx_count, dtype=np.float64)[order]
+    # txs of block k arrived between block k-1 and block k
+    cumulative = np.concatenate([[0.0], np.cumsum(tx_counts[1:])])
+    times = timestamps - timestamps[0]
+    offsets = np.interp(np.sort(rand.uniform(0, cumulative[-1], count)), cumulative, times)
+    offsets -= offsets[0]
+    return offsets * (count / rate) / max(offsets[-1], 1e-9)
+
+
+ARRIVALS = {"uniform": uniform_offsets, "poisson": poisson_offsets, "mmpp": mmpp_offsets,
+            "diurnal": diurnal_offsets, "replay": replay_offsets}
+
+
+def pick(n, count, distribution, rand, s=WORKLOAD_ZIPF_S):
+    """count indices into n items: uniform, or zipf (item of popularity rank k picked with probability ~ 1 / k^s,
+    ranks shuffled over the items)"""
+    if distribution == "uniform":
+        return rand.randint(0, n, count)
+    if distribution == "zipf":
+        weights = 1.0 / np.arange(1, n + 1) ** s
+        ranks = rand.choice(n, size=count, p=weights / weights.sum())
+        return rand.permutation(n)[ranks]
+    raise ValueError(f"unknown distribution {distribution}")
+
+
+def plan_txs(account_count, count, rate, arrivals=WORKLOAD_ARRIVALS, senders=WORKLOAD_SENDERS,
+             receivers=WORKLOAD_RECEIVERS, one_per_sender=False, seed=WORKLOAD_SEED):
+    """count planned txs between account_count accounts (by account id), with send offsets (seconds from start) from
+    the arrivals process. with one_per_sender every account sends exactly one tx"""
+    rand = np.random.RandomState(seed if seed >= 0 else None)
+    log(f"planning {count} txs: {arrivals} arrivals at {rate} tx/sec, {senders} senders, {receivers} receivers")
+    offsets = ARRIVALS[arrivals](count, rate, rand)
+    if one_per_sender:
+        frms = rand.permutation(account_count)[:count]
+    else:
+        frms = pick(account_count, count, senders, rand)
+    tos = pick(account_count, count, receivers, rand)
+    columns = (np.char.mod("%d", frms), np.char.mod("%d", tos), np.char.mod("%.6f", offsets))
+    return [TxPlannedResult(*row) for row in zip(*(column.tolist() for column in columns))]
+
+
+if __name__ == "__main__":
+    """./workload.py <accounts_csv> <tx_count> <tx_per_sec>: plan txs between existing accounts"""
+    planned_txs = plan_txs(len(read_accounts(get_arg(0))), int(get_arg(1)), float(get_arg(2)))
+    CSVWriter(f"results/txs.planned.{now_str()}.csv", TxPlannedResult._fields).append_all(planned_txs)